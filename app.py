@@ -1,14 +1,39 @@
+import cProfile
+import csv
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import multiprocessing
 import os
+import pstats
 import re
+import queue
+import random
+import select
+import signal
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dotenv import load_dotenv
 from datetime import datetime, date
+from decimal import Decimal
 from zoneinfo import ZoneInfo
 from mailersend import MailerSendClient, EmailBuilder, MailerSendError
 
-from flask import Flask, render_template, request, redirect, session
+from flask import Flask, Response, g, has_request_context, render_template, request, redirect, send_file, session, stream_template, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
+import click
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 from psycopg2 import sql, errorcodes
+from psycopg2.extras import execute_values
 
 load_dotenv()
 
@@ -22,16 +47,96 @@ MAILERSEND_BULK_BATCH_SIZE = max(1, int(os.getenv("MAILERSEND_BULK_BATCH_SIZE",
 EMAIL_REGEX = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
 DEFAULT_ALERT_RECIPIENTS = ["jwang@gummymaker.us", "brandon121511@gmail.com"]
 INGREDIENT_STAGES = ("Purchased", "In Stock", "Allocated", "Used")
+FORECAST_ALPHA = float(os.getenv("FORECAST_ALPHA", "0.2"))
+REORDER_COVER_DAYS = int(os.getenv("REORDER_COVER_DAYS", "21"))
+SEARCH_RESULT_LIMIT = int(os.getenv("SEARCH_RESULT_LIMIT", "25"))
+SEARCH_TERM_REGEX = re.compile(r"\w+")
+EVENT_CHANNEL = "inventory_events"
+SSE_CLIENT_BUFFER = int(os.getenv("SSE_CLIENT_BUFFER", "100"))
+SSE_HEARTBEAT_SECONDS = int(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+REPLICA_DATABASE_URL = os.getenv("REPLICA_DATABASE_URL")
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+REPLICA_LAG_CHECK_SECONDS = float(os.getenv("REPLICA_LAG_CHECK_SECONDS", "5"))
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "10"))
+# A streaming replica hears from the primary at least every wal_receiver_timeout / 2.
+REPLICA_SILENCE_SECONDS = float(os.getenv("REPLICA_SILENCE_SECONDS", "60"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+LOOKUP_MAX_ITEMS = int(os.getenv("LOOKUP_MAX_ITEMS", "200"))
+SYNC_TOMBSTONE_DAYS = int(os.getenv("SYNC_TOMBSTONE_DAYS", "30"))
+REPOSITORY_BACKEND = os.getenv("REPOSITORY_BACKEND", "postgres").lower()
+COMPLETED_PAGE_SIZE = 50
+BACKUP_TABLES = ("items", "inventory", "history", "projects", "project_ingredients", "lot_trace")
+BACKUP_WORKERS = int(os.getenv("BACKUP_WORKERS", "4"))
+BACKUP_COMPRESSION_LEVEL = int(os.getenv("BACKUP_COMPRESSION_LEVEL", "1"))
+JOB_RESULTS_DIR = os.getenv("JOB_RESULTS_DIR", os.path.join(app.instance_path, "job_results"))
+JOB_UPLOAD_DIR = os.path.join(JOB_RESULTS_DIR, "uploads")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_SECONDS = int(os.getenv("JOB_RETRY_SECONDS", "30"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "5"))
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "15"))
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "120"))
+JOB_CHANNEL = "job_queue"
+STREAM_FETCH_ROWS = int(os.getenv("STREAM_FETCH_ROWS", "500"))
+STREAM_CHUNK_BYTES = int(os.getenv("STREAM_CHUNK_BYTES", str(16 * 1024)))
+RENDER_CACHE_PATH = os.getenv(
+    "RENDER_CACHE_PATH", os.path.join(tempfile.gettempdir(), "gminventory-render-cache.sqlite3")
+)
+RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+RENDER_CACHE_MAX_ENTRY_BYTES = int(os.getenv("RENDER_CACHE_MAX_ENTRY_BYTES", str(2 * 1024 * 1024)))
+RENDER_CACHE_FLUSH_SECONDS = float(os.getenv("RENDER_CACHE_FLUSH_SECONDS", "5"))
+
+# alias, canonical unit, factor to canonical, low-stock threshold in canonical units
+DEFAULT_UNITS = (
+    ("mg", "g", 0.001, None),
+    ("g", "g", 1, 1000),
+    ("gram", "g", 1, 1000),
+    ("grams", "g", 1, 1000),
+    ("kg", "g", 1000, 50000),
+    ("kilogram", "g", 1000, 50000),
+    ("kilograms", "g", 1000, 50000),
+    ("oz", "g", 28.349523125, None),
+    ("ounce", "g", 28.349523125, None),
+    ("ounces", "g", 28.349523125, None),
+    ("lb", "g", 453.59237, None),
+    ("lbs", "g", 453.59237, None),
+    ("pound", "g", 453.59237, None),
+    ("pounds", "g", 453.59237, None),
+    ("ml", "ml", 1, None),
+    ("l", "ml", 1000, None),
+    ("liter", "ml", 1000, None),
+    ("liters", "ml", 1000, None),
+)
+_unit_registry = None
+
+def normalize_unit_name(unit):
+    return (unit or "").strip().lower()
+
+def unit_registry():
+    """Return {alias: (canonical_unit, factor, threshold)}, loaded once per process."""
+    global _unit_registry
+    if _unit_registry is None and REPOSITORY_BACKEND == "memory":
+        _unit_registry = {
+            alias: (canonical, float(factor), float(threshold) if threshold is not None else None)
+            for alias, canonical, factor, threshold in DEFAULT_UNITS
+        }
+    if _unit_registry is None:
+        conn = connect_db(read_only=True)
+        c = conn.cursor()
+        c.execute("SELECT alias, canonical_unit, factor, low_stock_threshold FROM units")
+        _unit_registry = {
+            row[0]: (row[1], float(row[2]), float(row[3]) if row[3] is not None else None)
+            for row in c.fetchall()
+        }
+        conn.close()
+    return _unit_registry
+
+def canonical_unit_for(unit):
+    """Return (canonical_unit, factor) for a free-text unit."""
+    alias = normalize_unit_name(unit)
+    canonical_unit, factor, _ = unit_registry().get(alias, (alias, 1.0, None))
+    return canonical_unit, factor
 
-def _low_stock_threshold_for_unit(unit):
-    if not unit:
-        return LOW_STOCK_THRESHOLD
-    normalized = unit.lower()
-    if normalized in {"g", "gram", "grams"}:
-        return 1000
-    if normalized in {"kg", "kilogram", "kilograms"}:
-        return 50
-    return LOW_STOCK_THRESHOLD
 
 @app.template_filter("comma")
 def format_comma(value):
@@ -51,23 +156,24 @@ def log_dashboard_event(cursor, message, username=None):
         "INSERT INTO dashboard_history (message, username) VALUES (%s, %s)",
         (message, username),
     )
+    mark_data_changed("projects")
+
+def _format_history_row(row):
+    return {
+        "id": row[0],
+        "item_number": row[1],
+        "lot": row[2],
+        "change": row[3],
+        "remaining": row[4],
+        "unit": row[5],
+        "action_type": row[6],
+        "username": row[7],
+        "timestamp": format_timestamp_pst(row[8]),
+        "item_name": row[9],
+    }
 
 def _format_history_rows(rows):
-    formatted = []
-    for row in rows:
-        formatted.append({
-            "id": row[0],
-            "item_number": row[1],
-            "lot": row[2],
-            "change": row[3],
-            "remaining": row[4],
-            "unit": row[5],
-            "action_type": row[6],
-            "username": row[7],
-            "timestamp": format_timestamp_pst(row[8]),
-            "item_name": row[9],
-        })
-    return formatted
+    return [_format_history_row(row) for row in rows]
 
 def _parse_recipients(value):
     if not value:
@@ -189,12 +295,151 @@ def maybe_send_expiration_email(item_number, lot, exp_value, item_name, supplier
 # -------------------------
 # DATABASE SETUP
 # -------------------------
-def connect_db():
+_replica_health = {"checked_at": float("-inf"), "fresh": False}
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """Connection that remembers which hot statements it has prepared."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+class PooledConnection:
+    """Pool checkout that acts like a connection; close() hands it back."""
+
+    def __init__(self, pool, conn):
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_conn", conn)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def close(self):
+        conn = self._conn
+        if conn is None:
+            return
+        object.__setattr__(self, "_conn", None)
+        discard = bool(conn.closed)
+        if not discard:
+            try:
+                conn.rollback()
+                # The next borrower gets a plain read-write READ COMMITTED session.
+                conn.autocommit = False
+                conn.set_session(isolation_level="DEFAULT", readonly="DEFAULT", deferrable="DEFAULT")
+            except psycopg2.Error:
+                discard = True
+        self._pool.putconn(conn, close=discard)
+
+def connect_db(read_only=False):
+    """Check out a pooled connection, routing read-only work to the replica when safe."""
+    if read_only and REPLICA_DATABASE_URL and not _reads_pinned_to_primary():
+        conn = _connect_replica()
+        if conn is not None:
+            return conn
+    return _pooled_connection("primary", _primary_connect_params())
+
+def _pooled_connection(name, connect_params):
+    global _pools_pid
+    with _pools_lock:
+        # Pools opened before a fork must not be shared with the children.
+        if _pools_pid != os.getpid():
+            _pools.clear()
+            _pools_pid = os.getpid()
+        pool = _pools.get(name)
+        if pool is None:
+            pool = psycopg2.pool.ThreadedConnectionPool(
+                0, DB_POOL_MAX, connection_factory=PreparingConnection, **connect_params
+            )
+            _pools[name] = pool
+    try:
+        conn = pool.getconn()
+    except psycopg2.pool.PoolError:
+        app.logger.warning("Connection pool %s exhausted, opening an unpooled connection.", name)
+        return _track_request_connection(
+            psycopg2.connect(connection_factory=PreparingConnection, **connect_params)
+        )
+    if conn.closed:
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return _track_request_connection(PooledConnection(pool, conn))
+
+def _track_request_connection(conn):
+    """Remember a request's checkout so teardown returns it even if the view raised."""
+    if has_request_context():
+        g.setdefault("db_connections", []).append(conn)
+    return conn
+
+@app.teardown_request
+def release_request_connections(exc):
+    # close() is idempotent, so connections the view already closed are skipped.
+    for conn in g.pop("db_connections", ()):
+        try:
+            conn.close()
+        except psycopg2.Error as close_exc:
+            app.logger.warning("Could not release database connection: %s", close_exc)
+
+def _reads_pinned_to_primary():
+    # A user who just wrote keeps reading the primary until the replica catches up,
+    # and pages rendered into the shared cache must not capture replica lag.
+    if not has_request_context():
+        return False
+    return g.get("render_cache_fill", False) or session.get("primary_until", 0) > time.time()
+
+def _connect_replica():
+    try:
+        conn = _pooled_connection("replica", {"dsn": REPLICA_DATABASE_URL, "connect_timeout": 2})
+    except psycopg2.OperationalError as exc:
+        app.logger.warning("Replica unavailable, reading from primary: %s", exc)
+        return None
+
+    now = time.monotonic()
+    if now - _replica_health["checked_at"] >= REPLICA_LAG_CHECK_SECONDS:
+        # Replay catching up with what was received says nothing once the
+        # receiver is disconnected, so the replica must also be streaming and
+        # have heard from the primary recently.
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                SELECT NOT pg_is_in_recovery() OR COALESCE((
+                           SELECT status = 'streaming'
+                                  AND last_msg_receipt_time > now() - make_interval(secs => %s)
+                           FROM pg_stat_wal_receiver
+                       ), false),
+                       COALESCE(
+                           CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+                           END,
+                           0
+                       )
+                """,
+                (REPLICA_SILENCE_SECONDS,),
+            )
+            streaming, lag = cursor.fetchone()
+            lag = float(lag)
+        conn.rollback()
+        _replica_health.update(checked_at=now, fresh=streaming and lag <= REPLICA_MAX_LAG_SECONDS)
+        if not streaming:
+            app.logger.warning("Replica is not streaming from the primary, reading from primary.")
+        elif not _replica_health["fresh"]:
+            app.logger.warning("Replica lag %.1fs exceeds %.1fs, reading from primary.", lag, REPLICA_MAX_LAG_SECONDS)
+
+    if not _replica_health["fresh"]:
+        conn.close()
+        return None
+    conn.set_session(readonly=True)
+    return conn
+
+def _primary_connect_params():
     db_url = os.getenv("DATABASE_URL") or os.getenv("POSTGRES_URL")
     if db_url:
-        return psycopg2.connect(db_url)
-
-    db_params = dict(
+        return {"dsn": db_url}
+    return dict(
         host=os.getenv("POSTGRES_HOST", "localhost"),
         port=os.getenv("POSTGRES_PORT", "5432"),
         dbname=os.getenv("POSTGRES_DB", "gummy_inventory"),
@@ -202,14 +447,48 @@ def connect_db():
         password=os.getenv("POSTGRES_PASSWORD", "postgres"),
     )
 
+def _connect_primary():
+    """Open a dedicated (unpooled) primary connection, creating the database if needed."""
+    db_params = _primary_connect_params()
     try:
-        return psycopg2.connect(**db_params)
+        return psycopg2.connect(connection_factory=PreparingConnection, **db_params)
     except psycopg2.OperationalError as exc:
-        if _is_missing_database_error(exc):
+        if "dsn" not in db_params and _is_missing_database_error(exc):
             create_database_if_missing(db_params)
-            return psycopg2.connect(**db_params)
+            return psycopg2.connect(connection_factory=PreparingConnection, **db_params)
         raise
 
+# Statements behind the per-keystroke lookups; each pooled connection
+# prepares them once and then only sends EXECUTE with parameters.
+HOT_STATEMENTS = {
+    "item_lookup": (
+        "text",
+        "SELECT item_number, name, unit, supplier, exp FROM inventory WHERE item_number = $1",
+    ),
+    "item_lots": (
+        "text",
+        "SELECT lot FROM inventory WHERE item_number = $1",
+    ),
+    "lot_quantity": (
+        "text, text",
+        "SELECT quantity, unit FROM inventory WHERE item_number = $1 AND lot = $2",
+    ),
+    "lot_details": (
+        "text, text",
+        "SELECT quantity, unit, name, supplier, exp FROM inventory WHERE item_number = $1 AND lot = $2",
+    ),
+}
+
+def execute_prepared(cursor, name, params):
+    """Run a registered hot statement, preparing it on first use per connection."""
+    conn = cursor.connection
+    if name not in conn.prepared:
+        arg_types, statement = HOT_STATEMENTS[name]
+        cursor.execute(f"PREPARE {name} ({arg_types}) AS {statement}")
+        conn.prepared.add(name)
+    placeholders = ", ".join(["%s"] * len(params))
+    cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+
 def _is_missing_database_error(exc):
     if getattr(exc, "pgcode", None) == errorcodes.INVALID_CATALOG_NAME:
         return True
@@ -251,8 +530,19 @@ def format_timestamp_pst(ts):
         dt = dt.replace(tzinfo=ZoneInfo("UTC"))
     return dt.astimezone(PST_ZONE).strftime("%Y-%m-%d %I:%M %p %Z")
 
+DAILY_COMPLETIONS_BACKFILL = """
+    INSERT INTO daily_completions (day, customer_name, projects_completed, bags_completed)
+    SELECT COALESCE(completed_on, (created_at AT TIME ZONE 'America/Los_Angeles')::date),
+           COALESCE(customer_name, ''),
+           COUNT(*),
+           COALESCE(SUM(completed_bags), 0)
+    FROM projects
+    WHERE status = 'Completed'
+    GROUP BY 1, 2
+"""
+
 def init_db():
-    conn = connect_db()
+    conn = _connect_primary()
     c = conn.cursor()
 
     c.execute("""
@@ -310,6 +600,7 @@ def init_db():
         )
     """)
     c.execute("ALTER TABLE projects ADD COLUMN IF NOT EXISTS customer_name TEXT")
+    c.execute("ALTER TABLE projects ADD COLUMN IF NOT EXISTS product TEXT")
 
     c.execute("""
         CREATE TABLE IF NOT EXISTS project_ingredients (
@@ -337,10 +628,605 @@ def init_db():
         )
     """)
 
+    # Watermarks for incremental jobs that consume history: rows whose
+    # write_xid is below folded_before have been folded in
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS job_state (
+            name TEXT PRIMARY KEY,
+            folded_before xid8 NOT NULL DEFAULT '0',
+            updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS item_forecasts (
+            item_number TEXT PRIMARY KEY,
+            unit TEXT,
+            daily_usage NUMERIC NOT NULL DEFAULT 0,
+            last_usage_date DATE,
+            usage_rate NUMERIC,
+            on_hand NUMERIC,
+            days_of_cover NUMERIC,
+            stockout_date DATE,
+            updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_item_forecasts_cover ON item_forecasts (days_of_cover)")
+
+    # FULL-TEXT SEARCH: generated tsvector columns kept current by Postgres
+    c.execute("""
+        ALTER TABLE inventory ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', coalesce(item_number, '') || ' ' || coalesce(lot, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(name, '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(supplier, '')), 'C')
+        ) STORED
+    """)
+    c.execute("""
+        ALTER TABLE projects ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(customer_name, '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(description, '')), 'C')
+        ) STORED
+    """)
+    c.execute("""
+        ALTER TABLE history ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', coalesce(item_number, '') || ' ' || coalesce(lot, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(action_type, '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(username, '')), 'C')
+        ) STORED
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_inventory_search ON inventory USING GIN (search_vector)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_projects_search ON projects USING GIN (search_vector)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_history_search ON history USING GIN (search_vector)")
+
+    # LIVE EVENTS: every write path notifies listeners on commit. Text fields
+    # are capped so a payload stays under NOTIFY's 8000-byte limit even in
+    # escaped multibyte text; a longer one would abort the write itself.
+    c.execute("""
+        CREATE OR REPLACE FUNCTION notify_inventory_event() RETURNS trigger AS $$
+        DECLARE
+            payload json;
+        BEGIN
+            IF TG_TABLE_NAME = 'history' THEN
+                payload := json_build_object(
+                    'type', 'movement',
+                    'id', NEW.id,
+                    'item_number', left(NEW.item_number, 100),
+                    'lot', left(NEW.lot, 100),
+                    'change', NEW.change,
+                    'remaining', NEW.remaining,
+                    'unit', left(NEW.unit, 50),
+                    'action_type', left(NEW.action_type, 200),
+                    'username', left(NEW.username, 100),
+                    'timestamp', NEW.timestamp
+                );
+            ELSIF TG_TABLE_NAME = 'dashboard_history' THEN
+                payload := json_build_object(
+                    'type', 'dashboard_history',
+                    'id', NEW.id,
+                    'message', left(NEW.message, 500),
+                    'username', left(NEW.username, 100),
+                    'timestamp', NEW.created_at
+                );
+            ELSIF TG_OP = 'DELETE' THEN
+                payload := json_build_object('type', 'project', 'op', 'delete', 'id', OLD.id);
+            ELSE
+                payload := json_build_object(
+                    'type', 'project',
+                    'op', lower(TG_OP),
+                    'id', NEW.id,
+                    'name', left(NEW.name, 200),
+                    'status', left(COALESCE(NEW.status, 'Pending'), 50),
+                    'bags_bottles', NEW.bags_bottles,
+                    'completed_bags', NEW.completed_bags,
+                    'due_date', NEW.due_date
+                );
+            END IF;
+            PERFORM pg_notify('inventory_events', payload::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    for table, events in (
+        ("history", "INSERT"),
+        ("dashboard_history", "INSERT"),
+        ("projects", "INSERT OR UPDATE OR DELETE"),
+    ):
+        c.execute(f"DROP TRIGGER IF EXISTS {table}_notify ON {table}")
+        c.execute(
+            f"""
+            CREATE TRIGGER {table}_notify
+            AFTER {events} ON {table}
+            FOR EACH ROW EXECUTE FUNCTION notify_inventory_event()
+            """
+        )
+
+    # UNIT REGISTRY: canonical quantities are derived in the database so
+    # every write path stays in sync
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS units (
+            alias TEXT PRIMARY KEY,
+            canonical_unit TEXT NOT NULL,
+            factor NUMERIC NOT NULL,
+            low_stock_threshold NUMERIC
+        )
+    """)
+    c.executemany(
+        """
+        INSERT INTO units (alias, canonical_unit, factor, low_stock_threshold)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (alias) DO NOTHING
+        """,
+        DEFAULT_UNITS,
+    )
+    c.execute("""
+        CREATE OR REPLACE FUNCTION canonical_unit_of(unit TEXT) RETURNS TEXT AS $$
+            SELECT COALESCE(
+                (SELECT canonical_unit FROM units WHERE alias = lower(trim(unit))),
+                lower(trim(unit))
+            )
+        $$ LANGUAGE sql STABLE
+    """)
+    c.execute("""
+        CREATE OR REPLACE FUNCTION canonical_factor_of(unit TEXT) RETURNS NUMERIC AS $$
+            SELECT COALESCE((SELECT factor FROM units WHERE alias = lower(trim(unit))), 1)
+        $$ LANGUAGE sql STABLE
+    """)
+    c.execute("""
+        CREATE OR REPLACE FUNCTION set_canonical_quantity() RETURNS trigger AS $$
+        BEGIN
+            NEW.canonical_unit := canonical_unit_of(NEW.unit);
+            IF TG_TABLE_NAME = 'history' THEN
+                NEW.canonical_change := NEW.change * canonical_factor_of(NEW.unit);
+            ELSE
+                NEW.canonical_quantity := NEW.quantity * canonical_factor_of(NEW.unit);
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    c.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'history' AND column_name = 'canonical_change'
+    """)
+    canonical_columns_exist = c.fetchone() is not None
+    c.execute("ALTER TABLE inventory ADD COLUMN IF NOT EXISTS canonical_quantity NUMERIC")
+    c.execute("ALTER TABLE inventory ADD COLUMN IF NOT EXISTS canonical_unit TEXT")
+    c.execute("ALTER TABLE history ADD COLUMN IF NOT EXISTS canonical_change NUMERIC")
+    c.execute("ALTER TABLE history ADD COLUMN IF NOT EXISTS canonical_unit TEXT")
+    for table, columns in (("inventory", "quantity, unit"), ("history", "change, unit")):
+        c.execute(f"DROP TRIGGER IF EXISTS {table}_canonical ON {table}")
+        c.execute(
+            f"""
+            CREATE TRIGGER {table}_canonical
+            BEFORE INSERT OR UPDATE OF {columns} ON {table}
+            FOR EACH ROW EXECUTE FUNCTION set_canonical_quantity()
+            """
+        )
+    if not canonical_columns_exist:
+        c.execute("""
+            UPDATE inventory
+            SET canonical_quantity = quantity * canonical_factor_of(unit),
+                canonical_unit = canonical_unit_of(unit)
+        """)
+        c.execute("""
+            UPDATE history
+            SET canonical_change = change * canonical_factor_of(unit),
+                canonical_unit = canonical_unit_of(unit)
+        """)
+        # Forecasts were accumulated in raw lot units; rebuild them canonically.
+        c.execute("DELETE FROM item_forecasts")
+        c.execute("DELETE FROM job_state WHERE name = 'forecast'")
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_inventory_canonical
+        ON inventory (item_number, canonical_unit) INCLUDE (canonical_quantity)
+    """)
+
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS item_thresholds (
+            item_number TEXT PRIMARY KEY,
+            threshold NUMERIC NOT NULL,
+            unit TEXT,
+            canonical_threshold NUMERIC NOT NULL,
+            canonical_unit TEXT,
+            updated_by TEXT,
+            updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_project_ingredients_allocated
+        ON project_ingredients (item_number) WHERE stage = 'Allocated'
+    """)
+
+    # RECIPES: ingredient quantity per gummy for each product
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS recipe_lines (
+            product TEXT NOT NULL,
+            item_number TEXT NOT NULL,
+            quantity_per_gummy NUMERIC NOT NULL,
+            unit TEXT,
+            canonical_per_gummy NUMERIC NOT NULL,
+            canonical_unit TEXT,
+            PRIMARY KEY (product, item_number)
+        )
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_projects_active_due
+        ON projects (due_date, created_at) WHERE status IS DISTINCT FROM 'Completed'
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_projects_completed_archive
+        ON projects ((COALESCE(completed_on, '-infinity'::date)), id) WHERE status = 'Completed'
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_projects_completed_customer
+        ON projects (customer_name, (COALESCE(completed_on, '-infinity'::date)), id) WHERE status = 'Completed'
+    """)
+
+    # DAILY ROLLUPS: movements are folded in from a history write_xid watermark,
+    # project completions are kept exact by a trigger on projects
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS daily_movements (
+            day DATE NOT NULL,
+            item_number TEXT NOT NULL,
+            action_type TEXT NOT NULL,
+            username TEXT NOT NULL,
+            canonical_unit TEXT NOT NULL,
+            total_change NUMERIC NOT NULL DEFAULT 0,
+            movement_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, item_number, action_type, username, canonical_unit)
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_daily_movements_item ON daily_movements (item_number, day)")
+
+    # History ids are assigned before commit, so a row can commit after a
+    # higher id has already been folded. Each row records the transaction that
+    # wrote it instead, and incremental jobs advance by snapshot xmin.
+    c.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'history' AND column_name = 'write_xid'
+    """)
+    history_xid_exists = c.fetchone() is not None
+    c.execute("ALTER TABLE history ADD COLUMN IF NOT EXISTS write_xid xid8 NOT NULL DEFAULT pg_current_xact_id()")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_history_write_xid ON history (write_xid)")
+    c.execute("ALTER TABLE job_state ADD COLUMN IF NOT EXISTS folded_before xid8 NOT NULL DEFAULT '0'")
+    c.execute("ALTER TABLE job_state DROP COLUMN IF EXISTS last_history_id")
+    if not history_xid_exists:
+        # Id watermarks may have skipped late commits; fold everything again.
+        c.execute("DELETE FROM daily_movements")
+        c.execute("DELETE FROM item_forecasts")
+        c.execute("DELETE FROM job_state WHERE name IN ('forecast', 'rollup_movements')")
+    c.execute("SELECT to_regclass('daily_completions') IS NOT NULL")
+    completions_exist = c.fetchone()[0]
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS daily_completions (
+            day DATE NOT NULL,
+            customer_name TEXT NOT NULL,
+            projects_completed INTEGER NOT NULL DEFAULT 0,
+            bags_completed BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, customer_name)
+        )
+    """)
+    c.execute("""
+        CREATE OR REPLACE FUNCTION rollup_project_completion() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.status = 'Completed' THEN
+                UPDATE daily_completions
+                SET projects_completed = projects_completed - 1,
+                    bags_completed = bags_completed - COALESCE(OLD.completed_bags, 0)
+                WHERE day = COALESCE(OLD.completed_on, (OLD.created_at AT TIME ZONE 'America/Los_Angeles')::date)
+                  AND customer_name = COALESCE(OLD.customer_name, '');
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'Completed' THEN
+                INSERT INTO daily_completions (day, customer_name, projects_completed, bags_completed)
+                VALUES (
+                    COALESCE(NEW.completed_on, (NEW.created_at AT TIME ZONE 'America/Los_Angeles')::date),
+                    COALESCE(NEW.customer_name, ''),
+                    1,
+                    COALESCE(NEW.completed_bags, 0)
+                )
+                ON CONFLICT (day, customer_name) DO UPDATE SET
+                    projects_completed = daily_completions.projects_completed + 1,
+                    bags_completed = daily_completions.bags_completed + excluded.bags_completed;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    c.execute("DROP TRIGGER IF EXISTS projects_rollup ON projects")
+    c.execute("""
+        CREATE TRIGGER projects_rollup
+        AFTER INSERT OR UPDATE OR DELETE ON projects
+        FOR EACH ROW EXECUTE FUNCTION rollup_project_completion()
+    """)
+    if not completions_exist:
+        c.execute(DAILY_COMPLETIONS_BACKFILL)
+
+    # ITEM MASTER: one row per item number, referenced by lots, history and ingredients
+    c.execute("SELECT to_regclass('items') IS NOT NULL")
+    items_exist = c.fetchone()[0]
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS items (
+            item_number TEXT PRIMARY KEY,
+            name TEXT,
+            unit TEXT,
+            supplier TEXT,
+            created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    if not items_exist:
+        c.execute("""
+            INSERT INTO items (item_number, name, unit, supplier)
+            SELECT DISTINCT ON (item_number) item_number, name, unit, supplier
+            FROM inventory
+            ORDER BY item_number, (name IS NULL OR name = ''), lot
+        """)
+        for table in ("history", "project_ingredients"):
+            c.execute(sql.SQL("""
+                INSERT INTO items (item_number)
+                SELECT DISTINCT item_number FROM {} WHERE item_number IS NOT NULL
+                ON CONFLICT (item_number) DO NOTHING
+            """).format(sql.Identifier(table)))
+    for table in ("inventory", "history", "project_ingredients"):
+        c.execute(sql.SQL("""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = {constraint}) THEN
+                    ALTER TABLE {table} ADD CONSTRAINT {constraint_ident}
+                        FOREIGN KEY (item_number) REFERENCES items (item_number) ON UPDATE CASCADE;
+                END IF;
+            END
+            $$;
+        """).format(
+            table=sql.Identifier(table),
+            constraint=sql.Literal(f"{table}_item_number_fkey"),
+            constraint_ident=sql.Identifier(f"{table}_item_number_fkey"),
+        ))
+    c.execute("CREATE INDEX IF NOT EXISTS idx_history_item ON history (item_number, id)")
+
+    # DELTA SYNC: every lot write stamps the writing transaction id; deletions
+    # leave tombstones until pruned past the sync horizon
+    c.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'inventory' AND column_name = 'sync_xid'
+    """)
+    sync_column_exists = c.fetchone() is not None
+    c.execute("ALTER TABLE inventory ADD COLUMN IF NOT EXISTS sync_xid xid8")
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS sync_tombstones (
+            item_number TEXT NOT NULL,
+            lot TEXT NOT NULL,
+            sync_xid xid8 NOT NULL,
+            deleted_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (item_number, lot)
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS sync_horizon (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            pruned_through xid8 NOT NULL
+        )
+    """)
+    c.execute("""
+        CREATE OR REPLACE FUNCTION stamp_inventory_sync() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                INSERT INTO sync_tombstones (item_number, lot, sync_xid)
+                VALUES (OLD.item_number, OLD.lot, pg_current_xact_id())
+                ON CONFLICT (item_number, lot) DO UPDATE
+                SET sync_xid = EXCLUDED.sync_xid, deleted_at = CURRENT_TIMESTAMP;
+                RETURN OLD;
+            END IF;
+            NEW.sync_xid := pg_current_xact_id();
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    c.execute("DROP TRIGGER IF EXISTS inventory_sync ON inventory")
+    c.execute("""
+        CREATE TRIGGER inventory_sync
+        BEFORE INSERT OR UPDATE OR DELETE ON inventory
+        FOR EACH ROW EXECUTE FUNCTION stamp_inventory_sync()
+    """)
+    if not sync_column_exists:
+        c.execute("UPDATE inventory SET sync_xid = pg_current_xact_id()")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_inventory_sync ON inventory (sync_xid)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sync_tombstones_xid ON sync_tombstones (sync_xid)")
+
+    # STOCKTAKES: frozen expected quantities plus counted quantities per lot
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS stocktakes (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'Open',
+            snapshot_history_id INTEGER,
+            created_by TEXT,
+            created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+            reconciled_by TEXT,
+            reconciled_at TIMESTAMPTZ
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS stocktake_lines (
+            stocktake_id INTEGER NOT NULL REFERENCES stocktakes(id) ON DELETE CASCADE,
+            item_number TEXT NOT NULL,
+            lot TEXT NOT NULL,
+            name TEXT,
+            unit TEXT,
+            expected NUMERIC NOT NULL,
+            counted NUMERIC,
+            moved_since NUMERIC,
+            final_quantity NUMERIC,
+            PRIMARY KEY (stocktake_id, item_number, lot)
+        )
+    """)
+
+    # LOT TRACE: which lots went into which projects, kept in step with
+    # project_ingredients by trigger. Keyed by lot for recalls and indexed
+    # by project for the reverse lookup. A lot that was used stays traced
+    # after its ingredient rows or project are deleted.
+    c.execute("SELECT to_regclass('lot_trace') IS NOT NULL")
+    trace_exists = c.fetchone()[0]
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS lot_trace (
+            lot TEXT NOT NULL,
+            item_number TEXT NOT NULL,
+            project_id INTEGER NOT NULL,
+            project_name TEXT,
+            customer_name TEXT,
+            supplier TEXT,
+            allocated_quantity NUMERIC NOT NULL DEFAULT 0,
+            used_quantity NUMERIC NOT NULL DEFAULT 0,
+            unit TEXT,
+            first_linked_at TIMESTAMPTZ,
+            last_used_at TIMESTAMPTZ,
+            PRIMARY KEY (lot, item_number, project_id)
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_lot_trace_project ON lot_trace (project_id)")
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_project_ingredients_trace
+        ON project_ingredients (project_id, item_number, lot)
+    """)
+    c.execute("""
+        CREATE OR REPLACE FUNCTION refresh_lot_trace(
+            p_item TEXT, p_lot TEXT, p_project INTEGER, p_deleting BOOLEAN
+        ) RETURNS void AS $$
+        DECLARE
+            allocated NUMERIC;
+            used NUMERIC;
+            unit_name TEXT;
+            linked_at TIMESTAMPTZ;
+            used_at TIMESTAMPTZ;
+        BEGIN
+            -- Ingredients may be entered in different units; trace in canonical ones.
+            SELECT COALESCE(SUM(quantity * canonical_factor_of(unit)) FILTER (WHERE stage = 'Allocated'), 0),
+                   COALESCE(SUM(quantity * canonical_factor_of(unit)) FILTER (WHERE stage = 'Used'), 0),
+                   canonical_unit_of(MAX(unit) FILTER (WHERE stage IN ('Allocated', 'Used'))),
+                   MIN(created_at) FILTER (WHERE stage IN ('Allocated', 'Used')),
+                   MAX(COALESCE(finalized_at, updated_at)) FILTER (WHERE stage = 'Used')
+            INTO allocated, used, unit_name, linked_at, used_at
+            FROM project_ingredients
+            WHERE project_id = p_project AND item_number = p_item AND lot = p_lot;
+
+            IF allocated = 0 AND used = 0 THEN
+                -- Deleting rows never erases a use; editing them away does.
+                DELETE FROM lot_trace
+                WHERE lot = p_lot AND item_number = p_item AND project_id = p_project
+                  AND (NOT p_deleting OR used_quantity = 0);
+                UPDATE lot_trace SET allocated_quantity = 0
+                WHERE lot = p_lot AND item_number = p_item AND project_id = p_project;
+                RETURN;
+            END IF;
+
+            INSERT INTO lot_trace (
+                lot, item_number, project_id, project_name, customer_name, supplier,
+                allocated_quantity, used_quantity, unit, first_linked_at, last_used_at
+            )
+            SELECT p_lot, p_item, p_project, p.name, p.customer_name,
+                   COALESCE(
+                       (SELECT supplier FROM inventory WHERE item_number = p_item AND lot = p_lot),
+                       (SELECT supplier FROM items WHERE item_number = p_item)
+                   ),
+                   allocated, used, unit_name, linked_at, used_at
+            FROM (SELECT 1) one
+            LEFT JOIN projects p ON p.id = p_project
+            ON CONFLICT (lot, item_number, project_id) DO UPDATE SET
+                project_name = COALESCE(excluded.project_name, lot_trace.project_name),
+                customer_name = COALESCE(excluded.customer_name, lot_trace.customer_name),
+                supplier = COALESCE(lot_trace.supplier, excluded.supplier),
+                allocated_quantity = excluded.allocated_quantity,
+                used_quantity = CASE
+                    WHEN p_deleting THEN GREATEST(lot_trace.used_quantity, excluded.used_quantity)
+                    ELSE excluded.used_quantity
+                END,
+                unit = COALESCE(excluded.unit, lot_trace.unit),
+                first_linked_at = LEAST(lot_trace.first_linked_at, excluded.first_linked_at),
+                last_used_at = GREATEST(lot_trace.last_used_at, excluded.last_used_at);
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    c.execute("""
+        CREATE OR REPLACE FUNCTION trace_project_ingredient() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') AND NULLIF(OLD.lot, '') IS NOT NULL AND OLD.project_id IS NOT NULL THEN
+                PERFORM refresh_lot_trace(OLD.item_number, OLD.lot, OLD.project_id, TG_OP = 'DELETE');
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') AND NULLIF(NEW.lot, '') IS NOT NULL AND NEW.project_id IS NOT NULL
+               AND (TG_OP = 'INSERT'
+                    OR (NEW.item_number, NEW.lot, NEW.project_id) IS DISTINCT FROM (OLD.item_number, OLD.lot, OLD.project_id)) THEN
+                PERFORM refresh_lot_trace(NEW.item_number, NEW.lot, NEW.project_id, false);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    c.execute("DROP TRIGGER IF EXISTS project_ingredients_trace ON project_ingredients")
+    c.execute("""
+        CREATE TRIGGER project_ingredients_trace
+        AFTER INSERT OR UPDATE OR DELETE ON project_ingredients
+        FOR EACH ROW EXECUTE FUNCTION trace_project_ingredient()
+    """)
+    if not trace_exists:
+        c.execute("""
+            SELECT refresh_lot_trace(item_number, lot, project_id, false)
+            FROM (
+                SELECT DISTINCT item_number, lot, project_id
+                FROM project_ingredients
+                WHERE NULLIF(lot, '') IS NOT NULL AND project_id IS NOT NULL
+            ) links
+        """)
+
+    # JOBS: background work claimed by `flask worker` processes
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id BIGSERIAL PRIMARY KEY,
+            job_type TEXT NOT NULL,
+            params JSONB NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress_done BIGINT NOT NULL DEFAULT 0,
+            progress_total BIGINT,
+            message TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            run_after TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            worker TEXT,
+            heartbeat_at TIMESTAMPTZ,
+            result_path TEXT,
+            error TEXT,
+            created_by TEXT,
+            created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMPTZ,
+            finished_at TIMESTAMPTZ
+        )
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_jobs_queued
+        ON jobs (job_type, run_after, id) WHERE status = 'queued'
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_jobs_running
+        ON jobs (job_type, heartbeat_at) WHERE status = 'running'
+    """)
+    # A handler whose writes must not repeat records its job here in the same
+    # transaction, so a retry after a crash between that commit and the job's
+    # completion finds the row and skips the work.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS job_applied (
+            job_id BIGINT PRIMARY KEY REFERENCES jobs(id) ON DELETE CASCADE,
+            applied_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
     conn.commit()
     conn.close()
 
-init_db()
+# The in-memory backend runs without a database at all.
+if REPOSITORY_BACKEND == "postgres":
+    init_db()
 
 def login_required(route_function):
     def wrapper(*args, **kwargs):
@@ -358,109 +1244,3023 @@ def login_required(route_function):
     wrapper.__name__ = route_function.__name__
     return wrapper
 
+@app.after_request
+def pin_reads_after_write(response):
+    if REPLICA_DATABASE_URL and request.method not in ("GET", "HEAD", "OPTIONS"):
+        session["primary_until"] = time.time() + REPLICA_STICKY_SECONDS
+    return response
 
-# -------------------------
-# ROUTES
-# -------------------------
-
-@app.route("/")
-def index():
-    if "user" not in session:
-        return redirect("/login")
-    return redirect("/dashboard")
+def _database_activity(conn):
+    """Return (transactions, ms spent executing statements) for the connected database."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT xact_commit + xact_rollback, COALESCE(active_time, 0)
+            FROM pg_stat_database
+            WHERE datname = current_database()
+            """
+        )
+        row = cursor.fetchone()
+    conn.close()
+    return int(row[0]), float(row[1])
 
-@app.route("/dashboard", methods=["GET", "POST"])
-@login_required
-def dashboard():
-    conn = connect_db()
+@app.cli.command("bench-prepared")
+@click.option("--iterations", default=5000, help="Calls per statement and mode.")
+def bench_prepared_command(iterations):
+    """Compare per-call latency of plain and prepared hot lookups."""
+    conn = _connect_primary()
     c = conn.cursor()
+    c.execute("SELECT item_number, lot FROM inventory ORDER BY item_number, lot LIMIT 1")
+    row = c.fetchone()
+    if not row:
+        raise click.ClickException("Add at least one inventory lot before benchmarking.")
+    item_number, lot = row
+
+    for name, (_, statement) in HOT_STATEMENTS.items():
+        params = (item_number, lot) if "$2" in statement else (item_number,)
+        plain_sql = re.sub(r"\$\d+", "%s", statement)
+
+        started = time.perf_counter()
+        for _ in range(iterations):
+            c.execute(plain_sql, params)
+            c.fetchall()
+        plain = (time.perf_counter() - started) / iterations
+
+        execute_prepared(c, name, params)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            execute_prepared(c, name, params)
+            c.fetchall()
+        prepared = (time.perf_counter() - started) / iterations
+
+        click.echo(
+            f"{name}: plain {plain * 1e6:.1f} us, prepared {prepared * 1e6:.1f} us, "
+            f"saved {(plain - prepared) * 1e6:.1f} us/call"
+        )
+    conn.close()
 
-    if request.method == "POST":
-        action = request.form.get("action")
+@app.cli.command("bench-reads")
+@click.option("--requests", "request_count", default=200, help="Requests per read view.")
+def bench_reads_command(request_count):
+    """Replay the read-heavy views with and without replica routing.
 
-        if action == "create":
-            name = request.form["name"].strip()
-            customer_name = request.form.get("customer_name", "").strip() or None
-            notes = request.form.get("description", "").strip()
-            due_date_str = request.form.get("due_date", "").strip()
-            bags_bottles = to_int_or_none(request.form.get("bags_bottles"))
-            gummies = to_int_or_none(request.form.get("gummies"))
-            quantity_unit = request.form.get("quantity_unit", "Bags")
-            storage_status = request.form.get("storage_status", "PPS")
-            completed_bags = to_int_or_none(request.form.get("completed_bags"))
+    Primary load is reported from pg_stat_database as transactions and
+    active statement time, which tracks backend CPU on the primary. Each
+    pass starts with a cold render cache, whose fills always read the primary.
+    """
+    global REPLICA_DATABASE_URL
+    replica_url = REPLICA_DATABASE_URL
+    if not replica_url:
+        raise click.ClickException("Set REPLICA_DATABASE_URL to benchmark replica routing.")
+
+    paths = ("/dashboard", "/current", "/history", "/dashboard/history", "/projects/completed")
+    client = app.test_client()
+    with client.session_transaction() as bench_session:
+        bench_session["user"] = "bench@localhost"
+
+    def replay():
+        for _ in range(request_count):
+            for path in paths:
+                # Read the body: streamed views query as they are sent.
+                client.get(path).get_data()
+
+    for label, routed_url in (("primary only", None), ("with replica", replica_url)):
+        REPLICA_DATABASE_URL = routed_url
+        for scope in ("inventory", "projects"):
+            render_cache.bump(scope)
+        before = _database_activity(_connect_primary())
+        started = time.perf_counter()
+        # Requests made under the CLI's app context would all share its g, so
+        # one cache fill would pin every later read to the primary. A new
+        # thread has no app context, so each request gets its own, as under a server.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(replay).result()
+        elapsed = time.perf_counter() - started
+        time.sleep(1)  # let backends flush their statistics
+        after = _database_activity(_connect_primary())
+        click.echo(
+            f"{label}: {request_count * len(paths)} requests in {elapsed:.2f}s, "
+            f"primary {after[0] - before[0]} transactions, "
+            f"{after[1] - before[1]:.0f} ms active"
+        )
+    REPLICA_DATABASE_URL = replica_url
 
-            if not name:
-                conn.close()
-                return "Project name is required."
+def _unsafe_remove_from_lot(cursor, item_number, lot, quantity, username):
+    """The old read-compute-write removal, kept for the stress harness to compare against."""
+    cursor.execute(
+        "SELECT quantity, unit FROM inventory WHERE item_number = %s AND lot = %s",
+        (item_number, lot),
+    )
+    current, unit = cursor.fetchone()
+    current = float(current or 0)
+    if quantity > current:
+        return None
+    cursor.execute(
+        "UPDATE inventory SET quantity = %s WHERE item_number = %s AND lot = %s",
+        (current - quantity, item_number, lot),
+    )
+    cursor.execute(
+        """
+        INSERT INTO history (item_number, lot, change, remaining, unit, action_type, username)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """,
+        (item_number, lot, -quantity, current - quantity, unit, "REMOVE", username),
+    )
+    return (current - quantity, unit)
+
+@app.cli.command("stress-removals")
+@click.option("--workers", default=16, help="Concurrent clerks.")
+@click.option("--removals", default=200, help="Removals attempted per worker.")
+@click.option("--lots", default=2, help="Hot lots the workers pull from.")
+@click.option("--unsafe", is_flag=True, help="Use the old read-compute-write removal.")
+@click.option("--keep", is_flag=True, help="Keep the stress item instead of deleting it.")
+def stress_removals_command(workers, removals, lots, unsafe, keep):
+    """Fire concurrent removals at a few hot lots and check nothing was lost.
+
+    Stock starts below total demand so some removals must be refused. After
+    the run each lot's quantity has to equal its starting quantity plus the
+    summed history, never go negative, and every history row's remaining has
+    to match the running total in commit order.
+    """
+    item_number = f"STRESS-{os.getpid()}"
+    lot_names = [f"HOT{n}" for n in range(1, lots + 1)]
+    starting_quantity = workers * removals * 0.8 / lots
+    remove = _unsafe_remove_from_lot if unsafe else remove_from_lot
 
-            due_date = None
-            if due_date_str:
-                try:
-                    due_date = datetime.strptime(due_date_str, "%Y-%m-%d").date()
-                except ValueError:
-                    conn.close()
-                    return "Invalid due date format."
+    conn = _connect_primary()
+    c = conn.cursor()
+    c.execute("INSERT INTO items (item_number, name, unit) VALUES (%s, 'Stress test', 'kg')", (item_number,))
+    execute_values(
+        c,
+        "INSERT INTO inventory (item_number, name, lot, quantity, unit) VALUES %s",
+        [(item_number, "Stress test", lot, starting_quantity, "kg") for lot in lot_names],
+    )
+    conn.commit()
 
-            c.execute(
-                """
-                INSERT INTO projects (name, customer_name, description, due_date, bags_bottles, gummies, storage_status, quantity_unit, completed_bags)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (name, customer_name, notes, due_date, bags_bottles, gummies, storage_status, quantity_unit, completed_bags),
-            )
-            log_dashboard_event(
-                c,
-                f"Created project '{name}' targeting {bags_bottles or 0} {quantity_unit}, due {due_date or 'unspecified'}",
-                session.get("user"),
-            )
-            conn.commit()
-            conn.close()
-            return redirect("/dashboard")
+    results = {"removed": 0, "refused": 0, "errors": 0}
+    results_lock = threading.Lock()
 
-        if action == "update_status":
-            project_id = request.form.get("project_id")
-            status = request.form.get("status", "Pending")
-            completion_date_str = request.form.get("completion_date", "").strip()
+    def clerk(worker_number):
+        worker_conn = _connect_primary()
+        worker_cursor = worker_conn.cursor()
+        removed = refused = errors = 0
+        for attempt in range(removals):
+            lot = lot_names[(worker_number + attempt) % lots]
+            try:
+                if remove(worker_cursor, item_number, lot, 1, "stress@localhost"):
+                    removed += 1
+                else:
+                    refused += 1
+                worker_conn.commit()
+            except psycopg2.Error:
+                worker_conn.rollback()
+                errors += 1
+        worker_conn.close()
+        with results_lock:
+            results["removed"] += removed
+            results["refused"] += refused
+            results["errors"] += errors
+
+    threads = [threading.Thread(target=clerk, args=(n,)) for n in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    failures = []
+    for lot in lot_names:
+        c.execute(
+            "SELECT quantity FROM inventory WHERE item_number = %s AND lot = %s",
+            (item_number, lot),
+        )
+        final_quantity = float(c.fetchone()[0])
+        c.execute(
+            "SELECT change, remaining FROM history WHERE item_number = %s AND lot = %s ORDER BY id",
+            (item_number, lot),
+        )
+        running = starting_quantity
+        drifted = 0
+        for change, remaining in c.fetchall():
+            running += float(change)
+            if abs(running - float(remaining)) > 1e-6:
+                drifted += 1
+        if abs(running - final_quantity) > 1e-6:
+            failures.append(f"{lot}: quantity {final_quantity} but history sums to {running}")
+        if final_quantity < 0:
+            failures.append(f"{lot}: overdrawn to {final_quantity}")
+        if drifted:
+            failures.append(f"{lot}: {drifted} history row(s) disagree with the running total")
+
+    if not keep:
+        c.execute("DELETE FROM history WHERE item_number = %s", (item_number,))
+        c.execute("DELETE FROM inventory WHERE item_number = %s", (item_number,))
+        c.execute("DELETE FROM items WHERE item_number = %s", (item_number,))
+        conn.commit()
+    conn.close()
+
+    attempts = workers * removals
+    click.echo(
+        f"{'unsafe' if unsafe else 'atomic'}: {attempts} removals over {lots} lot(s) by {workers} workers "
+        f"in {elapsed:.2f}s ({attempts / elapsed:.0f}/s); removed {results['removed']}, "
+        f"refused {results['refused']}, errors {results['errors']}"
+    )
+    if failures:
+        raise click.ClickException("; ".join(failures))
+    click.echo("consistent: final quantities match the summed history")
+
+
+def _resident_bytes():
+    """Current resident set size of this process, or None off Linux."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+def _render_buffered(cursor, path):
+    """Render /current or /history the pre-streaming way: fetch every row, then one body."""
+    with app.test_request_context(path):
+        session["user"] = "bench@localhost"
+        if path == "/current":
+            cursor.execute(
+                "SELECT item_number, name, quantity, unit, lot, supplier, exp FROM inventory ORDER BY item_number ASC, lot"
+            )
+            return render_template(
+                "current_inventory.html",
+                items=cursor.fetchall(),
+                sort_column="item_number",
+                sort_direction="asc",
+                search_term="",
+            )
+        cursor.execute(HISTORY_SELECT + " ORDER BY h.timestamp DESC")
+        logs = [_format_history_row(row) for row in cursor.fetchall()]
+        cursor.execute("SELECT item_number, name FROM items ORDER BY item_number")
+        return render_template(
+            "history.html",
+            logs=logs,
+            search_results=None,
+            search_term=None,
+            inventory_items=cursor.fetchall(),
+        )
+
+@app.cli.command("bench-streaming")
+@click.option("--rows", default=100000, help="Lots and history rows to render.")
+def bench_streaming_command(rows):
+    """Measure time to first byte and peak RSS of /current and /history.
+
+    Each page is read once as a stream through the app, and once rendered
+    the way it was before streaming: all rows fetched, then the template
+    rendered into one body that is sent only when complete.
+    """
+    item_number = f"BENCH-{os.getpid()}"
+    conn = _connect_primary()
+    c = conn.cursor()
+    c.execute("INSERT INTO items (item_number, name, unit) VALUES (%s, 'Streaming benchmark', 'kg')", (item_number,))
+    c.execute(
+        """
+        INSERT INTO inventory (item_number, name, lot, quantity, unit, supplier)
+        SELECT %s, 'Streaming benchmark', 'LOT' || n, n, 'kg', 'Bench'
+        FROM generate_series(1, %s) n
+        """,
+        (item_number, rows),
+    )
+    c.execute(
+        """
+        INSERT INTO history (item_number, lot, change, remaining, unit, action_type, username)
+        SELECT %s, 'LOT' || n, n, n, 'kg', 'ADD', 'bench@localhost'
+        FROM generate_series(1, %s) n
+        """,
+        (item_number, rows),
+    )
+    conn.commit()
+
+    client = app.test_client()
+    with client.session_transaction() as bench_session:
+        bench_session["user"] = "bench@localhost"
+
+    try:
+        for path in ("/current", "/history"):
+            for mode in ("streamed", "buffered"):
+                baseline = _resident_bytes()
+                peak = [baseline or 0]
+                done = threading.Event()
+
+                def sample():
+                    while not done.wait(0.005):
+                        peak[0] = max(peak[0], _resident_bytes() or 0)
+
+                sampler = threading.Thread(target=sample, daemon=True)
+                sampler.start()
+                started = time.perf_counter()
+                if mode == "streamed":
+                    # A fresh query string keeps the render cache out of the measurement.
+                    response = client.get(f"{path}?bench={time.time_ns()}", buffered=False)
+                    chunks = iter(response.response)
+                    first = next(chunks)
+                    first_byte = time.perf_counter() - started
+                    size = len(first) + sum(len(chunk) for chunk in chunks)
+                    response.close()
+                else:
+                    body = _render_buffered(c, path).encode()
+                    conn.rollback()
+                    first_byte = time.perf_counter() - started
+                    size = len(body)
+                    del body
+                elapsed = time.perf_counter() - started
+                done.set()
+                sampler.join()
+
+                rss = f"{(peak[0] - baseline) / 1e6:.1f} MB" if baseline else "n/a"
+                click.echo(
+                    f"{path} {mode}: first byte {first_byte * 1000:.0f} ms, "
+                    f"complete {elapsed * 1000:.0f} ms, {size / 1e6:.1f} MB sent, peak RSS +{rss}"
+                )
+    finally:
+        c.execute("DELETE FROM history WHERE item_number = %s", (item_number,))
+        c.execute("DELETE FROM inventory WHERE item_number = %s", (item_number,))
+        c.execute("DELETE FROM items WHERE item_number = %s", (item_number,))
+        conn.commit()
+        conn.close()
+
+# -------------------------
+# BACKUP AND RESTORE
+# -------------------------
+class _HashingWriter:
+    """File wrapper that hashes and counts the compressed bytes written through it."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.raw.write(data)
+
+    def flush(self):
+        self.raw.flush()
+
+def _copy_columns(cursor, table):
+    """Stored (non-generated) columns of a table in definition order.
+
+    Transaction ids (xid8) mean nothing once restored, so they are skipped and
+    the restored rows take their column default, or NULL.
+    """
+    cursor.execute(
+        """
+        SELECT attname FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = ''
+          AND atttypid <> 'xid8'::regtype
+        ORDER BY attnum
+        """,
+        (table,),
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+def _backup_table(directory, table, snapshot_id):
+    conn = _connect_primary()
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    c = conn.cursor()
+    # Every worker reads the coordinator's exported snapshot, so the files are
+    # mutually consistent even though they are written in parallel.
+    c.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+    columns = _copy_columns(c, table)
+    column_list = sql.SQL(", ").join(map(sql.Identifier, columns))
+    filename = f"{table}.copy.gz"
+    with open(os.path.join(directory, filename), "wb") as raw:
+        hashed = _HashingWriter(raw)
+        with gzip.GzipFile(fileobj=hashed, mode="wb", compresslevel=BACKUP_COMPRESSION_LEVEL) as compressed:
+            c.copy_expert(
+                sql.SQL("COPY {} ({}) TO STDOUT (FORMAT binary)").format(sql.Identifier(table), column_list).as_string(c),
+                compressed,
+            )
+            rows = c.rowcount
+    conn.close()
+    return {
+        "table": table,
+        "file": filename,
+        "columns": columns,
+        "rows": rows,
+        "bytes": hashed.size,
+        "sha256": hashed.sha256.hexdigest(),
+    }
+
+def backup_tables(directory, tables=BACKUP_TABLES, workers=BACKUP_WORKERS):
+    """Dump tables with parallel binary COPY streams into gzip files plus a manifest."""
+    os.makedirs(directory, exist_ok=True)
+    coordinator = _connect_primary()
+    coordinator.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    c = coordinator.cursor()
+    c.execute("SELECT pg_export_snapshot(), CURRENT_TIMESTAMP")
+    snapshot_id, taken_at = c.fetchone()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            entries = list(pool.map(lambda table: _backup_table(directory, table, snapshot_id), tables))
+    finally:
+        # The snapshot only stays importable while the exporting transaction is open.
+        coordinator.close()
+
+    manifest = {"taken_at": taken_at.isoformat(), "tables": entries}
+    with open(os.path.join(directory, "manifest.json"), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
+
+def _verify_backup_file(directory, entry):
+    digest = hashlib.sha256()
+    with open(os.path.join(directory, entry["file"]), "rb") as raw:
+        for block in iter(lambda: raw.read(1024 * 1024), b""):
+            digest.update(block)
+    if digest.hexdigest() != entry["sha256"]:
+        raise click.ClickException(f"Checksum mismatch for {entry['file']}; refusing to restore.")
+
+def _load_shadow_table(directory, entry):
+    """COPY one backup into <table>__restore, then build its indexes."""
+    table = entry["table"]
+    shadow = f"{table}__restore"
+    conn = _connect_primary()
+    c = conn.cursor()
+    c.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(shadow)))
+    c.execute(
+        sql.SQL(
+            "CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING CONSTRAINTS INCLUDING STORAGE)"
+        ).format(sql.Identifier(shadow), sql.Identifier(table))
+    )
+    column_list = sql.SQL(", ").join(map(sql.Identifier, entry["columns"]))
+    with gzip.open(os.path.join(directory, entry["file"]), "rb") as compressed:
+        c.copy_expert(
+            sql.SQL("COPY {} ({}) FROM STDIN (FORMAT binary)").format(sql.Identifier(shadow), column_list).as_string(c),
+            compressed,
+        )
+    if c.rowcount not in (-1, entry["rows"]):
+        conn.close()
+        raise click.ClickException(f"{table}: loaded {c.rowcount} rows, backup has {entry['rows']}.")
+
+    # Indexes are built once over the loaded rows instead of row by row.
+    c.execute(
+        """
+        SELECT i.relname, pg_get_indexdef(x.indexrelid), con.conname, con.contype
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        LEFT JOIN pg_constraint con ON con.conindid = x.indexrelid AND con.contype IN ('p', 'u')
+        WHERE x.indrelid = %s::regclass
+        """,
+        (table,),
+    )
+    renames = []
+    for index_name, definition, constraint_name, constraint_type in c.fetchall():
+        shadow_index = f"{index_name}__restore"
+        definition = re.sub(
+            r"^(CREATE (?:UNIQUE )?INDEX )\S+( ON (?:ONLY )?)\S+",
+            lambda match: f'{match.group(1)}"{shadow_index}"{match.group(2)}"{shadow}"',
+            definition,
+        )
+        c.execute(definition)
+        if constraint_name:
+            kind = "PRIMARY KEY" if constraint_type == "p" else "UNIQUE"
+            c.execute(
+                sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} " + kind + " USING INDEX {}").format(
+                    sql.Identifier(shadow),
+                    sql.Identifier(f"{constraint_name}__restore"),
+                    sql.Identifier(shadow_index),
+                )
+            )
+            renames.append(("constraint", f"{constraint_name}__restore", constraint_name))
+        else:
+            renames.append(("index", shadow_index, index_name))
+    conn.commit()
+    conn.close()
+    return {"table": table, "rows": entry["rows"], "renames": renames}
+
+def restore_tables(directory, workers=BACKUP_WORKERS):
+    """Load a backup into shadow tables in parallel, then swap them in atomically."""
+    with open(os.path.join(directory, "manifest.json")) as manifest_file:
+        manifest = json.load(manifest_file)
+    entries = manifest["tables"]
+    for entry in entries:
+        _verify_backup_file(directory, entry)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        loaded = list(pool.map(lambda entry: _load_shadow_table(directory, entry), entries))
+
+    tables = [entry["table"] for entry in entries]
+    conn = _connect_primary()
+    c = conn.cursor()
+    c.execute(
+        sql.SQL("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE").format(
+            sql.SQL(", ").join(map(sql.Identifier, tables))
+        )
+    )
+    # Capture what DROP ... CASCADE removes so it can be recreated on the swapped tables.
+    c.execute(
+        """
+        SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE contype = 'f'
+          AND (conrelid = ANY(%(tables)s::regclass[]) OR confrelid = ANY(%(tables)s::regclass[]))
+        """,
+        {"tables": tables},
+    )
+    foreign_keys = c.fetchall()
+    c.execute(
+        "SELECT pg_get_triggerdef(oid) FROM pg_trigger WHERE tgrelid = ANY(%s::regclass[]) AND NOT tgisinternal",
+        (tables,),
+    )
+    triggers = [row[0] for row in c.fetchall()]
+    c.execute(
+        """
+        SELECT c.relname, a.attname, pg_get_serial_sequence(quote_ident(c.relname), a.attname)
+        FROM pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        WHERE a.attrelid = ANY(%s::regclass[]) AND a.attnum > 0 AND NOT a.attisdropped
+          AND pg_get_serial_sequence(quote_ident(c.relname), a.attname) IS NOT NULL
+        """,
+        (tables,),
+    )
+    sequences = c.fetchall()
+
+    for _, _, sequence in sequences:
+        c.execute(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+    for table in tables:
+        c.execute(sql.SQL("DROP TABLE {} CASCADE").format(sql.Identifier(table)))
+    for result in loaded:
+        table = result["table"]
+        c.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(sql.Identifier(f"{table}__restore"), sql.Identifier(table)))
+        for kind, shadow_name, name in result["renames"]:
+            if kind == "constraint":
+                c.execute(
+                    sql.SQL("ALTER TABLE {} RENAME CONSTRAINT {} TO {}").format(
+                        sql.Identifier(table), sql.Identifier(shadow_name), sql.Identifier(name)
+                    )
+                )
+            else:
+                c.execute(sql.SQL("ALTER INDEX {} RENAME TO {}").format(sql.Identifier(shadow_name), sql.Identifier(name)))
+    for table, column, sequence in sequences:
+        c.execute(f"ALTER SEQUENCE {sequence} OWNED BY {sql.Identifier(table).as_string(c)}.{sql.Identifier(column).as_string(c)}")
+        c.execute(
+            sql.SQL("SELECT setval(%s, COALESCE((SELECT MAX({}) FROM {}), 0) + 1, false)").format(
+                sql.Identifier(column), sql.Identifier(table)
+            ),
+            (sequence,),
+        )
+    for table, name, definition in foreign_keys:
+        c.execute(f"ALTER TABLE {table} ADD CONSTRAINT {sql.Identifier(name).as_string(c)} {definition}")
+    for definition in triggers:
+        c.execute(definition)
+
+    # Derived state was built from the replaced rows: rebuild or reset it.
+    c.execute("DELETE FROM daily_completions")
+    c.execute(DAILY_COMPLETIONS_BACKFILL)
+    c.execute("DELETE FROM daily_movements")
+    c.execute("DELETE FROM item_forecasts")
+    c.execute("DELETE FROM job_state WHERE name IN ('forecast', 'rollup_movements')")
+    c.execute("DELETE FROM sync_tombstones")
+    c.execute(
+        """
+        INSERT INTO sync_horizon (pruned_through) VALUES (pg_current_xact_id())
+        ON CONFLICT (id) DO UPDATE SET pruned_through = EXCLUDED.pruned_through
+        """
+    )
+    conn.commit()
+
+    for table in tables:
+        c.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+    conn.commit()
+    conn.close()
+    for scope in ("inventory", "projects"):
+        mark_data_changed(scope)
+    return manifest
+
+@app.cli.command("backup")
+@click.argument("directory")
+@click.option("--workers", default=BACKUP_WORKERS, help="Parallel COPY streams.")
+def backup_command(directory, workers):
+    """Snapshot inventory, history and projects into DIRECTORY."""
+    started = time.perf_counter()
+    manifest = backup_tables(directory, workers=workers)
+    elapsed = time.perf_counter() - started
+    for entry in manifest["tables"]:
+        click.echo(f"{entry['table']}: {entry['rows']} rows, {entry['bytes'] / 1e6:.1f} MB")
+    click.echo(f"backup written to {directory} in {elapsed:.2f}s")
+
+@app.cli.command("restore")
+@click.argument("directory")
+@click.option("--workers", default=BACKUP_WORKERS, help="Parallel COPY streams.")
+@click.option("--yes", is_flag=True, help="Do not ask for confirmation.")
+def restore_command(directory, workers, yes):
+    """Replace the backed-up tables with the snapshot in DIRECTORY."""
+    if not yes:
+        click.confirm("This replaces inventory, history and projects. Continue?", abort=True)
+    started = time.perf_counter()
+    manifest = restore_tables(directory, workers=workers)
+    elapsed = time.perf_counter() - started
+    click.echo(f"restored snapshot from {manifest['taken_at']} in {elapsed:.2f}s")
+
+@app.cli.command("bench-backup")
+@click.option("--history-rows", default=2000000, help="Synthetic history rows to add first.")
+@click.option("--workers", default=BACKUP_WORKERS, help="Parallel COPY streams.")
+@click.option("--yes", is_flag=True, help="Do not ask for confirmation.")
+def bench_backup_command(history_rows, workers, yes):
+    """Time a backup and restore round trip with a large history table.
+
+    Run it against a scratch database: the round trip restores over the live
+    tables and the synthetic rows are removed afterwards.
+    """
+    if not yes:
+        click.confirm("This backs up and restores over the configured database. Continue?", abort=True)
+    item_number = f"BENCH-{os.getpid()}"
+    conn = _connect_primary()
+    c = conn.cursor()
+    c.execute("INSERT INTO items (item_number, name, unit) VALUES (%s, 'Backup benchmark', 'kg')", (item_number,))
+    c.execute("ALTER TABLE history DISABLE TRIGGER history_notify")
+    c.execute(
+        """
+        INSERT INTO history (item_number, lot, change, remaining, unit, action_type, username)
+        SELECT %s, 'LOT' || (n %% 1000), 1, n, 'kg', 'ADD', 'bench@localhost'
+        FROM generate_series(1, %s) n
+        """,
+        (item_number, history_rows),
+    )
+    c.execute("ALTER TABLE history ENABLE TRIGGER history_notify")
+    conn.commit()
+    conn.close()
+
+    directory = tempfile.mkdtemp(prefix="gminventory-backup-")
+    try:
+        started = time.perf_counter()
+        manifest = backup_tables(directory, workers=workers)
+        backup_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        restore_tables(directory, workers=workers)
+        restore_seconds = time.perf_counter() - started
+    finally:
+        conn = _connect_primary()
+        c = conn.cursor()
+        c.execute("DELETE FROM history WHERE item_number = %s", (item_number,))
+        c.execute("DELETE FROM items WHERE item_number = %s", (item_number,))
+        conn.commit()
+        conn.close()
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    rows = sum(entry["rows"] for entry in manifest["tables"])
+    size = sum(entry["bytes"] for entry in manifest["tables"])
+    click.echo(
+        f"{rows} rows ({size / 1e6:.1f} MB compressed) with {workers} workers: "
+        f"backup {backup_seconds:.2f}s, restore {restore_seconds:.2f}s"
+    )
+
+
+# -------------------------
+# FORECASTING
+# -------------------------
+def _claim_job_state(cursor, name):
+    """Lock an incremental job's state and return the write_xid range to fold.
+
+    History rows with folded_before <= write_xid < upper are new. upper is the
+    xmin of the current snapshot: every transaction below it has finished, so
+    no row can still commit into the range once it has been folded. Rows from
+    transactions still open wait for a later run.
+    """
+    cursor.execute(
+        "INSERT INTO job_state (name) VALUES (%s) ON CONFLICT (name) DO NOTHING",
+        (name,),
+    )
+    cursor.execute(
+        """
+        SELECT folded_before::text::bigint, pg_snapshot_xmin(pg_current_snapshot())::text::bigint
+        FROM job_state WHERE name = %s FOR UPDATE
+        """,
+        (name,),
+    )
+    return cursor.fetchone()
+
+def _save_job_state(cursor, name, folded_before):
+    cursor.execute(
+        """
+        UPDATE job_state
+        SET folded_before = %s::text::xid8, updated_at = CURRENT_TIMESTAMP
+        WHERE name = %s
+        """,
+        (str(folded_before), name),
+    )
+
+def job_state_updated_at(cursor, name):
+    """When an incremental job last folded history, or None if it never has."""
+    cursor.execute("SELECT updated_at FROM job_state WHERE name = %s", (name,))
+    row = cursor.fetchone()
+    return format_timestamp_pst(row[0]) if row else None
+
+def refresh_forecasts(cursor):
+    """Fold new REMOVE history into per-item EWMA usage and stock-out dates.
+
+    Only history rows written since the stored watermark are read, so a run
+    costs time proportional to the movements since the previous run.
+    """
+    folded_before, upper = _claim_job_state(cursor, "forecast")
+
+    if upper > folded_before:
+        cursor.execute(
+            """
+            SELECT item_number,
+                   (timestamp AT TIME ZONE %s)::date AS usage_day,
+                   SUM(-canonical_change) AS used,
+                   (ARRAY_AGG(canonical_unit ORDER BY id DESC))[1] AS unit
+            FROM history
+            WHERE write_xid >= %s::text::xid8 AND write_xid < %s::text::xid8 AND action_type = 'REMOVE'
+            GROUP BY item_number, usage_day
+            ORDER BY item_number, usage_day
+            """,
+            (str(PST_ZONE), str(folded_before), str(upper)),
+        )
+        daily_rows = cursor.fetchall()
+
+        item_numbers = sorted({row[0] for row in daily_rows})
+        state = {}
+        if item_numbers:
+            cursor.execute(
+                """
+                SELECT item_number, daily_usage, last_usage_date
+                FROM item_forecasts
+                WHERE item_number = ANY(%s)
+                """,
+                (item_numbers,),
+            )
+            state = {row[0]: (float(row[1] or 0), row[2]) for row in cursor.fetchall()}
+
+        # Days without a REMOVE count as zero usage, so a gap of n days
+        # decays the average by (1 - alpha) ** n before the new day lands.
+        updates = {}
+        for item_number, usage_day, used, unit in daily_rows:
+            usage, last_day = updates.get(item_number, state.get(item_number, (0.0, None)))[:2]
+            used = float(used or 0)
+            if last_day is None:
+                usage = used
+            else:
+                gap = max((usage_day - last_day).days, 0)
+                usage = usage * (1 - FORECAST_ALPHA) ** gap + FORECAST_ALPHA * used
+            updates[item_number] = (usage, usage_day, unit)
+
+        for item_number, (usage, usage_day, unit) in updates.items():
+            cursor.execute(
+                """
+                INSERT INTO item_forecasts (item_number, unit, daily_usage, last_usage_date)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (item_number) DO UPDATE SET
+                    unit = excluded.unit,
+                    daily_usage = excluded.daily_usage,
+                    last_usage_date = excluded.last_usage_date
+                """,
+                (item_number, unit, usage, usage_day),
+            )
+        _save_job_state(cursor, "forecast", upper)
+
+    # On-hand moves with every ADD/ADJUST and the rate decays on idle days,
+    # so cover is recomputed for all forecast rows in one set-based statement.
+    cursor.execute(
+        """
+        UPDATE item_forecasts f
+        SET on_hand = s.on_hand,
+            usage_rate = s.rate,
+            days_of_cover = CASE WHEN s.rate > 0 THEN s.on_hand / s.rate END,
+            stockout_date = CASE
+                WHEN s.rate > 0 THEN CURRENT_DATE + FLOOR(s.on_hand / s.rate)::int
+            END,
+            updated_at = CURRENT_TIMESTAMP
+        FROM (
+            SELECT f2.item_number,
+                   COALESCE(SUM(i.canonical_quantity), 0) AS on_hand,
+                   f2.daily_usage * POWER(
+                       1 - %s::numeric,
+                       GREATEST(CURRENT_DATE - f2.last_usage_date, 0)
+                   ) AS rate
+            FROM item_forecasts f2
+            LEFT JOIN inventory i
+              ON i.item_number = f2.item_number AND i.canonical_unit = f2.unit
+            GROUP BY f2.item_number, f2.daily_usage, f2.last_usage_date
+        ) s
+        WHERE f.item_number = s.item_number
+        """,
+        (FORECAST_ALPHA,),
+    )
+
+def refresh_movement_rollups(cursor):
+    """Add history rows written since the watermark into daily_movements."""
+    folded_before, upper = _claim_job_state(cursor, "rollup_movements")
+    if upper <= folded_before:
+        return
+    cursor.execute(
+        """
+        INSERT INTO daily_movements
+            (day, item_number, action_type, username, canonical_unit, total_change, movement_count)
+        SELECT (timestamp AT TIME ZONE %s)::date,
+               item_number,
+               split_part(action_type, ' ', 1),
+               COALESCE(username, ''),
+               COALESCE(canonical_unit, ''),
+               SUM(canonical_change),
+               COUNT(*)
+        FROM history
+        WHERE write_xid >= %s::text::xid8 AND write_xid < %s::text::xid8
+        GROUP BY 1, 2, 3, 4, 5
+        ON CONFLICT (day, item_number, action_type, username, canonical_unit) DO UPDATE SET
+            total_change = daily_movements.total_change + excluded.total_change,
+            movement_count = daily_movements.movement_count + excluded.movement_count
+        """,
+        (str(PST_ZONE), str(folded_before), str(upper)),
+    )
+    _save_job_state(cursor, "rollup_movements", upper)
+
+@app.cli.command("refresh-rollups")
+def refresh_rollups_command():
+    """Fold new history rows into the daily movement rollup."""
+    conn = connect_db()
+    c = conn.cursor()
+    refresh_movement_rollups(c)
+    conn.commit()
+    conn.close()
+
+@app.cli.command("refresh-forecasts")
+def refresh_forecasts_command():
+    """Update consumption forecasts from history since the last run."""
+    conn = connect_db()
+    c = conn.cursor()
+    refresh_forecasts(c)
+    conn.commit()
+    conn.close()
+
+
+@app.cli.command("prune-sync")
+@click.option("--days", default=SYNC_TOMBSTONE_DAYS, help="Keep deletions this many days.")
+def prune_sync_command(days):
+    """Drop old deletion tombstones; clients synced before them must resync fully."""
+    conn = connect_db()
+    c = conn.cursor()
+    c.execute(
+        """
+        WITH pruned AS (
+            DELETE FROM sync_tombstones
+            WHERE deleted_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+            RETURNING sync_xid
+        )
+        INSERT INTO sync_horizon (pruned_through)
+        SELECT MAX(sync_xid) FROM pruned HAVING COUNT(*) > 0
+        ON CONFLICT (id) DO UPDATE
+        SET pruned_through = GREATEST(sync_horizon.pruned_through, EXCLUDED.pruned_through)
+        RETURNING pruned_through
+        """,
+        (days,),
+    )
+    row = c.fetchone()
+    conn.commit()
+    conn.close()
+    click.echo(f"sync horizon: {row[0] if row else 'unchanged'}")
+
+# -------------------------
+# LOW STOCK
+# -------------------------
+# With an item list, the stock CTE finds lots through the item_number prefix
+# of idx_inventory_canonical, but it still reads each lot's raw unit from the
+# heap to price the default threshold, so it is not an index-only scan.
+# Allocations come from the partial idx_project_ingredients_allocated.
+LOW_STOCK_QUERY = """
+    WITH stock AS (
+        SELECT i.item_number,
+               i.canonical_unit,
+               SUM(i.canonical_quantity) AS on_hand,
+               MAX(COALESCE(u.low_stock_threshold, %(default_threshold)s * COALESCE(u.factor, 1))) AS default_threshold
+        FROM inventory i
+        LEFT JOIN units u ON u.alias = lower(trim(i.unit))
+        WHERE %(items)s::text[] IS NULL OR i.item_number = ANY(%(items)s)
+        GROUP BY i.item_number, i.canonical_unit
+    ),
+    allocated AS (
+        SELECT item_number,
+               canonical_unit_of(unit) AS canonical_unit,
+               SUM(quantity * canonical_factor_of(unit)) AS allocated
+        FROM project_ingredients
+        WHERE stage = 'Allocated'
+          AND (%(items)s::text[] IS NULL OR item_number = ANY(%(items)s))
+        GROUP BY 1, 2
+    )
+    SELECT s.item_number, it.name, it.supplier, s.canonical_unit, s.on_hand,
+           COALESCE(a.allocated, 0) AS allocated,
+           s.on_hand - COALESCE(a.allocated, 0) AS available,
+           COALESCE(t.canonical_threshold, s.default_threshold) AS threshold,
+           t.item_number IS NOT NULL AS custom_threshold
+    FROM stock s
+    LEFT JOIN items it ON it.item_number = s.item_number
+    LEFT JOIN allocated a
+      ON a.item_number = s.item_number AND a.canonical_unit = s.canonical_unit
+    LEFT JOIN item_thresholds t
+      ON t.item_number = s.item_number AND t.canonical_unit = s.canonical_unit
+    WHERE s.on_hand - COALESCE(a.allocated, 0) < COALESCE(t.canonical_threshold, s.default_threshold)
+    ORDER BY (s.on_hand - COALESCE(a.allocated, 0)) / NULLIF(COALESCE(t.canonical_threshold, s.default_threshold), 0),
+             s.item_number
+"""
+
+def evaluate_low_stock(cursor, item_numbers=None):
+    """Return items whose available stock (on hand minus allocated) is under threshold.
+
+    Pass item_numbers to check only the items touched by a movement, or
+    None to evaluate the whole inventory in the same single query.
+    """
+    cursor.execute(
+        LOW_STOCK_QUERY,
+        {"items": list(item_numbers) if item_numbers is not None else None, "default_threshold": LOW_STOCK_THRESHOLD},
+    )
+    return [
+        {
+            "item_number": row[0],
+            "name": row[1],
+            "supplier": row[2],
+            "unit": row[3],
+            "on_hand": float(row[4] or 0),
+            "allocated": float(row[5] or 0),
+            "available": float(row[6] or 0),
+            "threshold": float(row[7] or 0),
+            "custom_threshold": row[8],
+        }
+        for row in cursor.fetchall()
+    ]
+
+def send_low_stock_alerts(low_items, lot, triggered_by):
+    for entry in low_items:
+        app.logger.info(
+            "Threshold triggered for %s lot %s. Available %s %s (limit %s)",
+            entry["item_number"],
+            lot,
+            entry["available"],
+            entry["unit"],
+            entry["threshold"],
+        )
+        send_low_stock_email(
+            entry["item_number"],
+            lot,
+            entry["available"],
+            entry["unit"],
+            entry["name"],
+            entry["supplier"],
+            triggered_by,
+        )
+
+
+# -------------------------
+# MATERIAL REQUIREMENTS
+# -------------------------
+# Demand is netted in one statement: each project's gross requirement
+# (remaining gummies x recipe quantity) less what is already allocated to
+# it, then a running total per item in due-date order is compared with
+# the free stock (on hand minus all allocations).
+MRP_QUERY = """
+    WITH active AS (
+        SELECT id, name, customer_name, due_date, created_at, product,
+               GREATEST(COALESCE(bags_bottles, 0) - COALESCE(completed_bags, 0), 0)::numeric
+                   * COALESCE(gummies, 0) / NULLIF(bags_bottles, 0) AS remaining_gummies
+        FROM projects
+        WHERE status IS DISTINCT FROM 'Completed' AND product IS NOT NULL
+    ),
+    allocated AS (
+        SELECT project_id, item_number,
+               canonical_unit_of(unit) AS canonical_unit,
+               SUM(quantity * canonical_factor_of(unit)) AS allocated
+        FROM project_ingredients
+        WHERE stage = 'Allocated'
+        GROUP BY 1, 2, 3
+    ),
+    free_stock AS (
+        SELECT s.item_number, s.canonical_unit,
+               s.on_hand - COALESCE(SUM(a.allocated), 0) AS free
+        FROM (
+            SELECT item_number, canonical_unit, SUM(canonical_quantity) AS on_hand
+            FROM inventory
+            GROUP BY item_number, canonical_unit
+        ) s
+        LEFT JOIN allocated a
+          ON a.item_number = s.item_number AND a.canonical_unit = s.canonical_unit
+        GROUP BY s.item_number, s.canonical_unit, s.on_hand
+    ),
+    demand AS (
+        SELECT p.id AS project_id, p.name, p.customer_name, p.due_date, p.created_at,
+               r.item_number, r.canonical_unit,
+               p.remaining_gummies * r.canonical_per_gummy AS gross,
+               GREATEST(p.remaining_gummies * r.canonical_per_gummy - COALESCE(a.allocated, 0), 0) AS net
+        FROM active p
+        JOIN recipe_lines r ON r.product = p.product
+        LEFT JOIN allocated a
+          ON a.project_id = p.id AND a.item_number = r.item_number AND a.canonical_unit = r.canonical_unit
+        WHERE p.remaining_gummies > 0
+    ),
+    running AS (
+        SELECT d.*,
+               GREATEST(COALESCE(f.free, 0), 0) AS free,
+               SUM(d.net) OVER (
+                   PARTITION BY d.item_number, d.canonical_unit
+                   ORDER BY d.due_date NULLS LAST, d.created_at, d.project_id
+               ) AS cumulative
+        FROM demand d
+        LEFT JOIN free_stock f
+          ON f.item_number = d.item_number AND f.canonical_unit = d.canonical_unit
+    )
+    SELECT r.project_id, r.name, r.customer_name, r.due_date, r.item_number,
+           (SELECT i.name FROM items i WHERE i.item_number = r.item_number),
+           r.canonical_unit, r.gross, r.gross - r.net, r.net, r.free,
+           LEAST(r.net, GREATEST(r.cumulative - r.free, 0)) AS shortfall
+    FROM running r
+    ORDER BY r.due_date NULLS LAST, r.created_at, r.project_id, r.item_number
+"""
+
+def run_material_requirements(cursor):
+    """Explode active projects into ingredient demand and net it against stock.
+
+    Projects are served in due-date order, so a shortfall lands on the
+    latest projects that cannot be covered by free stock.
+    """
+    cursor.execute(MRP_QUERY)
+    projects = {}
+    item_shortfalls = {}
+    for row in cursor.fetchall():
+        project = projects.setdefault(
+            row[0],
+            {
+                "id": row[0],
+                "name": row[1],
+                "customer_name": row[2],
+                "due_display": row[3].strftime("%Y-%m-%d") if row[3] else "TBD",
+                "lines": [],
+                "short": False,
+            },
+        )
+        line = {
+            "item_number": row[4],
+            "item_name": row[5],
+            "unit": row[6],
+            "required": round(float(row[7] or 0), 4),
+            "allocated": round(float(row[8] or 0), 4),
+            "net": round(float(row[9] or 0), 4),
+            "free_stock": round(float(row[10] or 0), 4),
+            "shortfall": round(float(row[11] or 0), 4),
+        }
+        project["lines"].append(line)
+        if line["shortfall"] > 0:
+            project["short"] = True
+            key = (line["item_number"], line["unit"])
+            summary = item_shortfalls.setdefault(
+                key,
+                {"item_number": line["item_number"], "item_name": line["item_name"], "unit": line["unit"], "shortfall": 0.0},
+            )
+            summary["shortfall"] += line["shortfall"]
+    return list(projects.values()), sorted(item_shortfalls.values(), key=lambda entry: -entry["shortfall"])
+
+
+# -------------------------
+# LOT TRACEABILITY
+# -------------------------
+# Both directions read lot_trace through an index: by lot (and optionally
+# item) for a recall, by project for everything that went into it. Projects
+# are joined live, falling back to the names kept when a project is deleted.
+LOT_TRACE_COLUMNS = (
+    "lot", "item_number", "item_name", "supplier", "project_id", "project_name", "customer_name",
+    "status", "due_date", "completed_on", "allocated_quantity", "used_quantity", "unit",
+    "first_linked_at", "last_used_at", "project_deleted",
+)
+LOT_TRACE_SELECT = """
+    SELECT t.lot, t.item_number, it.name, t.supplier,
+           t.project_id, COALESCE(p.name, t.project_name), COALESCE(p.customer_name, t.customer_name),
+           p.status, p.due_date, p.completed_on,
+           t.allocated_quantity, t.used_quantity, t.unit,
+           t.first_linked_at, t.last_used_at, p.id IS NULL
+    FROM lot_trace t
+    LEFT JOIN projects p ON p.id = t.project_id
+    LEFT JOIN items it ON it.item_number = t.item_number
+"""
+
+def lot_trace_query(lot=None, item_number=None, project_id=None):
+    """Return (query, params) tracing a lot forward or a project backward."""
+    if project_id is not None:
+        return LOT_TRACE_SELECT + " WHERE t.project_id = %s ORDER BY t.item_number, t.lot", (project_id,)
+    if item_number:
+        return (
+            LOT_TRACE_SELECT + " WHERE t.lot = %s AND t.item_number = %s ORDER BY 7, 10, t.project_id",
+            (lot, item_number),
+        )
+    return LOT_TRACE_SELECT + " WHERE t.lot = %s ORDER BY 7, 10, t.project_id, t.item_number", (lot,)
+
+def _trace_row(row):
+    entry = dict(zip(LOT_TRACE_COLUMNS, row))
+    entry["allocated_quantity"] = float(entry["allocated_quantity"])
+    entry["used_quantity"] = float(entry["used_quantity"])
+    return entry
+
+def _trace_args():
+    """Read lot/item/project query args; project wins when both are given."""
+    lot = request.args.get("lot", "").strip()
+    item_number = request.args.get("item", "").strip() or None
+    project_arg = request.args.get("project", "").strip().lstrip("#")
+    project_id = int(project_arg) if project_arg.isdigit() else None
+    return lot, item_number, project_id
+
+
+@app.cli.command("bench-trace")
+@click.option("--projects", default=20000, help="Synthetic projects to create.")
+@click.option("--ingredients", default=10, help="Ingredient rows per project.")
+@click.option("--lots", default=5000, help="Distinct lots the ingredients draw from.")
+@click.option("--queries", default=200, help="Timed lookups per direction.")
+def bench_trace_command(projects, ingredients, lots, queries):
+    """Time recall and project lookups through lot_trace against scanning ingredients.
+
+    Everything seeded is deleted afterwards, trace rows included.
+    """
+    item_number = f"BENCH-TRACE-{os.getpid()}"
+    conn = _connect_primary()
+    c = conn.cursor()
+    started = time.perf_counter()
+    c.execute("INSERT INTO items (item_number, name, unit) VALUES (%s, 'Trace benchmark', 'kg')", (item_number,))
+    c.execute(
+        """
+        INSERT INTO projects (name, customer_name, status, completed_on)
+        SELECT 'Trace bench ' || n, 'Customer ' || (n %% 500), 'Completed',
+               CURRENT_DATE - (n %% 2000)
+        FROM generate_series(1, %s) n
+        RETURNING id
+        """,
+        (projects,),
+    )
+    project_ids = [row[0] for row in c.fetchall()]
+    c.execute(
+        """
+        INSERT INTO project_ingredients (project_id, item_number, lot, quantity, unit, stage)
+        SELECT p.id, %s, 'TRACE-' || ((p.id * %s + k) %% %s), 1, 'kg', 'Used'
+        FROM unnest(%s::int[]) AS p(id), generate_series(1, %s) k
+        """,
+        (item_number, ingredients, lots, project_ids, ingredients),
+    )
+    conn.commit()
+    c.execute("ANALYZE lot_trace")
+    c.execute("ANALYZE project_ingredients")
+    conn.commit()
+    click.echo(f"seeded {projects * ingredients} ingredient rows in {time.perf_counter() - started:.1f}s")
+
+    scan_query = """
+        SELECT pi.lot, pi.item_number, p.id, p.name, p.customer_name, p.completed_on, pi.quantity
+        FROM project_ingredients pi
+        JOIN projects p ON p.id = pi.project_id
+        WHERE pi.lot = %s AND pi.item_number = %s
+    """
+    rng = random.Random(0)
+    try:
+        for label, make_query in (
+            ("recall via lot_trace", lambda: lot_trace_query(f"TRACE-{rng.randrange(lots)}", item_number)),
+            ("project via lot_trace", lambda: lot_trace_query(project_id=rng.choice(project_ids))),
+            ("recall scanning ingredients", lambda: (scan_query, (f"TRACE-{rng.randrange(lots)}", item_number))),
+        ):
+            timings = []
+            for _ in range(queries):
+                query, params = make_query()
+                began = time.perf_counter()
+                c.execute(query, params)
+                c.fetchall()
+                timings.append((time.perf_counter() - began) * 1000)
+            conn.rollback()
+            timings.sort()
+            click.echo(
+                f"{label}: median {timings[len(timings) // 2]:.2f} ms, "
+                f"p99 {timings[int(len(timings) * 0.99) - 1]:.2f} ms"
+            )
+    finally:
+        conn.rollback()
+        c.execute("DELETE FROM projects WHERE id = ANY(%s)", (project_ids,))
+        c.execute("DELETE FROM lot_trace WHERE item_number = %s", (item_number,))
+        c.execute("DELETE FROM items WHERE item_number = %s", (item_number,))
+        conn.commit()
+        conn.close()
+
+
+# -------------------------
+# LIVE EVENTS
+# -------------------------
+class EventBroker:
+    """Fan out NOTIFY payloads from one LISTEN connection to SSE subscribers.
+
+    Each subscriber gets a bounded queue. A client that falls behind is
+    dropped and told to resync rather than growing the worker's memory.
+    """
+
+    def __init__(self, channel, buffer_size):
+        self.channel = channel
+        self.buffer_size = buffer_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self):
+        subscriber = queue.Queue(maxsize=self.buffer_size)
+        with self._lock:
+            self._subscribers.add(subscriber)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen, name="event-listener", daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, payload):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(payload)
+            except queue.Full:
+                self._drop(subscriber)
+
+    def resync_all(self):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            self._drop(subscriber)
+
+    def _drop(self, subscriber):
+        # None tells the stream to send a resync event and close.
+        self.unsubscribe(subscriber)
+        with subscriber.mutex:
+            subscriber.queue.clear()
+        subscriber.put_nowait(None)
+
+    def _listen(self):
+        while True:
+            conn = None
+            try:
+                conn = _connect_primary()
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+                while True:
+                    if select.select([conn], [], [], SSE_HEARTBEAT_SECONDS) != ([], [], []):
+                        conn.poll()
+                        while conn.notifies:
+                            self.publish(conn.notifies.pop(0).payload)
+                    with self._lock:
+                        if not self._subscribers:
+                            self._thread = None
+                            return
+            except (psycopg2.Error, OSError) as exc:
+                # Notifications sent while disconnected are lost, so clients reload.
+                app.logger.warning("Event listener disconnected: %s", exc)
+                self.resync_all()
+                time.sleep(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+event_broker = EventBroker(EVENT_CHANNEL, SSE_CLIENT_BUFFER)
+
+@app.route("/events")
+@login_required
+def events():
+    subscriber = event_broker.subscribe()
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    payload = subscriber.get(timeout=SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+                if payload is None:
+                    yield "event: resync\ndata: {}\n\n"
+                    return
+                yield f"data: {payload}\n\n"
+        finally:
+            event_broker.unsubscribe(subscriber)
+
+    return Response(
+        stream_with_context(stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# -------------------------
+# STREAMED PAGES
+# -------------------------
+def stream_rows(query, params=None, name="stream_rows", conn=None):
+    """Yield rows from a server-side cursor, closing the connection when done.
+
+    Only STREAM_FETCH_ROWS rows are held in memory at a time, so a page can
+    render its first rows before the last ones have been read. Unless conn
+    is given, a read-only connection is checked out when the first row is
+    requested, so a response that is never iterated never holds one.
+
+    A streaming response keeps its pooled connection, and the transaction
+    on it, until the last row is sent: every slow download in progress
+    takes one of the DB_POOL_MAX connections for its whole duration.
+    """
+    if conn is None:
+        conn = connect_db(read_only=True)
+    try:
+        cursor = conn.cursor(name=name)
+        cursor.itersize = STREAM_FETCH_ROWS
+        cursor.execute(query, params)
+        for row in cursor:
+            yield row
+        cursor.close()
+    finally:
+        conn.close()
+
+def _coalesce_chunks(pieces, size):
+    """Join Jinja's small output events into chunks of roughly size bytes."""
+    buffered = []
+    buffered_bytes = 0
+    for piece in pieces:
+        buffered.append(piece)
+        buffered_bytes += len(piece)
+        if buffered_bytes >= size:
+            yield "".join(buffered)
+            buffered = []
+            buffered_bytes = 0
+    if buffered:
+        yield "".join(buffered)
+
+def stream_page(template_name, **context):
+    """Render a template as a streamed response in STREAM_CHUNK_BYTES chunks."""
+    return Response(_coalesce_chunks(stream_template(template_name, **context), STREAM_CHUNK_BYTES))
+
+
+# -------------------------
+# RENDER CACHE
+# -------------------------
+class RenderCache:
+    """Rendered-page cache shared by worker processes through a local SQLite file.
+
+    Entries are keyed by the data version of the scopes a page depends on,
+    so bumping a scope makes old entries unreachable and LRU eviction
+    reclaims them once the byte budget is exceeded.
+    """
+
+    def __init__(self, path, max_bytes, max_entry_bytes, flush_seconds=RENDER_CACHE_FLUSH_SECONDS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.flush_seconds = flush_seconds
+        self._local = threading.local()
+        # Hit/miss counts and last_used touches are kept in memory and written
+        # in one transaction every flush_seconds, so a cache hit is a single read.
+        self._pending_lock = threading.Lock()
+        self._pending_stats = {}
+        self._pending_touches = {}
+        self._flushed_at = time.monotonic()
+
+    def _db(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS versions (scope TEXT PRIMARY KEY, version INTEGER NOT NULL)"
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    body TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, hits INTEGER NOT NULL, misses INTEGER NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('epoch', ?)", (os.urandom(8).hex(),))
+            self._local.epoch = conn.execute("SELECT value FROM meta WHERE name = 'epoch'").fetchone()[0]
+            self._local.conn = conn
+        return conn
+
+    def epoch(self):
+        """Random tag picked when the cache file was created.
+
+        Versions start again from zero in a new file, so a version given to
+        clients must be paired with the epoch to stay unique.
+        """
+        self._db()
+        return self._local.epoch
+
+    def versions(self, scopes):
+        placeholders = ",".join("?" for _ in scopes)
+        rows = self._db().execute(
+            f"SELECT scope, version FROM versions WHERE scope IN ({placeholders})", scopes
+        ).fetchall()
+        found = dict(rows)
+        return [found.get(scope, 0) for scope in scopes]
+
+    def bump(self, scope):
+        self._db().execute(
+            """
+            INSERT INTO versions (scope, version) VALUES (?, 1)
+            ON CONFLICT (scope) DO UPDATE SET version = version + 1
+            """,
+            (scope,),
+        )
+
+    def get(self, name, key):
+        row = self._db().execute("SELECT body FROM entries WHERE key = ?", (key,)).fetchone()
+        with self._pending_lock:
+            counts = self._pending_stats.setdefault(name, [0, 0])
+            counts[0 if row else 1] += 1
+            if row:
+                self._pending_touches[key] = time.time()
+            due = time.monotonic() - self._flushed_at >= self.flush_seconds
+        if due:
+            self.flush()
+        return row[0] if row else None
+
+    def _take_pending(self):
+        with self._pending_lock:
+            stats, self._pending_stats = self._pending_stats, {}
+            touches, self._pending_touches = self._pending_touches, {}
+            self._flushed_at = time.monotonic()
+        return stats, touches
+
+    def _write_pending(self, db, stats, touches):
+        if touches:
+            db.executemany(
+                "UPDATE entries SET last_used = MAX(last_used, ?) WHERE key = ?",
+                [(used, key) for key, used in touches.items()],
+            )
+        if stats:
+            db.executemany(
+                """
+                INSERT INTO stats (name, hits, misses) VALUES (?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET hits = hits + excluded.hits, misses = misses + excluded.misses
+                """,
+                [(name, hits, misses) for name, (hits, misses) in stats.items()],
+            )
+
+    def flush(self):
+        """Write this process's buffered hit counts and LRU touches."""
+        stats, touches = self._take_pending()
+        if not stats and not touches:
+            return
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            self._write_pending(db, stats, touches)
+            db.execute("COMMIT")
+        except sqlite3.Error:
+            db.execute("ROLLBACK")
+            raise
+
+    def set(self, key, body):
+        size = len(body.encode("utf-8"))
+        if size > self.max_entry_bytes:
+            return
+        stats, touches = self._take_pending()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # Apply buffered touches first so eviction sees recent hits.
+            self._write_pending(db, stats, touches)
+            db.execute(
+                "INSERT OR REPLACE INTO entries (key, body, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, body, size, time.time()),
+            )
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total > self.max_bytes:
+                # Drop least recently used entries until back under budget.
+                db.execute(
+                    """
+                    DELETE FROM entries WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, SUM(size) OVER (ORDER BY last_used DESC) AS running
+                            FROM entries
+                        ) WHERE running > ?
+                    )
+                    """,
+                    (self.max_bytes,),
+                )
+            db.execute("COMMIT")
+        except sqlite3.Error:
+            db.execute("ROLLBACK")
+            raise
+
+    def stats(self):
+        self.flush()
+        db = self._db()
+        pages = {}
+        for name, hits, misses in db.execute("SELECT name, hits, misses FROM stats ORDER BY name"):
+            lookups = hits + misses
+            pages[name] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": round(hits / lookups, 4) if lookups else None,
+            }
+        entries, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {"pages": pages, "entries": entries, "bytes": size, "max_bytes": self.max_bytes}
+
+render_cache = RenderCache(RENDER_CACHE_PATH, RENDER_CACHE_MAX_BYTES, RENDER_CACHE_MAX_ENTRY_BYTES)
+
+_deferred_bumps = threading.local()
+
+def mark_data_changed(scope):
+    """Invalidate cached pages for a scope once the current work has committed.
+
+    Inside a request the bump waits for after_request. Elsewhere it waits for
+    the enclosing deferred_cache_bumps() block; with neither, the caller must
+    already have committed.
+    """
+    if has_request_context():
+        g.setdefault("changed_scopes", set()).add(scope)
+        return
+    pending = getattr(_deferred_bumps, "scopes", None)
+    if pending is not None:
+        pending.add(scope)
+    else:
+        render_cache.bump(scope)
+
+@contextmanager
+def deferred_cache_bumps():
+    """Hold mark_data_changed() bumps made outside a request until the block exits.
+
+    Wrap the work and its commit: a page rendered from the old rows in between
+    would otherwise be cached under the new version and never invalidated.
+    Scopes are bumped even if the block raises, since a spare bump only costs
+    a re-render.
+    """
+    if getattr(_deferred_bumps, "scopes", None) is not None:
+        yield
+        return
+    _deferred_bumps.scopes = set()
+    try:
+        yield
+    finally:
+        scopes, _deferred_bumps.scopes = _deferred_bumps.scopes, None
+        for scope in scopes:
+            try:
+                render_cache.bump(scope)
+            except sqlite3.Error as exc:
+                app.logger.error("Render cache invalidation failed for %s: %s", scope, exc)
+
+@app.after_request
+def bump_changed_scopes(response):
+    for scope in g.pop("changed_scopes", ()):
+        try:
+            render_cache.bump(scope)
+        except sqlite3.Error as exc:
+            app.logger.error("Render cache invalidation failed for %s: %s", scope, exc)
+    return response
+
+def _cache_streamed(key, chunks):
+    """Pass streamed chunks through, storing the page once it has been sent in full.
+
+    Copying stops as soon as the page outgrows one cache entry, so large
+    streams still run in flat memory and are simply not cached.
+    """
+    copied = []
+    copied_bytes = 0
+    for chunk in chunks:
+        if copied is not None:
+            copied.append(chunk)
+            copied_bytes += len(chunk)
+            if copied_bytes > render_cache.max_entry_bytes:
+                copied = None
+        yield chunk
+    if copied is not None:
+        try:
+            render_cache.set(key, "".join(copied))
+        except sqlite3.Error as exc:
+            app.logger.warning("Render cache store failed: %s", exc)
+
+def cached_page(*scopes):
+    """Serve GET renders from the shared cache until one of the scopes changes."""
+    def decorator(route_function):
+        def wrapper(*args, **kwargs):
+            if request.method != "GET":
+                return route_function(*args, **kwargs)
+            try:
+                versions = render_cache.versions(scopes)
+                # The date is part of the key because pages flag overdue items.
+                key = "|".join(
+                    [request.path, request.query_string.decode("utf-8", "replace"), date.today().isoformat()]
+                    + [f"{scope}={version}" for scope, version in zip(scopes, versions)]
+                )
+                body = render_cache.get(route_function.__name__, key)
+            except sqlite3.Error as exc:
+                app.logger.warning("Render cache unavailable: %s", exc)
+                return route_function(*args, **kwargs)
+            if body is not None:
+                return body
+
+            g.render_cache_fill = True
+            response = route_function(*args, **kwargs)
+            if isinstance(response, Response) and response.is_streamed:
+                # Streamed rows are read after the view returns; keep them on the primary.
+                response.response = _cache_streamed(key, response.response)
+                return response
+            g.render_cache_fill = False
+            if isinstance(response, str):
+                try:
+                    render_cache.set(key, response)
+                except sqlite3.Error as exc:
+                    app.logger.warning("Render cache store failed: %s", exc)
+            return response
+        wrapper.__name__ = route_function.__name__
+        return wrapper
+    return decorator
+
+@app.route("/metrics/render-cache")
+@login_required
+def render_cache_metrics():
+    return render_cache.stats()
+
+
+# -------------------------
+# REPOSITORIES
+# -------------------------
+# Routes for inventory, history, projects and the dashboard log reach their
+# data through `repository`. Each backend hands out sessions from
+# transaction(): writes commit together when the block exits and roll back
+# if it raises.
+ACTIVE_PROJECT_COLUMNS = (
+    "id", "name", "customer_name", "description", "due_date", "status", "bags_bottles", "gummies",
+    "storage_status", "quantity_unit", "completed_bags", "created_at", "product",
+)
+COMPLETED_PROJECT_COLUMNS = (
+    "id", "name", "customer_name", "description", "due_date", "status", "bags_bottles", "gummies",
+    "storage_status", "quantity_unit", "completed_bags", "completed_on", "created_at",
+)
+LOT_COLUMNS = ("item_number", "name", "unit", "supplier", "exp", "lot", "quantity")
+HISTORY_SELECT = """
+    SELECT h.id, h.item_number, h.lot, h.change, h.remaining,
+           h.unit, h.action_type, h.username, h.timestamp,
+           i.name
+    FROM history h
+    LEFT JOIN items i ON i.item_number = h.item_number
+"""
+
+class PostgresSession:
+    """Data access for one database transaction."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor()
+
+    # Inventory
+    def item_choices(self):
+        self.cursor.execute("SELECT item_number, name FROM items ORDER BY item_number")
+        return self.cursor.fetchall()
+
+    def lot_rows(self):
+        self.cursor.execute(f"SELECT {', '.join(LOT_COLUMNS)} FROM inventory ORDER BY item_number, lot")
+        return self.cursor.fetchall()
+
+    def lot(self, item_number, lot):
+        """Return (quantity, unit, name, supplier, exp) for a lot, or None."""
+        execute_prepared(self.cursor, "lot_details", (item_number, lot))
+        return self.cursor.fetchone()
+
+    def item_lookup(self, item_number):
+        """Return (item_number, name, unit, supplier, exp) from one of the item's lots, or None."""
+        execute_prepared(self.cursor, "item_lookup", (item_number,))
+        return self.cursor.fetchone()
+
+    def lots(self, item_number):
+        execute_prepared(self.cursor, "item_lots", (item_number,))
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def lot_lookup(self, item_number, lot):
+        """Return (quantity, unit) for a lot, or None."""
+        execute_prepared(self.cursor, "lot_quantity", (item_number, lot))
+        return self.cursor.fetchone()
+
+    def lot_allocations(self, item_numbers, lots=None):
+        """(item_number, name, unit, supplier, exp, lot, quantity, allocated) per matching lot."""
+        self.cursor.execute(
+            """
+            SELECT i.item_number, i.name, i.unit, i.supplier, i.exp,
+                   i.lot, i.quantity, COALESCE(a.allocated, 0)
+            FROM inventory i
+            LEFT JOIN (
+                SELECT item_number, lot, SUM(quantity) AS allocated
+                FROM project_ingredients
+                WHERE stage = 'Allocated' AND item_number = ANY(%(items)s)
+                GROUP BY item_number, lot
+            ) a ON a.item_number = i.item_number AND a.lot = i.lot
+            WHERE i.item_number = ANY(%(items)s)
+              AND (%(lots)s::text[] IS NULL OR i.lot = ANY(%(lots)s))
+            ORDER BY i.item_number, i.lot
+            """,
+            {"items": item_numbers, "lots": lots},
+        )
+        return self.cursor.fetchall()
+
+    def add_stock(self, item_number, name, quantity, unit, lot, supplier, exp, username):
+        """Upsert the item and lot, log the addition and return the lot's new quantity."""
+        c = self.cursor
+        # keep the item master current; blank fields never erase known values
+        c.execute(
+            """
+            INSERT INTO items (item_number, name, unit, supplier)
+            VALUES (%s, NULLIF(%s, ''), %s, NULLIF(%s, ''))
+            ON CONFLICT (item_number) DO UPDATE SET
+                name = COALESCE(excluded.name, items.name),
+                unit = COALESCE(items.unit, excluded.unit),
+                supplier = COALESCE(excluded.supplier, items.supplier)
+            """,
+            (item_number, name, unit, supplier),
+        )
+        c.execute(
+            """
+            INSERT INTO inventory (item_number, name, quantity, unit, lot, supplier, exp)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT(item_number, lot)
+            DO UPDATE SET
+                name = excluded.name,
+                unit = excluded.unit,
+                supplier = excluded.supplier,
+                exp = excluded.exp,
+                quantity = inventory.quantity + excluded.quantity
+            RETURNING quantity
+            """,
+            (item_number, name, quantity, unit, lot, supplier, exp),
+        )
+        remaining = c.fetchone()[0]
+        c.execute(
+            """
+            INSERT INTO history (item_number, lot, change, remaining, unit, action_type, username)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """,
+            (item_number, lot, quantity, remaining, unit, "ADD", username),
+        )
+        return remaining
+
+    def remove_stock(self, item_number, lot, quantity, username):
+        return remove_from_lot(self.cursor, item_number, lot, quantity, username)
+
+    def set_stock(self, item_number, lot, quantity, unit, action_type, username):
+        """Overwrite a lot's quantity and unit; return the logged change, or None if missing."""
+        c = self.cursor
+        # Lock the lot so the logged change matches what this write replaced
+        c.execute(
+            "SELECT quantity FROM inventory WHERE item_number = %s AND lot = %s FOR UPDATE",
+            (item_number, lot),
+        )
+        row = c.fetchone()
+        if not row:
+            return None
+        c.execute(
+            "UPDATE inventory SET quantity = %s, unit = %s WHERE item_number = %s AND lot = %s",
+            (quantity, unit, item_number, lot),
+        )
+        change = quantity - float(row[0] or 0)
+        c.execute(
+            """
+            INSERT INTO history (item_number, lot, change, remaining, unit, action_type, username)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """,
+            (item_number, lot, change, quantity, unit, action_type, username),
+        )
+        return change
+
+    def low_stock(self, item_numbers=None):
+        return evaluate_low_stock(self.cursor, item_numbers)
+
+    # History
+    def item_history(self, item_number):
+        self.cursor.execute(
+            HISTORY_SELECT + " WHERE h.item_number = %s ORDER BY h.timestamp DESC",
+            (item_number,),
+        )
+        return self.cursor.fetchall()
+
+    # Projects
+    def products(self):
+        self.cursor.execute("SELECT DISTINCT product FROM recipe_lines ORDER BY product")
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def create_project(self, fields):
+        columns = list(fields)
+        self.cursor.execute(
+            sql.SQL("INSERT INTO projects ({}) VALUES ({}) RETURNING id").format(
+                sql.SQL(", ").join(map(sql.Identifier, columns)),
+                sql.SQL(", ").join(sql.Placeholder() * len(columns)),
+            ),
+            [fields[column] for column in columns],
+        )
+        return self.cursor.fetchone()[0]
+
+    def project_name(self, project_id):
+        self.cursor.execute("SELECT name FROM projects WHERE id = %s", (project_id,))
+        row = self.cursor.fetchone()
+        return row[0] if row else None
+
+    def update_project(self, project_id, fields):
+        self.cursor.execute(
+            sql.SQL("UPDATE projects SET {} WHERE id = %s").format(
+                sql.SQL(", ").join(
+                    sql.SQL("{} = %s").format(sql.Identifier(column)) for column in fields
+                )
+            ),
+            list(fields.values()) + [project_id],
+        )
+
+    def delete_project(self, project_id):
+        self.cursor.execute("DELETE FROM projects WHERE id = %s", (project_id,))
+        # Its ingredient allocations cascade away, and /lookup reports those.
+        mark_data_changed("inventory")
+
+    # Project ingredients
+    def project_summary(self, project_id):
+        """Return (id, name, customer_name) for a project, or None."""
+        self.cursor.execute("SELECT id, name, customer_name FROM projects WHERE id = %s", (project_id,))
+        return self.cursor.fetchone()
+
+    def project_ingredients(self, project_id):
+        """(id, item_number, item_name, quantity, unit, lot, stage, notes) in the order they were added."""
+        self.cursor.execute(
+            """
+            SELECT pi.id, pi.item_number, it.name, pi.quantity, pi.unit, pi.lot, pi.stage, pi.notes
+            FROM project_ingredients pi
+            LEFT JOIN items it ON it.item_number = pi.item_number
+            WHERE pi.project_id = %s
+            ORDER BY pi.created_at, pi.id
+            """,
+            (project_id,),
+        )
+        return self.cursor.fetchall()
+
+    def allocated_by_lot(self):
+        """(item_number, lot, allocated) for every lot with open allocations."""
+        self.cursor.execute(
+            """
+            SELECT item_number, lot, SUM(quantity)
+            FROM project_ingredients
+            WHERE stage = 'Allocated' AND lot IS NOT NULL
+            GROUP BY item_number, lot
+            """
+        )
+        return self.cursor.fetchall()
+
+    def add_ingredient(self, project_id, item_number, item_name, quantity, unit, lot, stage, notes):
+        c = self.cursor
+        c.execute(
+            """
+            INSERT INTO items (item_number, name, unit) VALUES (%s, NULLIF(%s, ''), %s)
+            ON CONFLICT (item_number) DO NOTHING
+            """,
+            (item_number, item_name, unit),
+        )
+        c.execute(
+            """
+            INSERT INTO project_ingredients (project_id, item_number, lot, quantity, unit, stage, notes)
+            VALUES (%s, %s, %s, %s, %s, %s, NULLIF(%s, ''))
+            """,
+            (project_id, item_number, lot, quantity, unit, stage, notes),
+        )
+
+    def ingredient_for_use(self, project_id, ingredient_id):
+        """Lock a project's ingredient and return (item_number, lot, quantity, unit, stage), or None."""
+        self.cursor.execute(
+            """
+            SELECT item_number, lot, quantity, unit, stage
+            FROM project_ingredients
+            WHERE id = %s AND project_id = %s
+            FOR UPDATE
+            """,
+            (ingredient_id, project_id),
+        )
+        return self.cursor.fetchone()
+
+    def mark_ingredient_used(self, ingredient_id):
+        self.cursor.execute(
+            """
+            UPDATE project_ingredients
+            SET stage = 'Used', finalized_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+            """,
+            (ingredient_id,),
+        )
+
+    def active_projects(self):
+        self.cursor.execute(
+            f"""
+            SELECT {', '.join(ACTIVE_PROJECT_COLUMNS)}
+            FROM projects
+            WHERE status IS DISTINCT FROM 'Completed'
+            ORDER BY due_date NULLS LAST, created_at
+            """
+        )
+        return self.cursor.fetchall()
+
+    def project_counts(self):
+        """Return (total, pending, completed)."""
+        self.cursor.execute(
+            """
+            SELECT COUNT(*),
+                   COUNT(*) FILTER (WHERE status IS DISTINCT FROM 'Completed'),
+                   COUNT(*) FILTER (WHERE status = 'Completed')
+            FROM projects
+            """
+        )
+        return self.cursor.fetchone()
+
+    def completed_projects(self, customer=None, date_from=None, date_to=None, before=None, limit=COMPLETED_PAGE_SIZE):
+        """One keyset page of completed projects, newest completion first.
+
+        before is the (completed_on or None, id) of the previous page's last row.
+        """
+        # Keyset on the same expression as the archive indexes; undated
+        # completions sort as -infinity so they come last.
+        conditions = ["status = 'Completed'"]
+        params = []
+        if customer:
+            conditions.append("customer_name = %s")
+            params.append(customer)
+        if date_from:
+            conditions.append("COALESCE(completed_on, '-infinity'::date) >= %s")
+            params.append(date_from)
+        if date_to:
+            conditions.append("completed_on IS NOT NULL AND COALESCE(completed_on, '-infinity'::date) <= %s")
+            params.append(date_to)
+        if before:
+            conditions.append("(COALESCE(completed_on, '-infinity'::date), id) < (%s::date, %s)")
+            params.extend([before[0].isoformat() if before[0] else "-infinity", before[1]])
+        self.cursor.execute(
+            f"""
+            SELECT {', '.join(COMPLETED_PROJECT_COLUMNS)}
+            FROM projects
+            WHERE {" AND ".join(conditions)}
+            ORDER BY COALESCE(completed_on, '-infinity'::date) DESC, id DESC
+            LIMIT %s
+            """,
+            params + [limit],
+        )
+        return self.cursor.fetchall()
+
+    def completed_customers(self):
+        self.cursor.execute(
+            "SELECT DISTINCT customer_name FROM daily_completions "
+            "WHERE customer_name <> '' AND projects_completed > 0 ORDER BY customer_name"
+        )
+        return [row[0] for row in self.cursor.fetchall()]
+
+    # Dashboard history
+    def log_event(self, message, username=None):
+        log_dashboard_event(self.cursor, message, username)
+
+    def recent_events(self, limit=50):
+        self.cursor.execute(
+            "SELECT message, username, created_at FROM dashboard_history ORDER BY created_at DESC LIMIT %s",
+            (limit,),
+        )
+        return self.cursor.fetchall()
+
+class PostgresRepository:
+    @contextmanager
+    def transaction(self, read_only=False):
+        conn = connect_db(read_only=read_only)
+        try:
+            yield PostgresSession(conn)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def stream_lots(self, search_term, column, descending):
+        """Yield (item_number, name, quantity, unit, lot, supplier, exp) rows in page order."""
+        query = "SELECT item_number, name, quantity, unit, lot, supplier, exp FROM inventory"
+        params = []
+        if search_term:
+            query += " WHERE item_number ILIKE %s OR name ILIKE %s"
+            like = f"%{search_term}%"
+            params.extend([like, like])
+        query += f" ORDER BY {column} {'DESC' if descending else 'ASC'}, lot"
+        return stream_rows(query, params, name="current_inventory")
+
+    def stream_history(self):
+        return stream_rows(HISTORY_SELECT + " ORDER BY h.timestamp DESC", name="history_log")
+
+def _numeric(value):
+    """Store a number the way a NUMERIC column does.
+
+    psycopg2 sends a float as its shortest repr, which NUMERIC keeps exactly.
+    """
+    return None if value is None else Decimal(str(value))
+
+class MemorySession:
+    """Data access against MemoryRepository, undone on rollback.
+
+    Every mutation records how to reverse itself, so a failed transaction
+    leaves the indexes exactly as it found them. Quantities are Decimals,
+    like the NUMERIC columns, so both backends round alike.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.undo = []
+
+    def _now(self):
+        return datetime.now(ZoneInfo("UTC"))
+
+    # Inventory
+    def item_choices(self):
+        return [(item_number, item["name"]) for item_number, item in sorted(self.store.items.items())]
+
+    def lot_rows(self):
+        return [
+            tuple(self.store.lots[key][column] for column in LOT_COLUMNS)
+            for key in sorted(self.store.lots)
+        ]
+
+    def lot(self, item_number, lot):
+        row = self.store.lots.get((item_number, lot))
+        if not row:
+            return None
+        return (row["quantity"], row["unit"], row["name"], row["supplier"], row["exp"])
+
+    def item_lookup(self, item_number):
+        lots = self.lots(item_number)
+        if not lots:
+            return None
+        row = self.store.lots[(item_number, lots[0])]
+        return (item_number, row["name"], row["unit"], row["supplier"], row["exp"])
+
+    def lots(self, item_number):
+        return sorted(self.store.lots_by_item.get(item_number, ()))
+
+    def lot_lookup(self, item_number, lot):
+        row = self.store.lots.get((item_number, lot))
+        return (row["quantity"], row["unit"]) if row else None
+
+    def lot_allocations(self, item_numbers, lots=None):
+        allocated = {(item_number, lot): total for item_number, lot, total in self.allocated_by_lot()}
+        rows = []
+        for item_number in sorted(item_numbers):
+            for lot in self.lots(item_number):
+                if lots is not None and lot not in lots:
+                    continue
+                row = self.store.lots[(item_number, lot)]
+                rows.append((
+                    item_number, row["name"], row["unit"], row["supplier"], row["exp"],
+                    lot, row["quantity"], allocated.get((item_number, lot), Decimal(0)),
+                ))
+        return rows
+
+    def _ensure_item(self, item_number, name=None, unit=None, supplier=None):
+        items = self.store.items
+        previous = items.get(item_number)
+        if previous is None:
+            items[item_number] = {"name": name or None, "unit": unit, "supplier": supplier or None}
+            self.undo.append(lambda: items.pop(item_number))
+        else:
+            items[item_number] = {
+                "name": name or previous["name"],
+                "unit": previous["unit"] or unit,
+                "supplier": supplier or previous["supplier"],
+            }
+            self.undo.append(lambda: items.__setitem__(item_number, previous))
+
+    def _write_lot(self, key, row):
+        lots = self.store.lots
+        by_item = self.store.lots_by_item
+        previous = lots.get(key)
+        lots[key] = row
+        by_item.setdefault(key[0], set()).add(key[1])
+        if previous is None:
+            self.undo.append(lambda: (lots.pop(key), by_item[key[0]].discard(key[1])))
+        else:
+            self.undo.append(lambda: lots.__setitem__(key, previous))
+
+    def _log_movement(self, item_number, lot, change, remaining, unit, action_type, username):
+        entry = {
+            "id": next(self.store.history_ids),
+            "item_number": item_number,
+            "lot": lot,
+            "change": change,
+            "remaining": remaining,
+            "unit": unit,
+            "action_type": action_type,
+            "username": username,
+            "timestamp": self._now(),
+        }
+        self.store.history.append(entry)
+        self.store.history_by_item.setdefault(item_number, []).append(entry)
+        self.undo.append(lambda: (self.store.history.pop(), self.store.history_by_item[item_number].pop()))
+
+    def add_stock(self, item_number, name, quantity, unit, lot, supplier, exp, username):
+        self._ensure_item(item_number, name, unit, supplier)
+        key = (item_number, lot)
+        previous = self.store.lots.get(key)
+        amount = _numeric(quantity)
+        remaining = (previous["quantity"] if previous else 0) + amount
+        self._write_lot(key, {
+            "item_number": item_number, "name": name, "unit": unit, "supplier": supplier,
+            "exp": exp, "lot": lot, "quantity": remaining,
+        })
+        self._log_movement(item_number, lot, amount, remaining, unit, "ADD", username)
+        return remaining
+
+    def remove_stock(self, item_number, lot, quantity, username):
+        key = (item_number, lot)
+        row = self.store.lots.get(key)
+        amount = _numeric(quantity)
+        if not row or (row["quantity"] or 0) < amount:
+            return None
+        remaining = (row["quantity"] or 0) - amount
+        self._write_lot(key, dict(row, quantity=remaining))
+        self._log_movement(item_number, lot, -amount, remaining, row["unit"], "REMOVE", username)
+        return (float(remaining), row["unit"], row["name"], row["supplier"], row["exp"])
+
+    def set_stock(self, item_number, lot, quantity, unit, action_type, username):
+        key = (item_number, lot)
+        row = self.store.lots.get(key)
+        if not row:
+            return None
+        change = quantity - float(row["quantity"] or 0)
+        self._write_lot(key, dict(row, quantity=_numeric(quantity), unit=unit))
+        self._log_movement(item_number, lot, _numeric(change), _numeric(quantity), unit, action_type, username)
+        return change
+
+    def low_stock(self, item_numbers=None):
+        """Default unit thresholds only; per-item overrides live in Postgres."""
+        registry = unit_registry()
+        stock = {}
+        wanted = item_numbers if item_numbers is not None else list(self.store.lots_by_item)
+        for item_number in wanted:
+            for lot in self.store.lots_by_item.get(item_number, ()):
+                row = self.store.lots[(item_number, lot)]
+                canonical_unit, factor, threshold = registry.get(
+                    normalize_unit_name(row["unit"]), (normalize_unit_name(row["unit"]), 1.0, None)
+                )
+                entry = stock.setdefault((item_number, canonical_unit), {
+                    "on_hand": 0.0,
+                    "threshold": threshold if threshold is not None else LOW_STOCK_THRESHOLD * factor,
+                })
+                entry["on_hand"] += float(row["quantity"] or 0) * factor
+        allocated = {}
+        for row in self.store.ingredients.values():
+            if row["stage"] == "Allocated":
+                canonical_unit, factor, _ = registry.get(
+                    normalize_unit_name(row["unit"]), (normalize_unit_name(row["unit"]), 1.0, None)
+                )
+                key = (row["item_number"], canonical_unit)
+                allocated[key] = allocated.get(key, 0.0) + float(row["quantity"]) * factor
+        low = []
+        for (item_number, canonical_unit), entry in stock.items():
+            entry["allocated"] = allocated.get((item_number, canonical_unit), 0.0)
+            entry["available"] = entry["on_hand"] - entry["allocated"]
+            if entry["available"] < entry["threshold"]:
+                item = self.store.items.get(item_number, {})
+                low.append({
+                    "item_number": item_number,
+                    "name": item.get("name"),
+                    "supplier": item.get("supplier"),
+                    "unit": canonical_unit,
+                    "on_hand": entry["on_hand"],
+                    "allocated": entry["allocated"],
+                    "available": entry["available"],
+                    "threshold": entry["threshold"],
+                    "custom_threshold": False,
+                })
+        low.sort(key=lambda item: (item["available"] / item["threshold"] if item["threshold"] else 0, item["item_number"]))
+        return low
+
+    # History
+    def _history_row(self, entry):
+        item = self.store.items.get(entry["item_number"], {})
+        return (
+            entry["id"], entry["item_number"], entry["lot"], entry["change"], entry["remaining"],
+            entry["unit"], entry["action_type"], entry["username"], entry["timestamp"], item.get("name"),
+        )
+
+    def item_history(self, item_number):
+        return [self._history_row(entry) for entry in reversed(self.store.history_by_item.get(item_number, []))]
+
+    # Projects
+    def products(self):
+        return []
+
+    def create_project(self, fields):
+        project_id = next(self.store.project_ids)
+        project = dict.fromkeys(ACTIVE_PROJECT_COLUMNS + COMPLETED_PROJECT_COLUMNS)
+        project.update(status="Pending", completed_bags=0, created_at=self._now())
+        project.update(fields, id=project_id)
+        self.store.projects[project_id] = project
+        self.undo.append(lambda: self.store.projects.pop(project_id))
+        return project_id
+
+    def project_name(self, project_id):
+        project = self.store.projects.get(project_id)
+        return project["name"] if project else None
+
+    def update_project(self, project_id, fields):
+        project = self.store.projects.get(project_id)
+        if project is None:
+            return
+        previous = dict(project)
+        project.update(fields)
+        self.undo.append(lambda: project.update(previous))
+
+    def delete_project(self, project_id):
+        project = self.store.projects.pop(project_id, None)
+        if project is not None:
+            self.undo.append(lambda: self.store.projects.__setitem__(project_id, project))
+        ingredients = self.store.ingredients
+        for ingredient_id in [key for key, row in ingredients.items() if row["project_id"] == project_id]:
+            row = ingredients.pop(ingredient_id)
+            self.undo.append(lambda ingredient_id=ingredient_id, row=row: ingredients.__setitem__(ingredient_id, row))
+        mark_data_changed("inventory")
+
+    # Project ingredients
+    def project_summary(self, project_id):
+        project = self.store.projects.get(project_id)
+        return (project_id, project["name"], project["customer_name"]) if project else None
+
+    def project_ingredients(self, project_id):
+        return [
+            (
+                ingredient_id, row["item_number"], self.store.items.get(row["item_number"], {}).get("name"),
+                row["quantity"], row["unit"], row["lot"], row["stage"], row["notes"],
+            )
+            for ingredient_id, row in sorted(self.store.ingredients.items())
+            if row["project_id"] == project_id
+        ]
+
+    def allocated_by_lot(self):
+        totals = {}
+        for row in self.store.ingredients.values():
+            if row["stage"] == "Allocated" and row["lot"] is not None:
+                key = (row["item_number"], row["lot"])
+                totals[key] = totals.get(key, 0) + row["quantity"]
+        return [key + (allocated,) for key, allocated in sorted(totals.items())]
+
+    def add_ingredient(self, project_id, item_number, item_name, quantity, unit, lot, stage, notes):
+        if item_number not in self.store.items:
+            self._ensure_item(item_number, item_name, unit)
+        ingredient_id = next(self.store.ingredient_ids)
+        self.store.ingredients[ingredient_id] = {
+            "project_id": project_id, "item_number": item_number, "lot": lot,
+            "quantity": _numeric(quantity), "unit": unit, "stage": stage, "notes": notes or None,
+        }
+        self.undo.append(lambda: self.store.ingredients.pop(ingredient_id))
+
+    def ingredient_for_use(self, project_id, ingredient_id):
+        row = self.store.ingredients.get(ingredient_id)
+        if not row or row["project_id"] != project_id:
+            return None
+        return (row["item_number"], row["lot"], row["quantity"], row["unit"], row["stage"])
+
+    def mark_ingredient_used(self, ingredient_id):
+        row = self.store.ingredients[ingredient_id]
+        previous = row["stage"]
+        row["stage"] = "Used"
+        self.undo.append(lambda: row.__setitem__("stage", previous))
+
+    def active_projects(self):
+        active = [p for p in self.store.projects.values() if p["status"] != "Completed"]
+        active.sort(key=lambda p: (p["due_date"] is None, p["due_date"] or date.min, p["created_at"]))
+        return [tuple(p[column] for column in ACTIVE_PROJECT_COLUMNS) for p in active]
+
+    def project_counts(self):
+        total = len(self.store.projects)
+        completed = sum(1 for p in self.store.projects.values() if p["status"] == "Completed")
+        return total, total - completed, completed
+
+    def completed_projects(self, customer=None, date_from=None, date_to=None, before=None, limit=COMPLETED_PAGE_SIZE):
+        def sort_key(project):
+            return (project["completed_on"] or date.min, project["id"])
+
+        page = []
+        for project in self.store.projects.values():
+            if project["status"] != "Completed":
+                continue
+            if customer and project["customer_name"] != customer:
+                continue
+            if date_from and (project["completed_on"] or date.min) < date_from:
+                continue
+            if date_to and (project["completed_on"] is None or project["completed_on"] > date_to):
+                continue
+            if before and sort_key(project) >= (before[0] or date.min, before[1]):
+                continue
+            page.append(project)
+        page.sort(key=sort_key, reverse=True)
+        return [tuple(p[column] for column in COMPLETED_PROJECT_COLUMNS) for p in page[:limit]]
+
+    def completed_customers(self):
+        return sorted({
+            p["customer_name"] for p in self.store.projects.values()
+            if p["status"] == "Completed" and p["customer_name"]
+        })
+
+    # Dashboard history
+    def log_event(self, message, username=None):
+        self.store.dashboard_history.append((message, username, self._now()))
+        self.undo.append(self.store.dashboard_history.pop)
+        mark_data_changed("projects")
+
+    def recent_events(self, limit=50):
+        return list(reversed(self.store.dashboard_history[-limit:]))
+
+class MemoryRepository:
+    """Process-local backend with the Postgres backend's ordering and upsert rules.
+
+    Lots are keyed by (item_number, lot) with a per-item lot index, and
+    history keeps a per-item list, so lookups never scan the whole store.
+    Transactions are serialized by one lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.items = {}
+        self.lots = {}
+        self.lots_by_item = {}
+        self.history = []
+        self.history_by_item = {}
+        self.history_ids = itertools.count(1)
+        self.projects = {}
+        self.project_ids = itertools.count(1)
+        self.ingredients = {}
+        self.ingredient_ids = itertools.count(1)
+        self.dashboard_history = []
+
+    @contextmanager
+    def transaction(self, read_only=False):
+        with self.lock:
+            session = MemorySession(self)
+            try:
+                yield session
+            except BaseException:
+                for undo in reversed(session.undo):
+                    undo()
+                raise
+
+    def stream_lots(self, search_term, column, descending):
+        with self.lock:
+            rows = [dict(row) for row in self.lots.values()]
+        if search_term:
+            needle = search_term.casefold()
+            rows = [
+                row for row in rows
+                if needle in row["item_number"].casefold() or needle in (row["name"] or "").casefold()
+            ]
+        rows.sort(key=lambda row: row["lot"])
+        # Stable sorts keep the lot order; NULLs sort last ascending, first descending.
+        rows.sort(key=lambda row: (row[column] is None, row[column] or ""), reverse=descending)
+        return (
+            (row["item_number"], row["name"], row["quantity"], row["unit"], row["lot"], row["supplier"], row["exp"])
+            for row in rows
+        )
+
+    def stream_history(self):
+        with self.lock:
+            entries = list(reversed(self.history))
+        session = MemorySession(self)
+        return (session._history_row(entry) for entry in entries)
+
+repository = MemoryRepository() if REPOSITORY_BACKEND == "memory" else PostgresRepository()
+
+
+@app.cli.command("bench-memory")
+@click.option("--requests", "request_count", default=2000, help="Request rounds to replay.")
+@click.option("--lots", default=200, help="Lots to seed before replaying.")
+@click.option("--profile", "profile_path", default=None, help="Write cProfile stats to this file.")
+def bench_memory_command(request_count, lots, profile_path):
+    """Replay stock movements and page views against the in-memory repository.
+
+    Needs REPOSITORY_BACKEND=memory; no database is touched, so the numbers
+    are the cost of the Python request path alone.
+    """
+    if REPOSITORY_BACKEND != "memory":
+        raise click.ClickException("Set REPOSITORY_BACKEND=memory to benchmark without a database.")
+
+    with repository.transaction() as tx:
+        for n in range(lots):
+            tx.add_stock(f"BENCH-{n % 20}", f"Bench item {n % 20}", 1000.0, "kg", f"LOT{n}", "Bench", "", "bench@localhost")
+    client = app.test_client()
+    with client.session_transaction() as bench_session:
+        bench_session["user"] = "bench@localhost"
+
+    def replay():
+        for n in range(request_count):
+            lot = f"LOT{n % lots}"
+            item_number = f"BENCH-{n % lots % 20}"
+            client.post("/add", data={"item_number": item_number, "name": "", "quantity": "2", "unit": "kg", "lot": lot, "supplier": "Bench", "exp": ""})
+            client.post("/remove", data={"item_number": item_number, "lot": lot, "quantity": "1"})
+            client.get("/current")
+            client.get(f"/history?search={item_number}")
+            client.get("/dashboard")
+
+    profiler = cProfile.Profile() if profile_path else None
+    started = time.perf_counter()
+    if profiler:
+        profiler.runcall(replay)
+    else:
+        replay()
+    elapsed = time.perf_counter() - started
+    total = request_count * 5
+    click.echo(f"{total} requests in {elapsed:.2f}s ({total / elapsed:.0f} requests/s)")
+    if profiler:
+        profiler.dump_stats(profile_path)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+
+
+# -------------------------
+# BACKGROUND JOBS
+# -------------------------
+# Slow work is queued in the jobs table and run by `flask worker`, so a
+# request only inserts a row and answers with the job id. Workers claim rows
+# with FOR UPDATE SKIP LOCKED; a per-type advisory lock held while claiming
+# keeps the count of running jobs of each type under its limit.
+JOB_TYPES = {}
+
+class JobError(Exception):
+    """A job failure that retrying cannot fix, such as a malformed import."""
+
+def job_handler(job_type, label, concurrency=1):
+    """Register a handler that receives a JobContext and returns a summary message."""
+    def register(function):
+        JOB_TYPES[job_type] = {"run": function, "label": label, "concurrency": concurrency}
+        return function
+    return register
+
+def enqueue_job(cursor, job_type, params=None, username=None, max_attempts=JOB_MAX_ATTEMPTS):
+    """Queue a job in the caller's transaction and wake a worker once it commits."""
+    if job_type not in JOB_TYPES:
+        raise ValueError(f"Unknown job type: {job_type}")
+    cursor.execute(
+        """
+        INSERT INTO jobs (job_type, params, created_by, max_attempts)
+        VALUES (%s, %s, %s, %s)
+        RETURNING id
+        """,
+        (job_type, json.dumps(params or {}), username, max_attempts),
+    )
+    job_id = cursor.fetchone()[0]
+    cursor.execute("SELECT pg_notify(%s, %s)", (JOB_CHANNEL, job_type))
+    return job_id
+
+JOB_COLUMNS = (
+    "id", "job_type", "params", "status", "progress_done", "progress_total", "message",
+    "attempts", "max_attempts", "run_after", "worker", "result_path", "error",
+    "created_by", "created_at", "started_at", "finished_at",
+)
+
+def _job_dict(row):
+    job = dict(zip(JOB_COLUMNS, row))
+    job["label"] = JOB_TYPES.get(job["job_type"], {}).get("label", job["job_type"])
+    job["finished"] = job["status"] in ("succeeded", "failed")
+    job["percent"] = (
+        min(100, round(100 * job["progress_done"] / job["progress_total"]))
+        if job["progress_total"] else None
+    )
+    return job
+
+def _remove_job_upload(params):
+    """Delete a job's uploaded input once the job has reached a final state."""
+    path = params.get("path")
+    if not path or os.path.dirname(os.path.abspath(path)) != os.path.abspath(JOB_UPLOAD_DIR):
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as exc:
+        app.logger.warning("Could not remove job upload %s: %s", path, exc)
+
+def _reap_stale_jobs(cursor):
+    """Requeue jobs whose worker stopped sending heartbeats."""
+    cursor.execute(
+        """
+        UPDATE jobs
+        SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+            finished_at = CASE WHEN attempts >= max_attempts THEN CURRENT_TIMESTAMP END,
+            error = 'Worker ' || COALESCE(worker, '?') || ' stopped responding',
+            worker = NULL
+        WHERE status = 'running'
+          AND heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+        RETURNING status, params
+        """,
+        (JOB_STALE_SECONDS,),
+    )
+    for status, params in cursor.fetchall():
+        if status == "failed":
+            _remove_job_upload(params)
+
+def claim_job(conn, worker_name):
+    """Mark one runnable job as running by worker_name and return it, or None."""
+    c = conn.cursor()
+    _reap_stale_jobs(c)
+    c.execute(
+        "SELECT DISTINCT job_type FROM jobs WHERE status = 'queued' AND run_after <= CURRENT_TIMESTAMP"
+    )
+    ready = [row[0] for row in c.fetchall() if row[0] in JOB_TYPES]
+    conn.commit()
+    random.shuffle(ready)
+
+    for job_type in ready:
+        # A worker already claiming this type holds the lock; try the next type.
+        c.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s))", (f"{JOB_CHANNEL}:{job_type}",))
+        if not c.fetchone()[0]:
+            conn.rollback()
+            continue
+        c.execute("SELECT COUNT(*) FROM jobs WHERE job_type = %s AND status = 'running'", (job_type,))
+        if c.fetchone()[0] >= JOB_TYPES[job_type]["concurrency"]:
+            conn.rollback()
+            continue
+        c.execute(
+            """
+            UPDATE jobs
+            SET status = 'running',
+                attempts = attempts + 1,
+                worker = %s,
+                started_at = CURRENT_TIMESTAMP,
+                heartbeat_at = CURRENT_TIMESTAMP,
+                error = NULL
+            WHERE id = (
+                SELECT id FROM jobs
+                WHERE job_type = %s AND status = 'queued' AND run_after <= CURRENT_TIMESTAMP
+                ORDER BY run_after, id
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING id, job_type, params, attempts, max_attempts, created_by
+            """,
+            (worker_name, job_type),
+        )
+        row = c.fetchone()
+        conn.commit()
+        if row:
+            return row
+    return None
+
+class JobContext:
+    """What a handler sees of its job: parameters, progress reporting and a result file."""
+
+    def __init__(self, worker, job_id, job_type, params, username):
+        self.worker = worker
+        self.id = job_id
+        self.job_type = job_type
+        self.params = params
+        self.username = username
+        self.result_path = None
+        self._reported_at = 0.0
+
+    def progress(self, done, total=None, message=None, force=False):
+        """Record progress, at most once a second unless forced."""
+        now = time.monotonic()
+        if not force and now - self._reported_at < 1:
+            return
+        self._reported_at = now
+        self.worker.execute(
+            """
+            UPDATE jobs
+            SET progress_done = %s,
+                progress_total = COALESCE(%s, progress_total),
+                message = COALESCE(%s, message),
+                heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND worker = %s
+            """,
+            (done, total, message, self.id, self.worker.name),
+        )
+
+    def apply_once(self, cursor):
+        """Claim this job's writes in the handler's transaction; False if an earlier attempt committed them.
+
+        A concurrent attempt waits on the first one's uncommitted row and then sees it.
+        """
+        cursor.execute("INSERT INTO job_applied (job_id) VALUES (%s) ON CONFLICT (job_id) DO NOTHING", (self.id,))
+        return cursor.rowcount == 1
+
+    def result_file(self, extension):
+        """Path for the handler to write its result to; it is published only on success."""
+        os.makedirs(JOB_RESULTS_DIR, exist_ok=True)
+        self.result_path = os.path.join(JOB_RESULTS_DIR, f"job-{self.id}-{self.job_type}.{extension}")
+        return f"{self.result_path}.part"
+
+class JobWorker:
+    """One worker process: claims jobs, runs them and keeps their heartbeat fresh.
+
+    The queue connection is idle while a handler runs on its own connection,
+    so progress and heartbeat updates share it under a lock.
+    """
+
+    def __init__(self, name, stop):
+        self.name = name
+        self.stop = stop
+        self.lock = threading.Lock()
+        self.conn = _connect_primary()
+        self.current_job = None
+        with self.lock, self.conn.cursor() as cursor:
+            cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(JOB_CHANNEL)))
+            self.conn.commit()
+
+    def execute(self, query, params):
+        with self.lock, self.conn.cursor() as cursor:
+            cursor.execute(query, params)
+            self.conn.commit()
+
+    def _heartbeat(self):
+        while not self.stop.wait(JOB_HEARTBEAT_SECONDS):
+            job_id = self.current_job
+            if job_id is None:
+                continue
+            try:
+                self.execute(
+                    "UPDATE jobs SET heartbeat_at = CURRENT_TIMESTAMP WHERE id = %s AND worker = %s",
+                    (job_id, self.name),
+                )
+            except psycopg2.Error as exc:
+                app.logger.warning("Job heartbeat failed for job %s: %s", job_id, exc)
+
+    def run(self, burst=False):
+        threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True).start()
+        while not self.stop.is_set():
+            with self.lock:
+                job = claim_job(self.conn, self.name)
+                del self.conn.notifies[:]
+            if job:
+                self.run_job(*job)
+                continue
+            if burst:
+                return
+            # Sleep until a job is queued, or poll again for retries coming
+            # due; wake every second to notice a shutdown.
+            deadline = time.monotonic() + JOB_POLL_SECONDS
+            while not self.stop.is_set() and time.monotonic() < deadline:
+                if select.select([self.conn], [], [], 1) != ([], [], []):
+                    with self.lock:
+                        self.conn.poll()
+                        del self.conn.notifies[:]
+                    break
+
+    def run_job(self, job_id, job_type, params, attempts, max_attempts, username):
+        context = JobContext(self, job_id, job_type, params, username)
+        self.current_job = job_id
+        app.logger.info("Job %s (%s) started by %s, attempt %s", job_id, job_type, self.name, attempts)
+        try:
+            # Handlers commit on their own connections; cache bumps wait for that.
+            with deferred_cache_bumps():
+                message = JOB_TYPES[job_type]["run"](context)
+        except Exception as exc:
+            if context.result_path and os.path.exists(f"{context.result_path}.part"):
+                os.remove(f"{context.result_path}.part")
+            retry = attempts < max_attempts and not isinstance(exc, JobError)
+            if not retry:
+                _remove_job_upload(params)
+            if isinstance(exc, JobError):
+                app.logger.warning("Job %s (%s) failed: %s", job_id, job_type, exc)
+            else:
+                app.logger.exception("Job %s (%s) failed on attempt %s", job_id, job_type, attempts)
+            # Back off 1x, 2x, 4x ... JOB_RETRY_SECONDS between attempts.
+            self.execute(
+                """
+                UPDATE jobs
+                SET status = %s,
+                    error = %s,
+                    run_after = CURRENT_TIMESTAMP + make_interval(secs => %s),
+                    finished_at = CASE WHEN %s THEN NULL ELSE CURRENT_TIMESTAMP END,
+                    worker = NULL
+                WHERE id = %s AND worker = %s
+                """,
+                (
+                    "queued" if retry else "failed",
+                    str(exc) or exc.__class__.__name__,
+                    JOB_RETRY_SECONDS * 2 ** (attempts - 1),
+                    retry,
+                    job_id,
+                    self.name,
+                ),
+            )
+        else:
+            _remove_job_upload(params)
+            if context.result_path:
+                os.replace(f"{context.result_path}.part", context.result_path)
+            self.execute(
+                """
+                UPDATE jobs
+                SET status = 'succeeded',
+                    message = COALESCE(%s, message),
+                    progress_done = COALESCE(progress_total, progress_done),
+                    result_path = %s,
+                    finished_at = CURRENT_TIMESTAMP
+                WHERE id = %s AND worker = %s
+                """,
+                (message, context.result_path, job_id, self.name),
+            )
+            app.logger.info("Job %s (%s) succeeded: %s", job_id, job_type, message)
+        finally:
+            self.current_job = None
+
+def _job_worker_process(index, stop, burst):
+    # The parent decides when to stop; a job in progress is finished first.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    worker = JobWorker(f"{socket.gethostname()}:{os.getpid()}:{index}", stop)
+    try:
+        worker.run(burst=burst)
+    finally:
+        worker.conn.close()
+
+@app.cli.command("worker")
+@click.option("--processes", default=JOB_WORKERS, help="Worker processes to run.")
+@click.option("--burst", is_flag=True, help="Exit once no job is runnable.")
+def worker_command(processes, burst):
+    """Run background jobs from the queue until interrupted."""
+    os.makedirs(JOB_RESULTS_DIR, exist_ok=True)
+    context = multiprocessing.get_context("fork")
+    stop = context.Event()
+    workers = [
+        context.Process(target=_job_worker_process, args=(index, stop, burst), name=f"job-worker-{index}")
+        for index in range(processes)
+    ]
+    for process in workers:
+        process.start()
+    click.echo(f"{processes} job worker(s) running; results in {JOB_RESULTS_DIR}")
+
+    def shutdown(*_):
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    try:
+        for process in workers:
+            process.join()
+    except KeyboardInterrupt:
+        click.echo("Stopping after the jobs in progress...")
+        stop.set()
+        for process in workers:
+            process.join()
+
+@app.cli.command("enqueue")
+@click.argument("job_type")
+@click.option("--param", "params", multiple=True, help="key=value parameter, repeatable.")
+def enqueue_command(job_type, params):
+    """Queue a job, e.g. from cron: flask enqueue refresh_forecasts"""
+    if job_type not in JOB_TYPES:
+        raise click.ClickException(f"Job types: {', '.join(sorted(JOB_TYPES))}")
+    conn = connect_db()
+    c = conn.cursor()
+    job_id = enqueue_job(c, job_type, dict(param.split("=", 1) for param in params), "cli")
+    conn.commit()
+    conn.close()
+    click.echo(f"queued job {job_id}")
+
+def _write_csv_rows(context, path, header, conn, count_query, query, params=()):
+    """Stream a query to a CSV file, reporting progress against its row count."""
+    try:
+        count_cursor = conn.cursor()
+        count_cursor.execute(count_query, params)
+        total = count_cursor.fetchone()[0]
+        count_cursor.close()
+        context.progress(0, total, "Exporting", force=True)
+        with open(path, "w", newline="", encoding="utf-8") as handle:
+            writer = csv.writer(handle)
+            writer.writerow(header)
+            for done, row in enumerate(stream_rows(query, params, name="job_export", conn=conn), 1):
+                writer.writerow(row)
+                context.progress(done)
+    finally:
+        conn.close()
+    return total
+
+@job_handler("export_inventory", "Inventory export", concurrency=2)
+def export_inventory_job(context):
+    # One REPEATABLE READ snapshot so the count matches the rows exported.
+    conn = _connect_primary()
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    total = _write_csv_rows(
+        context,
+        context.result_file("csv"),
+        LOT_COLUMNS,
+        conn,
+        "SELECT COUNT(*) FROM inventory",
+        f"SELECT {', '.join(LOT_COLUMNS)} FROM inventory ORDER BY item_number, lot",
+    )
+    return f"Exported {total} lot(s)"
+
+@job_handler("export_history", "History export", concurrency=2)
+def export_history_job(context):
+    start = context.params.get("start") or None
+    end = context.params.get("end") or None
+    conn = _connect_primary()
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    where = """
+        WHERE (%(start)s::date IS NULL OR h.timestamp >= (%(start)s::date)::timestamp AT TIME ZONE %(zone)s)
+          AND (%(end)s::date IS NULL OR h.timestamp < (%(end)s::date + 1)::timestamp AT TIME ZONE %(zone)s)
+    """
+    total = _write_csv_rows(
+        context,
+        context.result_file("csv"),
+        ("id", "item_number", "lot", "change", "remaining", "unit", "action_type", "username", "timestamp", "name"),
+        conn,
+        "SELECT COUNT(*) FROM history h " + where,
+        HISTORY_SELECT + where + " ORDER BY h.id",
+        {"start": start, "end": end, "zone": str(PST_ZONE)},
+    )
+    return f"Exported {total} history row(s)"
+
+IMPORT_COLUMNS = ("item_number", "name", "quantity", "unit", "lot", "supplier", "exp")
+
+@job_handler("import_stock", "Stock import")
+def import_stock_job(context):
+    """Add every row of an uploaded CSV as stock in one transaction, once per job."""
+    conn = _connect_primary()
+    try:
+        tx = PostgresSession(conn)
+        # Checked before the upload: a successful attempt may already have removed it.
+        if not context.apply_once(tx.cursor):
+            conn.rollback()
+            return "Already imported by an earlier attempt"
+        rows = _read_stock_import(context.params["path"])
+        context.progress(0, len(rows), "Importing", force=True)
+        for done, fields in enumerate(rows, 1):
+            tx.add_stock(
+                fields["item_number"], fields["name"], fields["quantity"], fields["unit"],
+                fields["lot"], fields["supplier"], fields["exp"], context.username,
+            )
+            context.progress(done)
+        tx.log_event(f"Imported {len(rows)} stock row(s) from {context.params.get('filename', 'CSV')}", context.username)
+        conn.commit()
+    finally:
+        conn.close()
+    mark_data_changed("inventory")
+    return f"Imported {len(rows)} row(s)"
+
+def _read_stock_import(path):
+    rows = []
+    errors = []
+    if not os.path.exists(path):
+        raise JobError("The uploaded file is no longer available; upload it again.")
+    with open(path, newline="", encoding="utf-8-sig") as handle:
+        reader = csv.DictReader(handle)
+        missing = [column for column in ("item_number", "quantity", "unit", "lot") if column not in (reader.fieldnames or ())]
+        if missing:
+            raise JobError(f"Missing column(s): {', '.join(missing)}")
+        for line, row in enumerate(reader, 2):
+            fields = {column: (row.get(column) or "").strip() for column in IMPORT_COLUMNS}
+            try:
+                fields["quantity"] = float(fields["quantity"])
+            except ValueError:
+                errors.append(f"line {line}: quantity must be a number")
+                continue
+            if not fields["item_number"] or not fields["lot"] or not fields["unit"] or fields["quantity"] <= 0:
+                errors.append(f"line {line}: item_number, lot, unit and a positive quantity are required")
+                continue
+            rows.append(fields)
+    if errors:
+        raise JobError("; ".join(errors[:10]) + (f" (and {len(errors) - 10} more)" if len(errors) > 10 else ""))
+    return rows
+
+@job_handler("reconcile_stocktake", "Stocktake reconciliation")
+def reconcile_stocktake_job(context):
+    stocktake_id = int(context.params["stocktake_id"])
+    conn = _connect_primary()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT status FROM stocktakes WHERE id = %s FOR UPDATE", (stocktake_id,))
+        row = c.fetchone()
+        if not row:
+            raise JobError(f"Stocktake #{stocktake_id} not found.")
+        if row[0] != "Open":
+            raise JobError(f"Stocktake #{stocktake_id} has already been reconciled.")
+        touched_items, skipped = reconcile_stocktake(c, stocktake_id, context.username)
+        low_items = evaluate_low_stock(c, touched_items) if touched_items else []
+        summary = f"{len(touched_items)} item(s) adjusted"
+        if skipped:
+            summary += (
+                f"; {len(skipped)} line(s) skipped because the lot is now counted in an incompatible unit: "
+                + ", ".join(skipped[:10]) + (f" (and {len(skipped) - 10} more)" if len(skipped) > 10 else "")
+            )
+        log_dashboard_event(c, f"Reconciled stocktake #{stocktake_id}: {summary}", context.username)
+        conn.commit()
+    finally:
+        conn.close()
+    send_low_stock_alerts(low_items, f"stocktake #{stocktake_id}", context.username)
+    return summary
+
+@job_handler("refresh_forecasts", "Forecast and rollup refresh")
+def refresh_forecasts_job(context):
+    conn = _connect_primary()
+    try:
+        c = conn.cursor()
+        refresh_movement_rollups(c)
+        conn.commit()
+        context.progress(1, 2, "Rollups refreshed", force=True)
+        refresh_forecasts(c)
+        conn.commit()
+    finally:
+        conn.close()
+    return "Forecasts refreshed"
+
+@job_handler("low_stock_scan", "Low stock alert scan")
+def low_stock_scan_job(context):
+    conn = _connect_primary()
+    try:
+        low_items = evaluate_low_stock(conn.cursor())
+    finally:
+        conn.close()
+    send_low_stock_alerts(low_items, "scheduled scan", context.username)
+    return f"{len(low_items)} item(s) below threshold"
+
+
+# -------------------------
+# ROUTES
+# -------------------------
+
+@app.route("/")
+def index():
+    if "user" not in session:
+        return redirect("/login")
+    return redirect("/dashboard")
+
+@app.route("/dashboard", methods=["GET", "POST"])
+@login_required
+@cached_page("projects")
+def dashboard():
+    if request.method == "POST":
+        action = request.form.get("action")
+
+        if action == "create":
+            name = request.form["name"].strip()
+            customer_name = request.form.get("customer_name", "").strip() or None
+            product = request.form.get("product", "").strip() or None
+            notes = request.form.get("description", "").strip()
+            due_date_str = request.form.get("due_date", "").strip()
+            bags_bottles = to_int_or_none(request.form.get("bags_bottles"))
+            gummies = to_int_or_none(request.form.get("gummies"))
+            quantity_unit = request.form.get("quantity_unit", "Bags")
+            storage_status = request.form.get("storage_status", "PPS")
+            completed_bags = to_int_or_none(request.form.get("completed_bags"))
+
+            if not name:
+                return "Project name is required."
+
+            due_date = None
+            if due_date_str:
+                try:
+                    due_date = datetime.strptime(due_date_str, "%Y-%m-%d").date()
+                except ValueError:
+                    return "Invalid due date format."
+
+            with repository.transaction() as tx:
+                tx.create_project(
+                    {
+                        "name": name,
+                        "customer_name": customer_name,
+                        "product": product,
+                        "description": notes,
+                        "due_date": due_date,
+                        "bags_bottles": bags_bottles,
+                        "gummies": gummies,
+                        "storage_status": storage_status,
+                        "quantity_unit": quantity_unit,
+                        "completed_bags": completed_bags,
+                    }
+                )
+                tx.log_event(
+                    f"Created project '{name}' targeting {bags_bottles or 0} {quantity_unit}, due {due_date or 'unspecified'}",
+                    session.get("user"),
+                )
+            return redirect("/dashboard")
+
+        if action == "update_status":
+            project_id = request.form.get("project_id")
+            status = request.form.get("status", "Pending")
+            completion_date_str = request.form.get("completion_date", "").strip()
             completion_date = None
             if completion_date_str:
                 try:
                     completion_date = datetime.strptime(completion_date_str, "%Y-%m-%d").date()
                 except ValueError:
-                    conn.close()
                     return "Invalid completion date."
 
             try:
                 project_id_int = int(project_id)
             except (TypeError, ValueError):
-                conn.close()
                 return "Invalid project id."
-            c.execute("SELECT name FROM projects WHERE id = %s", (project_id_int,))
-            project_row = c.fetchone()
-            project_name = project_row[0] if project_row else f"#{project_id_int}"
 
             completed_on_value = completion_date if status == "Completed" else None
-            c.execute(
-                """
-                UPDATE projects
-                SET status = %s,
-                    completed_on = %s
-                WHERE id = %s
-                """,
-                (status, completed_on_value, project_id_int),
-            )
-            log_dashboard_event(
-                c,
-                f"Marked project '{project_name}' as {status}",
-                session.get("user"),
-            )
-            conn.commit()
-            conn.close()
+            with repository.transaction() as tx:
+                project_name = tx.project_name(project_id_int) or f"#{project_id_int}"
+                tx.update_project(project_id_int, {"status": status, "completed_on": completed_on_value})
+                tx.log_event(f"Marked project '{project_name}' as {status}", session.get("user"))
             return redirect("/dashboard")
 
         if action == "edit":
             project_id = request.form.get("project_id")
             name = request.form.get("name", "").strip()
             customer_name = request.form.get("customer_name", "").strip() or None
+            product = request.form.get("product", "").strip() or None
             description = request.form.get("description", "").strip()
             bags_bottles = to_int_or_none(request.form.get("bags_bottles"))
             gummies = to_int_or_none(request.form.get("gummies"))
@@ -472,7 +4272,6 @@ def dashboard():
             completion_date_str = request.form.get("completion_date", "").strip()
 
             if not name:
-                conn.close()
                 return "Project name is required."
 
             due_date = None
@@ -480,7 +4279,6 @@ def dashboard():
                 try:
                     due_date = datetime.strptime(due_date_str, "%Y-%m-%d").date()
                 except ValueError:
-                    conn.close()
                     return "Invalid due date."
 
             completion_date = None
@@ -488,58 +4286,36 @@ def dashboard():
                 try:
                     completion_date = datetime.strptime(completion_date_str, "%Y-%m-%d").date()
                 except ValueError:
-                    conn.close()
                     return "Invalid completion date."
             completed_on_value = completion_date if status == "Completed" else None
 
             try:
                 project_id_int = int(project_id)
             except (TypeError, ValueError):
-                conn.close()
                 return "Invalid project id."
 
-            c.execute(
-                "SELECT name FROM projects WHERE id = %s",
-                (project_id_int,),
-            )
-            c.execute(
-                """
-                UPDATE projects
-                SET name = %s,
-                    customer_name = %s,
-                    description = %s,
-                    due_date = %s,
-                    bags_bottles = %s,
-                    gummies = %s,
-                    storage_status = %s,
-                    quantity_unit = %s,
-                    completed_bags = %s,
-                    status = %s,
-                    completed_on = %s
-                WHERE id = %s
-                """,
-                (
-                    name,
-                    customer_name,
-                    description,
-                    due_date,
-                    bags_bottles,
-                    gummies,
-                    storage_status,
-                    quantity_unit,
-                    completed_bags,
-                    status,
-                    completed_on_value,
-                    project_id_int,
-                ),
-            )
-            log_dashboard_event(
-                c,
-                f"Updated project '{name}': status {status}, quantity {bags_bottles or 0} {quantity_unit}, produced {completed_bags or 0}, due {due_date or 'N/A'}",
-                session.get("user"),
-            )
-            conn.commit()
-            conn.close()
+            with repository.transaction() as tx:
+                tx.update_project(
+                    project_id_int,
+                    {
+                        "name": name,
+                        "customer_name": customer_name,
+                        "product": product,
+                        "description": description,
+                        "due_date": due_date,
+                        "bags_bottles": bags_bottles,
+                        "gummies": gummies,
+                        "storage_status": storage_status,
+                        "quantity_unit": quantity_unit,
+                        "completed_bags": completed_bags,
+                        "status": status,
+                        "completed_on": completed_on_value,
+                    },
+                )
+                tx.log_event(
+                    f"Updated project '{name}': status {status}, quantity {bags_bottles or 0} {quantity_unit}, produced {completed_bags or 0}, due {due_date or 'N/A'}",
+                    session.get("user"),
+                )
             return redirect("/dashboard")
 
         if action == "delete":
@@ -547,39 +4323,19 @@ def dashboard():
             try:
                 project_id_int = int(project_id)
             except (TypeError, ValueError):
-                conn.close()
                 return "Invalid project id."
-            c.execute("SELECT name FROM projects WHERE id = %s", (project_id_int,))
-            project_row = c.fetchone()
-            project_name = project_row[0] if project_row else f"#{project_id_int}"
-            c.execute("DELETE FROM projects WHERE id = %s", (project_id_int,))
-            log_dashboard_event(c, f"Deleted project '{project_name}'", session.get("user"))
-            conn.commit()
-            conn.close()
+            with repository.transaction() as tx:
+                project_name = tx.project_name(project_id_int) or f"#{project_id_int}"
+                tx.delete_project(project_id_int)
+                tx.log_event(f"Deleted project '{project_name}'", session.get("user"))
             return redirect("/dashboard")
 
-    c.execute(
-        """
-        SELECT id, name, customer_name, description, due_date, status, bags_bottles, gummies, storage_status, quantity_unit, completed_bags, created_at
-        FROM projects
-        WHERE status <> 'Completed' OR status IS NULL
-        ORDER BY due_date NULLS LAST, created_at
-        """
-    )
-    active_rows = c.fetchall()
-
-    c.execute(
-        """
-        SELECT id, name, customer_name, description, due_date, status, bags_bottles, gummies, storage_status, quantity_unit, completed_bags, completed_on, created_at
-        FROM projects
-        WHERE status = 'Completed'
-        ORDER BY created_at DESC
-        """
-    )
-    completed_rows = c.fetchall()
-    conn.close()
+    with repository.transaction(read_only=True) as tx:
+        active_rows = tx.active_projects()
+        total, pending, completed = tx.project_counts()
+        products = tx.products()
 
-    def map_projects(rows, include_completed_fields=False):
+    def map_projects(rows):
         mapped = []
         for row in rows:
             due_raw = row[4]
@@ -608,42 +4364,59 @@ def dashboard():
                     "quantity_unit": row[9] or "Bags",
                     "completed_bags": completed,
                     "progress_percent": progress,
-                    "completed_on": row[11].strftime("%Y-%m-%d") if include_completed_fields and row[11] else None,
+                    "product": row[12],
                 }
             )
         return mapped
 
     active_projects = map_projects(active_rows)
-    completed_projects = map_projects(completed_rows, include_completed_fields=True)
 
     stats = {
-        "total": len(active_projects) + len(completed_projects),
-        "pending": len(active_projects),
-        "completed": len(completed_projects),
+        "total": total,
+        "pending": pending,
+        "completed": completed,
     }
 
     return render_template(
         "dashboard.html",
         projects=active_projects,
-        completed_projects=completed_projects,
         stats=stats,
+        products=products,
     )
 
 @app.route("/projects/completed")
 @login_required
 def completed_projects_view():
-    conn = connect_db()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT id, name, customer_name, description, due_date, status, bags_bottles, gummies, storage_status, quantity_unit, completed_bags, completed_on, created_at
-        FROM projects
-        WHERE status = 'Completed'
-        ORDER BY completed_on DESC NULLS LAST, created_at DESC
-        """
-    )
-    rows = c.fetchall()
-    conn.close()
+    customer = request.args.get("customer", "").strip()
+    date_from = request.args.get("from", "").strip()
+    date_to = request.args.get("to", "").strip()
+    before = request.args.get("before", "").strip()
+
+    try:
+        date_from = datetime.strptime(date_from, "%Y-%m-%d").date() if date_from else None
+        date_to = datetime.strptime(date_to, "%Y-%m-%d").date() if date_to else None
+    except ValueError:
+        return "Invalid date range."
+    if before:
+        before_date, _, before_id = before.rpartition("_")
+        try:
+            before_date = None if before_date == "-infinity" else datetime.strptime(before_date, "%Y-%m-%d").date()
+        except ValueError:
+            return "Invalid page cursor."
+        before_id = to_int_or_none(before_id)
+        if before_id is None:
+            return "Invalid page cursor."
+        before = (before_date, before_id)
+
+    with repository.transaction(read_only=True) as tx:
+        rows = tx.completed_projects(customer, date_from, date_to, before or None, COMPLETED_PAGE_SIZE + 1)
+        customers = tx.completed_customers()
+
+    next_cursor = None
+    if len(rows) > COMPLETED_PAGE_SIZE:
+        rows = rows[:COMPLETED_PAGE_SIZE]
+        last = rows[-1]
+        next_cursor = f"{last[11].strftime('%Y-%m-%d') if last[11] else '-infinity'}_{last[0]}"
 
     projects = []
     for row in rows:
@@ -664,23 +4437,24 @@ def completed_projects_view():
             }
         )
 
-    return render_template("completed_projects.html", completed_projects=projects)
+    return render_template(
+        "completed_projects.html",
+        completed_projects=projects,
+        customers=customers,
+        filters={
+            "customer": customer,
+            "from": date_from.isoformat() if date_from else "",
+            "to": date_to.isoformat() if date_to else "",
+        },
+        next_cursor=next_cursor,
+        first_page=not before,
+    )
 
 @app.route("/dashboard/history")
 @login_required
 def dashboard_history():
-    conn = connect_db()
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT message, username, created_at
-        FROM dashboard_history
-        ORDER BY created_at DESC
-        LIMIT 50
-        """
-    )
-    rows = c.fetchall()
-    conn.close()
+    with repository.transaction(read_only=True) as tx:
+        rows = tx.recent_events(50)
     entries = [
         {
             "message": row[0],
@@ -696,6 +4470,7 @@ def dashboard_history():
 def new_project():
     if request.method == "POST":
         name = request.form["name"].strip()
+        product = request.form.get("product", "").strip() or None
         notes = request.form.get("description", "").strip()
         due_date_str = request.form.get("due_date", "").strip()
         bags_bottles = to_int_or_none(request.form.get("bags_bottles"))
@@ -714,56 +4489,164 @@ def new_project():
             except ValueError:
                 return "Invalid due date format."
 
-        conn = connect_db()
-        c = conn.cursor()
-        c.execute(
-            """
-                INSERT INTO projects (name, description, due_date, bags_bottles, gummies, storage_status, quantity_unit, completed_bags)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (name, notes, due_date, bags_bottles, gummies, storage_status, quantity_unit, completed_bags),
+        with repository.transaction() as tx:
+            tx.create_project(
+                {
+                    "name": name,
+                    "product": product,
+                    "description": notes,
+                    "due_date": due_date,
+                    "bags_bottles": bags_bottles,
+                    "gummies": gummies,
+                    "storage_status": storage_status,
+                    "quantity_unit": quantity_unit,
+                    "completed_bags": completed_bags,
+                }
+            )
+            tx.log_event(
+                f"Created project '{name}' targeting {bags_bottles or 0} {quantity_unit}, due {due_date or 'unspecified'}",
+                session.get("user"),
             )
-        log_dashboard_event(
-            c,
-            f"Created project '{name}' targeting {bags_bottles or 0} {quantity_unit}, due {due_date or 'unspecified'}",
-            session.get("user"),
-        )
-        conn.commit()
-        conn.close()
         return redirect("/dashboard")
 
-    return render_template("add_project.html")
+    with repository.transaction(read_only=True) as tx:
+        products = tx.products()
+    return render_template("add_project.html", products=products)
+
+@app.route("/projects/<int:project_id>/ingredients", methods=["GET", "POST"])
+@login_required
+def project_ingredients(project_id):
+    if request.method == "POST":
+        action = request.form.get("action")
+
+        if action == "add":
+            item_number = request.form.get("item_number", "").strip()
+            unit = request.form.get("unit", "").strip()
+            lot = request.form.get("lot", "").strip() or None
+            stage = request.form.get("stage", "Allocated")
+            try:
+                quantity = float(request.form["quantity"])
+            except (KeyError, TypeError, ValueError):
+                return "ERROR: Quantity must be a number."
+            if not item_number or not unit or quantity <= 0:
+                return "ERROR: Item number, unit and a positive quantity are required."
+            if stage not in INGREDIENT_STAGES:
+                return "ERROR: Unknown ingredient stage."
+            if stage == "Used":
+                # Only the use action may mark an ingredient Used, since it draws the stock.
+                return "ERROR: Add the ingredient as Allocated, then use it."
+
+            with repository.transaction() as tx:
+                project_name = tx.project_name(project_id)
+                if project_name is None:
+                    return "ERROR: Project not found."
+                if lot:
+                    lot_row = tx.lot_lookup(item_number, lot)
+                    if not lot_row:
+                        return "ERROR: Lot does not exist."
+                    if canonical_unit_for(unit)[0] != canonical_unit_for(lot_row[1])[0]:
+                        return f"ERROR: Cannot allocate {unit} from a lot counted in {lot_row[1]}."
+                tx.add_ingredient(
+                    project_id, item_number, request.form.get("item_name", "").strip(), quantity, unit, lot, stage,
+                    request.form.get("notes", "").strip(),
+                )
+                tx.log_event(
+                    f"{stage} {quantity} {unit} of {item_number}{f' lot {lot}' if lot else ''} for project '{project_name}'",
+                    session.get("user"),
+                )
+            # Allocations change what /lookup reports as available.
+            mark_data_changed("inventory")
+            return redirect(f"/projects/{project_id}/ingredients")
+
+        if action == "use":
+            ingredient_id = to_int_or_none(request.form.get("ingredient_id"))
+            if ingredient_id is None:
+                return "ERROR: Invalid ingredient id."
+            # Drawing the allocation from its lot and marking it Used commit
+            # together, and the trace trigger records the consumption.
+            with repository.transaction() as tx:
+                project_name = tx.project_name(project_id)
+                if project_name is None:
+                    return "ERROR: Project not found."
+                ingredient = tx.ingredient_for_use(project_id, ingredient_id)
+                if not ingredient or ingredient[4] != "Allocated" or not ingredient[1]:
+                    return "ERROR: Only allocated ingredients with a lot can be used."
+                item_number, lot, quantity, unit, _ = ingredient
+                lot_row = tx.lot_lookup(item_number, lot)
+                if not lot_row:
+                    return "ERROR: Lot does not exist."
+                ingredient_unit, ingredient_factor = canonical_unit_for(unit)
+                lot_unit, lot_factor = canonical_unit_for(lot_row[1])
+                if ingredient_unit != lot_unit:
+                    return f"ERROR: Cannot take {unit} from a lot counted in {lot_row[1]}."
+                amount = float(quantity) * ingredient_factor / lot_factor
+                if not tx.remove_stock(item_number, lot, amount, session.get("user")):
+                    return f"ERROR: Cannot remove {amount} {lot_row[1]}. Not enough left in lot {lot}!"
+                tx.mark_ingredient_used(ingredient_id)
+                low_items = tx.low_stock([item_number])
+                tx.log_event(
+                    f"Used {quantity} {unit} of {item_number} lot {lot} for project '{project_name}'",
+                    session.get("user"),
+                )
+            mark_data_changed("inventory")
+            send_low_stock_alerts(low_items, lot, session.get("user"))
+            return redirect(f"/projects/{project_id}/ingredients")
+
+        return "ERROR: Unknown action."
+
+    with repository.transaction(read_only=True) as tx:
+        row = tx.project_summary(project_id)
+        if not row:
+            return "ERROR: Project not found."
+        ingredient_rows = tx.project_ingredients(project_id)
+        items = tx.item_choices()
+        lot_rows = tx.lot_rows()
+        allocations = tx.allocated_by_lot()
+
+    project = {"id": row[0], "name": row[1], "customer_name": row[2]}
+    ingredients = [
+        {
+            "id": ingredient_id,
+            "item_number": item_number,
+            "item_name": item_name,
+            "quantity": float(quantity),
+            "unit": unit,
+            "lot": lot,
+            "stage": stage,
+            "notes": notes,
+        }
+        for ingredient_id, item_number, item_name, quantity, unit, lot, stage, notes in ingredient_rows
+    ]
+    inventory_map = {}
+    for item_number, name, unit, _, _, lot, quantity in lot_rows:
+        entry = inventory_map.setdefault(item_number, {"name": name, "lots": {}})
+        entry["lots"][lot] = {"quantity": float(quantity or 0), "unit": unit}
+    allocated_map = {}
+    for item_number, lot, allocated in allocations:
+        allocated_map.setdefault(item_number, {})[lot] = float(allocated)
+
+    return render_template(
+        "project_ingredients.html",
+        project=project,
+        ingredients=ingredients,
+        items=items,
+        inventory_map=inventory_map,
+        allocated_map=allocated_map,
+    )
 
 @app.route("/current")
 @login_required
+@cached_page("inventory")
 def current_inventory():
-    conn = connect_db()
-    c = conn.cursor()
     order = request.args.get("sort", "item_number")
     direction = request.args.get("direction", "asc").lower()
     search_term = request.args.get("search", "").strip()
     valid_columns = {"item_number": "item_number", "name": "name"}
     column = valid_columns.get(order, "item_number")
     direction_sql = "DESC" if direction == "desc" else "ASC"
-    base_query = f"""
-        SELECT item_number, name, quantity, unit, lot, supplier, exp
-        FROM inventory
-    """
-    params = []
-    if search_term:
-        base_query += " WHERE item_number ILIKE %s OR name ILIKE %s"
-        like = f"%{search_term}%"
-        params.extend([like, like])
-    base_query += f" ORDER BY {column} {direction_sql}, lot"
-    if params:
-        c.execute(base_query, params)
-    else:
-        c.execute(base_query)
-    items = c.fetchall()
-    conn.close()
-    return render_template(
+    return stream_page(
         "current_inventory.html",
-        items=items,
+        items=repository.stream_lots(search_term, column, direction_sql == "DESC"),
         sort_column=column,
         sort_direction=direction_sql.lower(),
         search_term=search_term,
@@ -781,58 +4664,18 @@ def add_item():
         supplier = request.form.get("supplier") or ""
         exp = request.form["exp"]
 
-        conn = connect_db()
-        c = conn.cursor()
-
-        # insert into current inventory table (upsert by item + lot)
-        c.execute(
-            """
-            INSERT INTO inventory (item_number, name, quantity, unit, lot, supplier, exp)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT(item_number, lot)
-            DO UPDATE SET
-                name = excluded.name,
-                unit = excluded.unit,
-                supplier = excluded.supplier,
-                exp = excluded.exp,
-                quantity = inventory.quantity + excluded.quantity
-            """,
-            (item_number, name, quantity, unit, lot, supplier, exp),
-        )
-        c.execute(
-            """
-            SELECT quantity FROM inventory
-            WHERE item_number = %s AND lot = %s
-            """,
-            (item_number, lot),
-        )
-        remaining_row = c.fetchone()
-        remaining_qty = remaining_row[0] if remaining_row else quantity
-    
-        #inserts into history
-        c.execute("""
-        INSERT INTO history (item_number, lot, change, remaining, unit, action_type, username)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """, (item_number, lot, quantity, remaining_qty, unit, "ADD", session["user"]))
-
-        conn.commit()
-        conn.close()
+        with repository.transaction() as tx:
+            tx.add_stock(item_number, name, quantity, unit, lot, supplier, exp, session["user"])
+        mark_data_changed("inventory")
 
         maybe_send_expiration_email(item_number, lot, exp, name, supplier)
         return redirect("/current")
 
-    conn = connect_db()
-    c = conn.cursor()
-    c.execute("""
-        SELECT item_number, name, unit, supplier, exp, lot
-        FROM inventory
-        ORDER BY item_number, lot
-    """)
-    rows = c.fetchall()
-    conn.close()
+    with repository.transaction(read_only=True) as tx:
+        rows = tx.lot_rows()
 
     inventory_map = {}
-    for item_number, name, unit, supplier, exp, lot in rows:
+    for item_number, name, unit, supplier, exp, lot, _ in rows:
         entry = inventory_map.setdefault(
             item_number,
             {"name": name, "unit": unit, "supplier": supplier, "exp": exp, "lots": []},
@@ -851,6 +4694,35 @@ def add_item():
 
     return render_template("add_item.html", items=items, inventory_map=inventory_map)
 
+def remove_from_lot(cursor, item_number, lot, quantity, username):
+    """Take quantity from a lot and log it, or return None if it holds too little.
+
+    The decrement is a single conditional UPDATE, so concurrent removals from
+    the same lot serialize on the row and can neither lose an update nor
+    overdraw it. Returns (remaining, unit, name, supplier, exp).
+    """
+    cursor.execute(
+        """
+        UPDATE inventory
+        SET quantity = COALESCE(quantity, 0) - %s
+        WHERE item_number = %s AND lot = %s AND COALESCE(quantity, 0) >= %s
+        RETURNING quantity, unit, name, supplier, exp
+        """,
+        (quantity, item_number, lot, quantity),
+    )
+    row = cursor.fetchone()
+    if not row:
+        return None
+    remaining, unit = row[0], row[1]
+    cursor.execute(
+        """
+        INSERT INTO history (item_number, lot, change, remaining, unit, action_type, username)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """,
+        (item_number, lot, -quantity, remaining, unit, "REMOVE", username),
+    )
+    return (float(remaining), *row[1:])
+
 @app.route("/remove", methods=["GET", "POST"])
 @login_required
 def remove_item():
@@ -864,85 +4736,33 @@ def remove_item():
         if qty_remove <= 0:
             return "ERROR: Quantity must be greater than 0."
 
-        conn = connect_db()
-        c = conn.cursor()
-
-        # Get current quantity + unit for that lot
-        c.execute("""
-            SELECT quantity, unit, name, supplier, exp FROM inventory 
-            WHERE item_number = %s AND lot = %s
-        """, (item_number, lot))
-        row = c.fetchone()
-
+        with repository.transaction() as tx:
+            row = tx.remove_stock(item_number, lot, qty_remove, session["user"])
+            if not row:
+                # Nothing was taken; look the lot up only to explain why.
+                current = tx.lot(item_number, lot)
+            else:
+                low_items = tx.low_stock([item_number])
         if not row:
-            conn.close()
-            return "ERROR: Lot does not exist."
-
-        current_qty, unit, item_name, supplier, exp_value = row
-        current_qty = float(current_qty or 0)
-
-        # ⚠️ Block removal if quantity too high
-        if qty_remove > current_qty:
-            conn.close()
+            if not current:
+                return "ERROR: Lot does not exist."
+            current_qty, unit = float(current[0] or 0), current[1]
             return f"ERROR: Cannot remove {qty_remove} {unit}. Only {current_qty} {unit} available!"
 
-        # Update inventory
-        new_qty = current_qty - qty_remove
-        c.execute("""
-            UPDATE inventory 
-            SET quantity = %s
-            WHERE item_number = %s AND lot = %s
-        """, (new_qty, item_number, lot))
-
-        # Log to history
-        c.execute("""
-            INSERT INTO history (item_number, lot, change, remaining, unit, action_type, username)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """, (item_number, lot, -qty_remove, new_qty, unit, "REMOVE", session["user"]))
-
-        conn.commit()
-        conn.close()
+        _, _, item_name, supplier, exp_value = row
+        mark_data_changed("inventory")
 
         maybe_send_expiration_email(item_number, lot, exp_value, item_name, supplier)
-
-        threshold = _low_stock_threshold_for_unit(unit)
-        if new_qty < threshold:
-            app.logger.info(
-                "Threshold triggered for %s lot %s. Remaining %s %s (limit %s)",
-                item_number,
-                lot,
-                new_qty,
-                unit,
-                threshold,
-            )
-            send_low_stock_email(
-                item_number,
-                lot,
-                new_qty,
-                unit,
-                item_name,
-                supplier,
-                session.get("user"),
-            )
+        send_low_stock_alerts(low_items, lot, session.get("user"))
 
         return redirect("/current")
 
-    conn = connect_db()
-    c = conn.cursor()
-    c.execute("SELECT DISTINCT item_number, name FROM inventory ORDER BY item_number")
-    items = c.fetchall()
-    c.execute(
-        """
-        SELECT item_number, name, lot, quantity, unit
-        FROM inventory
-        ORDER BY item_number, lot
-        """
-    )
-    rows = c.fetchall()
-    conn.close()
+    with repository.transaction(read_only=True) as tx:
+        items = tx.item_choices()
+        rows = tx.lot_rows()
 
     inventory_map = {}
-    for item_number, name, lot, quantity, unit in rows:
+    for item_number, name, unit, _, _, lot, quantity in rows:
         entry = inventory_map.setdefault(item_number, {"name": name, "lots": {}})
         entry["lots"][lot] = {"quantity": float(quantity or 0), "unit": unit}
 
@@ -952,12 +4772,6 @@ def remove_item():
 @app.route("/adjust", methods=["GET", "POST"])
 @login_required
 def adjust_item():
-    conn = connect_db()
-    c = conn.cursor()
-    c.execute("SELECT DISTINCT item_number, name FROM inventory")
-    items = c.fetchall()
-    conn.close()
-
     if request.method == "POST":
         item_number = request.form["item_number"]
         lot = request.form["lot"]
@@ -970,58 +4784,475 @@ def adjust_item():
         new_unit = request.form["unit"]
         description = request.form.get("description", "").strip()
 
+        action_text = "ADJUST"
+        if description:
+            action_text = f"ADJUST ({description})"
+        with repository.transaction() as tx:
+            change = tx.set_stock(item_number, lot, new_quantity, new_unit, action_text, session["user"])
+            # Only downward corrections can newly cross a threshold.
+            low_items = tx.low_stock([item_number]) if change is not None and change < 0 else []
+        if change is None:
+            return "ERROR: Item/Lot not found"
+        mark_data_changed("inventory")
+
+        send_low_stock_alerts(low_items, lot, session.get("user"))
+
+        return redirect("/current")
+
+    with repository.transaction(read_only=True) as tx:
+        items = tx.item_choices()
+    return render_template("adjust_item.html", items=items)
+
+
+STOCKTAKE_PAGE_SIZE = 1000
+
+def _parse_count_rows(rows):
+    """Validate (item_number, lot, counted) rows; blank counts are skipped."""
+    counts = {}
+    errors = []
+    for line_number, (item_number, lot, counted) in enumerate(rows, start=1):
+        item_number = (item_number or "").strip()
+        lot = (lot or "").strip()
+        counted = (counted or "").strip()
+        if not counted:
+            continue
+        try:
+            value = float(counted)
+        except ValueError:
+            errors.append(f"Row {line_number}: '{counted}' is not a number.")
+            continue
+        if value < 0 or not item_number or not lot:
+            errors.append(f"Row {line_number}: needs an item, a lot and a count of 0 or more.")
+            continue
+        counts[(item_number, lot)] = value
+    return counts, errors
+
+def save_stocktake_counts(cursor, stocktake_id, counts):
+    """Store counted quantities in one UPDATE ... FROM (VALUES ...); return unmatched keys."""
+    if not counts:
+        return []
+    matched = execute_values(
+        cursor,
+        """
+        UPDATE stocktake_lines l
+        SET counted = v.counted
+        FROM (VALUES %s) AS v(stocktake_id, item_number, lot, counted)
+        WHERE l.stocktake_id = v.stocktake_id
+          AND l.item_number = v.item_number
+          AND l.lot = v.lot
+        RETURNING l.item_number, l.lot
+        """,
+        [(stocktake_id, item_number, lot, counted) for (item_number, lot), counted in counts.items()],
+        template="(%s, %s, %s, %s::numeric)",
+        page_size=STOCKTAKE_PAGE_SIZE,
+        fetch=True,
+    )
+    matched_keys = {(row[0], row[1]) for row in matched}
+    return [key for key in counts if key not in matched_keys]
+
+def reconcile_stocktake(cursor, stocktake_id, username):
+    """Apply counted quantities in the current transaction.
+
+    Movements after the snapshot are kept: each lot becomes
+    counted + (current quantity - expected). A lot re-counted in another
+    unit since the snapshot is converted when the units are compatible and
+    left alone otherwise. Returns the touched item numbers and the
+    "item lot" labels of the lines left alone.
+    """
+    cursor.execute(
+        """
+        SELECT l.item_number, l.lot, l.expected, l.counted, l.unit, i.quantity, i.unit
+        FROM stocktake_lines l
+        JOIN inventory i ON i.item_number = l.item_number AND i.lot = l.lot
+        WHERE l.stocktake_id = %s AND l.counted IS NOT NULL
+        FOR UPDATE OF i
+        """,
+        (stocktake_id,),
+    )
+    results = []
+    movements = []
+    skipped = []
+    action_text = f"ADJUST (stocktake #{stocktake_id})"
+    for item_number, lot, expected, counted, counted_unit, current, unit in cursor.fetchall():
+        # expected and counted are in the snapshot's unit; the lot may since be in another.
+        counted_canonical, counted_factor = canonical_unit_for(counted_unit)
+        lot_canonical, lot_factor = canonical_unit_for(unit)
+        if counted_canonical != lot_canonical:
+            skipped.append(f"{item_number} {lot}")
+            continue
+        scale = counted_factor / lot_factor
+        moved_since = float(current or 0) - float(expected) * scale
+        final_quantity = max(float(counted) * scale + moved_since, 0)
+        # The line keeps the snapshot's unit, like its expected and counted columns.
+        results.append((stocktake_id, item_number, lot, moved_since / scale, final_quantity / scale, final_quantity))
+        change = final_quantity - float(current or 0)
+        if change:
+            movements.append((item_number, lot, change, final_quantity, unit, action_text, username))
+
+    if results:
+        execute_values(
+            cursor,
+            """
+            UPDATE inventory i
+            SET quantity = v.lot_quantity
+            FROM (VALUES %s) AS v(stocktake_id, item_number, lot, moved_since, final_quantity, lot_quantity)
+            WHERE i.item_number = v.item_number AND i.lot = v.lot
+              AND i.quantity IS DISTINCT FROM v.lot_quantity
+            """,
+            results,
+            template="(%s, %s, %s, %s::numeric, %s::numeric, %s::numeric)",
+            page_size=STOCKTAKE_PAGE_SIZE,
+        )
+        execute_values(
+            cursor,
+            """
+            UPDATE stocktake_lines l
+            SET moved_since = v.moved_since, final_quantity = v.final_quantity
+            FROM (VALUES %s) AS v(stocktake_id, item_number, lot, moved_since, final_quantity, lot_quantity)
+            WHERE l.stocktake_id = v.stocktake_id AND l.item_number = v.item_number AND l.lot = v.lot
+            """,
+            results,
+            template="(%s, %s, %s, %s::numeric, %s::numeric, %s::numeric)",
+            page_size=STOCKTAKE_PAGE_SIZE,
+        )
+    if movements:
+        execute_values(
+            cursor,
+            """
+            INSERT INTO history (item_number, lot, change, remaining, unit, action_type, username)
+            VALUES %s
+            """,
+            movements,
+            page_size=STOCKTAKE_PAGE_SIZE,
+        )
+        mark_data_changed("inventory")
+
+    cursor.execute(
+        """
+        UPDATE stocktakes
+        SET status = 'Reconciled', reconciled_by = %s, reconciled_at = CURRENT_TIMESTAMP
+        WHERE id = %s
+        """,
+        (username, stocktake_id),
+    )
+    return sorted({movement[0] for movement in movements}), skipped
+
+@app.route("/stocktakes", methods=["GET", "POST"])
+@login_required
+def stocktakes():
+    if request.method == "POST":
+        name = request.form.get("name", "").strip() or f"Stocktake {datetime.now(PST_ZONE):%Y-%m-%d}"
+        conn = connect_db()
+        # One snapshot for the history mark and the copied quantities.
+        conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ)
+        c = conn.cursor()
+        c.execute(
+            """
+            INSERT INTO stocktakes (name, snapshot_history_id, created_by)
+            SELECT %s, COALESCE(MAX(id), 0), %s FROM history
+            RETURNING id
+            """,
+            (name, session.get("user")),
+        )
+        stocktake_id = c.fetchone()[0]
+        c.execute(
+            """
+            INSERT INTO stocktake_lines (stocktake_id, item_number, lot, name, unit, expected)
+            SELECT %s, item_number, lot, name, unit, COALESCE(quantity, 0)
+            FROM inventory
+            """,
+            (stocktake_id,),
+        )
+        conn.commit()
+        conn.close()
+        return redirect(f"/stocktakes/{stocktake_id}")
+
+    conn = connect_db(read_only=True)
+    c = conn.cursor()
+    c.execute(
+        """
+        SELECT s.id, s.name, s.status, s.created_by, s.created_at, s.reconciled_at,
+               COUNT(l.lot), COUNT(l.counted)
+        FROM stocktakes s
+        LEFT JOIN stocktake_lines l ON l.stocktake_id = s.id
+        GROUP BY s.id
+        ORDER BY s.created_at DESC
+        LIMIT 50
+        """
+    )
+    sessions = [
+        {
+            "id": row[0],
+            "name": row[1],
+            "status": row[2],
+            "created_by": row[3],
+            "created_at": format_timestamp_pst(row[4]),
+            "reconciled_at": format_timestamp_pst(row[5]),
+            "lines": row[6],
+            "counted": row[7],
+        }
+        for row in c.fetchall()
+    ]
+    conn.close()
+    return render_template("stocktakes.html", stocktakes=sessions)
+
+@app.route("/stocktakes/<int:stocktake_id>", methods=["GET", "POST"])
+@login_required
+def stocktake_detail(stocktake_id):
+    errors = []
+    if request.method == "POST":
+        action = request.form.get("action")
         conn = connect_db()
         c = conn.cursor()
+        c.execute("SELECT status FROM stocktakes WHERE id = %s FOR UPDATE", (stocktake_id,))
+        row = c.fetchone()
+        if not row:
+            conn.close()
+            return "ERROR: Stocktake not found."
+        if row[0] != "Open":
+            conn.close()
+            return "ERROR: This stocktake has already been reconciled."
+
+        if action == "save_counts":
+            rows = zip(
+                request.form.getlist("item_number"),
+                request.form.getlist("lot"),
+                request.form.getlist("counted"),
+            )
+            counts, errors = _parse_count_rows(rows)
+            unmatched = save_stocktake_counts(c, stocktake_id, counts)
+        elif action == "upload_csv":
+            upload = request.files.get("file")
+            if not upload:
+                conn.close()
+                return "ERROR: Choose a CSV file to upload."
+            reader = csv.DictReader(io.TextIOWrapper(upload.stream, encoding="utf-8-sig"))
+            counts, errors = _parse_count_rows(
+                (row.get("item_number"), row.get("lot"), row.get("counted")) for row in reader
+            )
+            unmatched = save_stocktake_counts(c, stocktake_id, counts)
+        elif action == "reconcile":
+            # Reconciling locks every counted lot, so a worker does it; a
+            # second click finds the job already queued.
+            c.execute(
+                """
+                SELECT id FROM jobs
+                WHERE job_type = 'reconcile_stocktake'
+                  AND status IN ('queued', 'running')
+                  AND params->>'stocktake_id' = %s
+                """,
+                (str(stocktake_id),),
+            )
+            pending = c.fetchone()
+            job_id = pending[0] if pending else enqueue_job(
+                c, "reconcile_stocktake", {"stocktake_id": stocktake_id}, session.get("user")
+            )
+            conn.commit()
+            conn.close()
+            return redirect(f"/jobs/{job_id}")
+        else:
+            unmatched = []
+
+        conn.commit()
+        conn.close()
+        errors.extend(f"{item} lot {lot} is not part of this stocktake." for item, lot in unmatched)
+        if not errors:
+            return redirect(f"/stocktakes/{stocktake_id}")
+
+    conn = connect_db(read_only=True)
+    c = conn.cursor()
+    c.execute(
+        """
+        SELECT id, name, status, snapshot_history_id, created_by, created_at, reconciled_by, reconciled_at
+        FROM stocktakes WHERE id = %s
+        """,
+        (stocktake_id,),
+    )
+    row = c.fetchone()
+    if not row:
+        conn.close()
+        return "ERROR: Stocktake not found."
+    stocktake = {
+        "id": row[0],
+        "name": row[1],
+        "status": row[2],
+        "snapshot_history_id": row[3],
+        "created_by": row[4],
+        "created_at": format_timestamp_pst(row[5]),
+        "reconciled_by": row[6],
+        "reconciled_at": format_timestamp_pst(row[7]),
+    }
+    c.execute(
+        """
+        SELECT item_number, lot, name, unit, expected, counted, moved_since, final_quantity
+        FROM stocktake_lines
+        WHERE stocktake_id = %s
+        ORDER BY ABS(COALESCE(counted - expected, 0)) DESC, item_number, lot
+        """,
+        (stocktake_id,),
+    )
+    lines = []
+    for item_number, lot, name, unit, expected, counted, moved_since, final_quantity in c.fetchall():
+        expected = float(expected)
+        lines.append(
+            {
+                "item_number": item_number,
+                "lot": lot,
+                "name": name,
+                "unit": unit,
+                "expected": expected,
+                "counted": float(counted) if counted is not None else None,
+                "variance": float(counted) - expected if counted is not None else None,
+                "moved_since": float(moved_since) if moved_since is not None else None,
+                "final_quantity": float(final_quantity) if final_quantity is not None else None,
+            }
+        )
+    conn.close()
 
-        # Get current quantity + unit
-        c.execute("""
-            SELECT quantity, unit FROM inventory
-            WHERE item_number = %s AND lot = %s
-        """, (item_number, lot))
-        row = c.fetchone()
+    summary = {
+        "lines": len(lines),
+        "counted": sum(1 for line in lines if line["counted"] is not None),
+        "with_variance": sum(1 for line in lines if line["variance"]),
+    }
+    return render_template(
+        "stocktake.html",
+        stocktake=stocktake,
+        lines=lines,
+        summary=summary,
+        errors=errors,
+    )
 
-        if not row:
-            conn.close()
-            return "ERROR: Item/Lot not found"
+JOB_SUBMIT_TYPES = ("export_inventory", "export_history", "import_stock", "refresh_forecasts", "low_stock_scan")
 
-        old_quantity, old_unit = row
-        old_quantity = float(old_quantity or 0)
+def _load_job(cursor, job_id):
+    cursor.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = %s", (job_id,))
+    row = cursor.fetchone()
+    return _job_dict(row) if row else None
 
-        # Update inventory
-        c.execute("""
-            UPDATE inventory SET quantity = %s, unit = %s
-            WHERE item_number = %s AND lot = %s
-        """, (new_quantity, new_unit, item_number, lot))
+def _display_job(job):
+    for column in ("run_after", "created_at", "started_at", "finished_at"):
+        job[column] = format_timestamp_pst(job[column])
+    return job
 
-        # Log to history
-        change = new_quantity - old_quantity
-        action_text = "ADJUST"
-        if description:
-            action_text = f"ADJUST ({description})"
-        c.execute("""
-        INSERT INTO history (item_number, lot, change, remaining, unit, action_type, username)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """, (item_number, lot, change, new_quantity, new_unit, action_text, session["user"]))
+@app.route("/jobs", methods=["GET", "POST"])
+@login_required
+def jobs():
+    if request.method == "POST":
+        wants_json = request.is_json
+        form = (request.get_json(silent=True) or {}) if wants_json else request.form
+
+        def reject(message):
+            return ({"error": message}, 400) if wants_json else f"ERROR: {message}"
+
+        job_type = form.get("job_type", "")
+        if job_type not in JOB_SUBMIT_TYPES:
+            return reject("Unknown job type.")
+        params = {}
+        if job_type == "export_history":
+            for field in ("start", "end"):
+                value = (form.get(field) or "").strip()
+                if value:
+                    try:
+                        params[field] = date.fromisoformat(value).isoformat()
+                    except ValueError:
+                        return reject(f"{field.capitalize()} must be a date (YYYY-MM-DD).")
+        elif job_type == "import_stock":
+            upload = request.files.get("file")
+            if not upload or not upload.filename:
+                return reject("Choose a CSV file to import.")
+            os.makedirs(JOB_UPLOAD_DIR, exist_ok=True)
+            handle, path = tempfile.mkstemp(suffix=".csv", dir=JOB_UPLOAD_DIR)
+            with os.fdopen(handle, "wb") as saved:
+                upload.save(saved)
+            params = {"path": path, "filename": upload.filename}
 
+        conn = connect_db()
+        c = conn.cursor()
+        job_id = enqueue_job(c, job_type, params, session.get("user"))
         conn.commit()
         conn.close()
+        if wants_json:
+            return {"id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}/status"}, 202
+        return redirect(f"/jobs/{job_id}")
 
-        return redirect("/current")
+    conn = connect_db(read_only=True)
+    c = conn.cursor()
+    c.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs ORDER BY id DESC LIMIT 50")
+    recent = [_display_job(_job_dict(row)) for row in c.fetchall()]
+    conn.close()
+    job_types = {job_type: JOB_TYPES[job_type]["label"] for job_type in JOB_SUBMIT_TYPES}
+    return render_template("jobs.html", jobs=recent, job_types=job_types)
 
-    return render_template("adjust_item.html", items=items)
+@app.route("/jobs/<int:job_id>")
+@login_required
+def job_detail(job_id):
+    conn = connect_db(read_only=True)
+    job = _load_job(conn.cursor(), job_id)
+    conn.close()
+    if not job:
+        return "ERROR: Job not found."
+    return render_template("job.html", job=_display_job(job))
 
+@app.route("/jobs/<int:job_id>/status")
+@login_required
+def job_status(job_id):
+    """Progress for polling clients; result_url appears once the job has a file."""
+    conn = connect_db(read_only=True)
+    job = _load_job(conn.cursor(), job_id)
+    conn.close()
+    if not job:
+        return {"error": "Job not found."}, 404
+    body = {
+        column: job[column]
+        for column in (
+            "id", "job_type", "status", "progress_done", "progress_total", "percent",
+            "message", "error", "attempts", "max_attempts", "finished",
+        )
+    }
+    for column in ("created_at", "started_at", "finished_at", "run_after"):
+        body[column] = job[column].isoformat() if job[column] else None
+    body["result_url"] = f"/jobs/{job_id}/result" if job["result_path"] else None
+    return body
 
-@app.route("/lookup_item/<item_number>")
+@app.route("/jobs/<int:job_id>/result")
 @login_required
-def lookup_item(item_number):
+def job_result(job_id):
+    conn = connect_db(read_only=True)
+    job = _load_job(conn.cursor(), job_id)
+    conn.close()
+    if not job or not job["result_path"] or not os.path.exists(job["result_path"]):
+        return "ERROR: This job has no result file.", 404
+    return send_file(job["result_path"], as_attachment=True, download_name=os.path.basename(job["result_path"]))
+
+@app.route("/jobs/<int:job_id>/retry", methods=["POST"])
+@login_required
+def retry_job(job_id):
     conn = connect_db()
     c = conn.cursor()
-    c.execute("""
-        SELECT item_number, name, unit, supplier, exp
-        FROM inventory WHERE item_number = %s
-    """, (item_number,))
+    c.execute(
+        """
+        UPDATE jobs
+        SET status = 'queued', attempts = 0, run_after = CURRENT_TIMESTAMP, error = NULL,
+            message = NULL, progress_done = 0, progress_total = NULL, finished_at = NULL
+        WHERE id = %s AND status = 'failed'
+        RETURNING job_type
+        """,
+        (job_id,),
+    )
     row = c.fetchone()
+    if row:
+        c.execute("SELECT pg_notify(%s, %s)", (JOB_CHANNEL, row[0]))
+    conn.commit()
     conn.close()
+    if not row:
+        return "ERROR: Only failed jobs can be retried."
+    return redirect(f"/jobs/{job_id}")
+
+@app.route("/lookup_item/<item_number>")
+@login_required
+def lookup_item(item_number):
+    with repository.transaction(read_only=True) as tx:
+        row = tx.item_lookup(item_number)
 
     if row:
         return {
@@ -1038,26 +5269,16 @@ def lookup_item(item_number):
 @app.route("/get_lots/<item_number>")
 @login_required
 def get_lots(item_number):
-    conn = connect_db()
-    c = conn.cursor()
-    c.execute("SELECT lot FROM inventory WHERE item_number = %s", (item_number,))
-    lots = [row[0] for row in c.fetchall()]
-    conn.close()
+    with repository.transaction(read_only=True) as tx:
+        lots = tx.lots(item_number)
 
     return {"lots": lots}
 
 @app.route("/lot_info/<item>/<lot>")
 @login_required
 def lot_info(item, lot):
-    conn = connect_db()
-    c = conn.cursor()
-    c.execute("""
-        SELECT quantity, unit 
-        FROM inventory
-        WHERE item_number = %s AND lot = %s
-    """, (item, lot))
-    row = c.fetchone()
-    conn.close()
+    with repository.transaction(read_only=True) as tx:
+        row = tx.lot_lookup(item, lot)
 
     if row:
         return {
@@ -1067,48 +5288,629 @@ def lot_info(item, lot):
         }
     return {"found": False}
 
+def _split_args(name, limit=None):
+    """Collect repeated and comma-separated query values, de-duplicated in order."""
+    values = []
+    for raw in request.args.getlist(name):
+        values.extend(value.strip() for value in raw.split(",") if value.strip())
+    values = list(dict.fromkeys(values))
+    return values[:limit] if limit else values
+
+SYNC_LOT_COLUMNS = ("item_number", "lot", "name", "quantity", "unit", "supplier", "exp")
+
+@app.route("/sync")
+@login_required
+def sync_inventory():
+    """Lot changes since a client's cursor, or a full snapshot when it is too old.
+
+    The cursor is the xmin of the snapshot the previous answer was read from:
+    every transaction below it had finished, so nothing committed later can
+    land behind it. Rows from transactions at or above it may be sent twice,
+    which is harmless because each lot is sent as its latest full state.
+    """
+    cursor_arg = request.args.get("cursor", "").strip()
+    since = int(cursor_arg) if cursor_arg.isdigit() else None
+
+    conn = connect_db(read_only=True)
+    c = conn.cursor()
+    # Take the watermark before reading so the rows are at least as new as it.
+    c.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")
+    next_cursor = c.fetchone()[0]
+    c.execute("SELECT pruned_through::text::bigint FROM sync_horizon")
+    horizon = c.fetchone()
+    full_resync = since is None or since > next_cursor or (horizon is not None and since <= horizon[0])
+
+    columns = ", ".join(SYNC_LOT_COLUMNS)
+    if full_resync:
+        c.execute(f"SELECT {columns} FROM inventory ORDER BY item_number, lot")
+        deletions = []
+    else:
+        c.execute(
+            f"SELECT {columns} FROM inventory WHERE sync_xid >= %s::text::xid8 ORDER BY item_number, lot",
+            (str(since),),
+        )
+    upserts = [
+        dict(zip(SYNC_LOT_COLUMNS, row[:3] + (float(row[3] or 0),) + row[4:]))
+        for row in c.fetchall()
+    ]
+    if not full_resync:
+        c.execute(
+            """
+            SELECT t.item_number, t.lot
+            FROM sync_tombstones t
+            WHERE t.sync_xid >= %s::text::xid8
+              AND NOT EXISTS (
+                  SELECT 1 FROM inventory i WHERE i.item_number = t.item_number AND i.lot = t.lot
+              )
+            ORDER BY t.item_number, t.lot
+            """,
+            (str(since),),
+        )
+        deletions = [{"item_number": row[0], "lot": row[1]} for row in c.fetchall()]
+    conn.close()
+
+    return {
+        "cursor": str(next_cursor),
+        "full_resync": full_resync,
+        "upserts": upserts,
+        "deletions": deletions,
+    }
+
+@app.route("/lookup")
+@login_required
+def batch_lookup():
+    """Items, lots, quantities and allocations for many items in one round trip."""
+    item_numbers = _split_args("item", LOOKUP_MAX_ITEMS)
+    lots = _split_args("lot") or None
+    if not item_numbers:
+        return {"error": "Pass at least one item."}, 400
+
+    # Inventory writes bump the version, so clients revalidate with a
+    # conditional GET that is answered without touching Postgres.
+    etag = None
+    try:
+        etag = f"inventory-{render_cache.epoch()}-{render_cache.versions(['inventory'])[0]}"
+    except sqlite3.Error as exc:
+        app.logger.warning("Render cache unavailable for lookup ETag: %s", exc)
+    headers = {"Cache-Control": "private, no-cache"}
+    if etag:
+        headers["ETag"] = f'"{etag}"'
+        if etag in request.if_none_match:
+            return Response(status=304, headers=headers)
+
+    # The ETag is only as fresh as the primary, so do not read a lagging replica.
+    with repository.transaction() as tx:
+        rows = tx.lot_allocations(item_numbers, lots)
+
+    items = {}
+    for item_number, name, unit, supplier, exp, lot, quantity, allocated in rows:
+        entry = items.setdefault(
+            item_number,
+            {"name": name, "unit": unit, "supplier": supplier, "exp": exp, "lots": {}},
+        )
+        for field, value in (("name", name), ("unit", unit), ("supplier", supplier), ("exp", exp)):
+            if not entry[field] and value:
+                entry[field] = value
+        quantity = float(quantity or 0)
+        allocated = float(allocated or 0)
+        entry["lots"][lot] = {
+            "quantity": quantity,
+            "unit": unit,
+            "exp": exp,
+            "allocated": allocated,
+            "available": quantity - allocated,
+        }
+
+    body = {"items": items, "missing": [item for item in item_numbers if item not in items]}
+    return body, 200, headers
+
 @app.route("/history")
 @login_required
 def history():
     search_term = request.args.get("search")
 
-    conn = connect_db()
-    c = conn.cursor()
-    c.execute("SELECT DISTINCT item_number, name FROM inventory ORDER BY item_number")
-    inventory_items = c.fetchall()
+    with repository.transaction(read_only=True) as tx:
+        inventory_items = tx.item_choices()
+        search_results = _format_history_rows(tx.item_history(search_term)) if search_term else None
 
-    c.execute("""
+    return stream_page("history.html",
+                       logs=map(_format_history_row, repository.stream_history()),
+                       search_results=search_results,
+                       search_term=search_term,
+                       inventory_items=inventory_items)
+
+def _build_search_query(text):
+    """Turn free text into a prefix-matching tsquery string, or None."""
+    terms = SEARCH_TERM_REGEX.findall((text or "").lower())
+    if not terms:
+        return None
+    return " & ".join(f"{term}:*" for term in terms)
+
+def search_everything(cursor, text, limit=SEARCH_RESULT_LIMIT):
+    """Return ranked inventory, project and history matches grouped by type."""
+    results = {"inventory": [], "projects": [], "history": []}
+    tsquery = _build_search_query(text)
+    if not tsquery:
+        return results
+
+    cursor.execute(
+        """
+        SELECT item_number, name, quantity, unit, lot, supplier, exp
+        FROM inventory, to_tsquery('simple', %s) query
+        WHERE search_vector @@ query
+        ORDER BY ts_rank(search_vector, query) DESC, item_number, lot
+        LIMIT %s
+        """,
+        (tsquery, limit),
+    )
+    results["inventory"] = [
+        {
+            "item_number": row[0],
+            "name": row[1],
+            "quantity": float(row[2] or 0),
+            "unit": row[3],
+            "lot": row[4],
+            "supplier": row[5],
+            "exp": row[6],
+        }
+        for row in cursor.fetchall()
+    ]
+
+    cursor.execute(
+        """
+        SELECT id, name, customer_name, description, status, due_date
+        FROM projects, to_tsquery('simple', %s) query
+        WHERE search_vector @@ query
+        ORDER BY ts_rank(search_vector, query) DESC, created_at DESC
+        LIMIT %s
+        """,
+        (tsquery, limit),
+    )
+    results["projects"] = [
+        {
+            "id": row[0],
+            "name": row[1],
+            "customer_name": row[2],
+            "description": row[3],
+            "status": row[4] or "Pending",
+            "due_date": row[5].strftime("%Y-%m-%d") if row[5] else None,
+        }
+        for row in cursor.fetchall()
+    ]
+
+    cursor.execute(
+        """
         SELECT h.id, h.item_number, h.lot, h.change, h.remaining,
                h.unit, h.action_type, h.username, h.timestamp,
                i.name
-        FROM history h
-        LEFT JOIN inventory i
-          ON h.item_number = i.item_number AND h.lot = i.lot
-        ORDER BY h.timestamp DESC
-    """)
-    logs = _format_history_rows(c.fetchall())
+        FROM (
+            SELECT *, ts_rank(search_vector, query) AS rank
+            FROM history, to_tsquery('simple', %s) query
+            WHERE search_vector @@ query
+            ORDER BY rank DESC, timestamp DESC
+            LIMIT %s
+        ) h
+        LEFT JOIN items i ON i.item_number = h.item_number
+        ORDER BY h.rank DESC, h.timestamp DESC
+        """,
+        (tsquery, limit),
+    )
+    results["history"] = _format_history_rows(cursor.fetchall())
+    return results
 
-    search_results = None
-    if search_term:
-        c.execute("""
-            SELECT h.id, h.item_number, h.lot, h.change, h.remaining,
-                   h.unit, h.action_type, h.username, h.timestamp,
-                   i.name
-            FROM history h
-            LEFT JOIN inventory i
-              ON h.item_number = i.item_number AND h.lot = i.lot
-            WHERE h.item_number = %s
-            ORDER BY h.timestamp DESC
-        """, (search_term,))
-        search_results = _format_history_rows(c.fetchall())
+@app.route("/search")
+@login_required
+def search():
+    search_term = request.args.get("q", "").strip()
+
+    conn = connect_db(read_only=True)
+    c = conn.cursor()
+    results = search_everything(c, search_term)
+    conn.close()
+
+    if request.args.get("format") == "json":
+        return {"query": search_term, "results": results}
+    return render_template("search.html", search_term=search_term, results=results)
+
+@app.route("/reports/reorder")
+@login_required
+def reorder_report():
+    cover_days = to_int_or_none(request.args.get("days")) or REORDER_COVER_DAYS
+
+    # Forecasts are refreshed by the refresh_forecasts job, not by viewing them.
+    conn = connect_db(read_only=True)
+    c = conn.cursor()
+    refreshed_at = job_state_updated_at(c, "forecast")
+    c.execute(
+        """
+        SELECT f.item_number, i.name, f.on_hand, f.unit, f.usage_rate,
+               f.days_of_cover, f.stockout_date, f.last_usage_date
+        FROM item_forecasts f
+        LEFT JOIN items i ON i.item_number = f.item_number
+        WHERE f.days_of_cover <= %s
+        ORDER BY f.days_of_cover, f.item_number
+        """,
+        (cover_days,),
+    )
+    rows = c.fetchall()
+    conn.close()
+
+    forecasts = [
+        {
+            "item_number": row[0],
+            "name": row[1],
+            "on_hand": float(row[2] or 0),
+            "unit": row[3],
+            "daily_usage": round(float(row[4] or 0), 2),
+            "days_of_cover": round(float(row[5]), 1),
+            "stockout_date": row[6].strftime("%Y-%m-%d") if row[6] else None,
+            "last_usage_date": row[7].strftime("%Y-%m-%d") if row[7] else None,
+        }
+        for row in rows
+    ]
+    return render_template(
+        "reorder_report.html", forecasts=forecasts, cover_days=cover_days, refreshed_at=refreshed_at
+    )
+
+@app.route("/reports/low-stock", methods=["GET", "POST"])
+@login_required
+def low_stock_report():
+    if request.method == "POST":
+        action = request.form.get("action")
+        item_number = request.form.get("item_number", "").strip()
+        if not item_number:
+            return "Item number is required."
+
+        conn = connect_db()
+        c = conn.cursor()
+
+        if action == "set_threshold":
+            try:
+                threshold = float(request.form["threshold"])
+            except (KeyError, TypeError, ValueError):
+                conn.close()
+                return "ERROR: Threshold must be a number."
+            if threshold < 0:
+                conn.close()
+                return "ERROR: Threshold cannot be negative."
+            unit = request.form.get("unit", "").strip()
+            canonical_unit, factor = canonical_unit_for(unit)
+            # A threshold only applies to stock in the same canonical unit.
+            c.execute("SELECT DISTINCT canonical_unit FROM inventory WHERE item_number = %s", (item_number,))
+            stock_units = {row[0] for row in c.fetchall()}
+            if not stock_units:
+                c.execute("SELECT unit FROM items WHERE item_number = %s", (item_number,))
+                row = c.fetchone()
+                if row and row[0]:
+                    stock_units = {canonical_unit_for(row[0])[0]}
+            if stock_units and canonical_unit not in stock_units:
+                conn.close()
+                return (
+                    f"ERROR: {item_number} is stocked in {', '.join(sorted(stock_units))}; "
+                    f"a threshold in {unit or 'no unit'} would never apply."
+                )
+            c.execute(
+                """
+                INSERT INTO item_thresholds
+                    (item_number, threshold, unit, canonical_threshold, canonical_unit, updated_by)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (item_number) DO UPDATE SET
+                    threshold = excluded.threshold,
+                    unit = excluded.unit,
+                    canonical_threshold = excluded.canonical_threshold,
+                    canonical_unit = excluded.canonical_unit,
+                    updated_by = excluded.updated_by,
+                    updated_at = CURRENT_TIMESTAMP
+                """,
+                (item_number, threshold, unit, threshold * factor, canonical_unit, session.get("user")),
+            )
+        elif action == "clear_threshold":
+            c.execute("DELETE FROM item_thresholds WHERE item_number = %s", (item_number,))
+
+        conn.commit()
+        conn.close()
+        return redirect("/reports/low-stock")
+
+    conn = connect_db(read_only=True)
+    c = conn.cursor()
+    low_items = evaluate_low_stock(c)
+    c.execute(
+        """
+        SELECT item_number, threshold, unit, canonical_threshold, canonical_unit, updated_by
+        FROM item_thresholds
+        ORDER BY item_number
+        """
+    )
+    thresholds = [
+        {
+            "item_number": row[0],
+            "threshold": float(row[1]),
+            "unit": row[2],
+            "canonical_threshold": float(row[3]),
+            "canonical_unit": row[4],
+            "updated_by": row[5],
+        }
+        for row in c.fetchall()
+    ]
+    c.execute("SELECT item_number, name FROM items ORDER BY item_number")
+    items = c.fetchall()
+    conn.close()
+
+    return render_template("low_stock_report.html", low_items=low_items, thresholds=thresholds, items=items)
+
+ROLLUP_PERIODS = ("day", "week", "month")
+
+def _report_date_range():
+    """Read start/end/period query args, defaulting to the last 30 days by day."""
+    period = request.args.get("period", "day")
+    if period not in ROLLUP_PERIODS:
+        period = "day"
+    today = datetime.now(PST_ZONE).date()
+    try:
+        end = datetime.strptime(request.args.get("end", ""), "%Y-%m-%d").date()
+    except ValueError:
+        end = today
+    try:
+        start = datetime.strptime(request.args.get("start", ""), "%Y-%m-%d").date()
+    except ValueError:
+        start = date.fromordinal(end.toordinal() - 29)
+    return start, end, period
+
+@app.route("/reports/movements")
+@login_required
+def movement_report():
+    start, end, period = _report_date_range()
+    item_number = request.args.get("item", "").strip()
+    action_type = request.args.get("action", "").strip().upper()
+    by_user = request.args.get("by_user") == "1"
+
+    # The rollup is refreshed by the refresh_forecasts job, not by viewing it.
+    conn = connect_db(read_only=True)
+    c = conn.cursor()
+    refreshed_at = job_state_updated_at(c, "rollup_movements")
+
+    user_column = "username" if by_user else "''"
+    query = f"""
+        SELECT date_trunc(%s, day)::date AS period, item_number, action_type,
+               {user_column} AS username, canonical_unit,
+               SUM(total_change), SUM(movement_count)
+        FROM daily_movements
+        WHERE day BETWEEN %s AND %s
+    """
+    params = [period, start, end]
+    if item_number:
+        query += " AND item_number = %s"
+        params.append(item_number)
+    if action_type:
+        query += " AND action_type = %s"
+        params.append(action_type)
+    query += " GROUP BY 1, 2, 3, 4, 5 ORDER BY 1 DESC, 2, 3, 4"
+    c.execute(query, params)
+    rows = [
+        {
+            "period": row[0].strftime("%Y-%m-%d"),
+            "item_number": row[1],
+            "action_type": row[2],
+            "username": row[3],
+            "unit": row[4],
+            "total": float(row[5] or 0),
+            "count": row[6],
+        }
+        for row in c.fetchall()
+    ]
+    c.execute("SELECT item_number, name FROM items ORDER BY item_number")
+    items = c.fetchall()
+    conn.close()
 
+    return render_template(
+        "movement_report.html",
+        rows=rows,
+        items=items,
+        start=start,
+        end=end,
+        period=period,
+        periods=ROLLUP_PERIODS,
+        item_number=item_number,
+        action_type=action_type,
+        by_user=by_user,
+        refreshed_at=refreshed_at,
+    )
+
+@app.route("/reports/production")
+@login_required
+def production_report():
+    start, end, period = _report_date_range()
+    customer_name = request.args.get("customer", "").strip()
+
+    conn = connect_db(read_only=True)
+    c = conn.cursor()
+    query = """
+        SELECT date_trunc(%s, day)::date AS period, customer_name,
+               SUM(projects_completed), SUM(bags_completed)
+        FROM daily_completions
+        WHERE day BETWEEN %s AND %s
+    """
+    params = [period, start, end]
+    if customer_name:
+        query += " AND customer_name = %s"
+        params.append(customer_name)
+    query += " GROUP BY 1, 2 HAVING SUM(projects_completed) > 0 ORDER BY 1 DESC, 2"
+    c.execute(query, params)
+    rows = [
+        {
+            "period": row[0].strftime("%Y-%m-%d"),
+            "customer_name": row[1] or "-",
+            "projects": row[2],
+            "bags": row[3],
+        }
+        for row in c.fetchall()
+    ]
+    conn.close()
+
+    return render_template(
+        "production_report.html",
+        rows=rows,
+        start=start,
+        end=end,
+        period=period,
+        periods=ROLLUP_PERIODS,
+        customer_name=customer_name,
+    )
+
+@app.route("/recipes", methods=["GET", "POST"])
+@login_required
+def recipes():
+    if request.method == "POST":
+        action = request.form.get("action")
+        product = request.form.get("product", "").strip()
+        item_number = request.form.get("item_number", "").strip()
+        if not product or not item_number:
+            return "Product and item number are required."
+
+        conn = connect_db()
+        c = conn.cursor()
+
+        if action == "add":
+            try:
+                quantity = float(request.form["quantity_per_gummy"])
+            except (KeyError, TypeError, ValueError):
+                conn.close()
+                return "ERROR: Quantity per gummy must be a number."
+            if quantity <= 0:
+                conn.close()
+                return "ERROR: Quantity per gummy must be greater than 0."
+            unit = request.form.get("unit", "").strip()
+            canonical_unit, factor = canonical_unit_for(unit)
+            c.execute(
+                """
+                INSERT INTO recipe_lines
+                    (product, item_number, quantity_per_gummy, unit, canonical_per_gummy, canonical_unit)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (product, item_number) DO UPDATE SET
+                    quantity_per_gummy = excluded.quantity_per_gummy,
+                    unit = excluded.unit,
+                    canonical_per_gummy = excluded.canonical_per_gummy,
+                    canonical_unit = excluded.canonical_unit
+                """,
+                (product, item_number, quantity, unit, quantity * factor, canonical_unit),
+            )
+            log_dashboard_event(
+                c,
+                f"Set recipe '{product}': {quantity} {unit} of {item_number} per gummy",
+                session.get("user"),
+            )
+        elif action == "delete":
+            c.execute(
+                "DELETE FROM recipe_lines WHERE product = %s AND item_number = %s",
+                (product, item_number),
+            )
+            log_dashboard_event(c, f"Removed {item_number} from recipe '{product}'", session.get("user"))
+
+        conn.commit()
+        conn.close()
+        return redirect("/recipes")
+
+    conn = connect_db(read_only=True)
+    c = conn.cursor()
+    c.execute(
+        """
+        SELECT r.product, r.item_number, i.name, r.quantity_per_gummy, r.unit
+        FROM recipe_lines r
+        LEFT JOIN items i ON i.item_number = r.item_number
+        ORDER BY r.product, r.item_number
+        """
+    )
+    recipe_map = {}
+    for product, item_number, item_name, quantity, unit in c.fetchall():
+        recipe_map.setdefault(product, []).append(
+            {"item_number": item_number, "item_name": item_name, "quantity": float(quantity), "unit": unit}
+        )
+    c.execute("SELECT item_number, name FROM items ORDER BY item_number")
+    items = c.fetchall()
+    conn.close()
+
+    return render_template("recipes.html", recipes=recipe_map, items=items)
+
+@app.route("/reports/mrp")
+@login_required
+def material_requirements_report():
+    conn = connect_db(read_only=True)
+    c = conn.cursor()
+    projects, shortfalls = run_material_requirements(c)
     conn.close()
 
-    return render_template("history.html",
-                           logs=logs,
-                           search_results=search_results,
-                           search_term=search_term,
-                           inventory_items=inventory_items)
+    if request.args.get("format") == "json":
+        return {"projects": projects, "shortfalls": shortfalls}
+    return render_template("mrp_report.html", projects=projects, shortfalls=shortfalls)
+
+@app.route("/reports/trace")
+@login_required
+def lot_trace_report():
+    lot, item_number, project_id = _trace_args()
+    rows = None
+    project = None
+    if project_id is not None or lot:
+        conn = connect_db(read_only=True)
+        c = conn.cursor()
+        query, params = lot_trace_query(lot, item_number, project_id)
+        c.execute(query, params)
+        rows = [_trace_row(row) for row in c.fetchall()]
+        if project_id is not None:
+            c.execute("SELECT name, customer_name FROM projects WHERE id = %s", (project_id,))
+            found = c.fetchone()
+            project = {"id": project_id, "name": found[0], "customer_name": found[1]} if found else {"id": project_id}
+        conn.close()
+        for row in rows:
+            row["first_linked_at"] = format_timestamp_pst(row["first_linked_at"])
+            row["last_used_at"] = format_timestamp_pst(row["last_used_at"])
+
+    summary = None
+    if rows and project_id is None:
+        summary = {
+            "projects": len({row["project_id"] for row in rows}),
+            "customers": sorted({row["customer_name"] for row in rows if row["customer_name"]}),
+            "used": sum(1 for row in rows if row["used_quantity"]),
+        }
+    return render_template(
+        "lot_trace.html",
+        lot=lot,
+        item_number=item_number or "",
+        project_id=project_id,
+        project=project,
+        rows=rows,
+        summary=summary,
+        query_string=request.query_string.decode(),
+    )
+
+@app.route("/reports/trace.csv")
+@login_required
+def lot_trace_csv():
+    """The trace report as CSV, streamed straight from the index."""
+    lot, item_number, project_id = _trace_args()
+    if project_id is None and not lot:
+        return "ERROR: Give a lot or a project to trace.", 400
+    query, params = lot_trace_query(lot, item_number, project_id)
+    rows = stream_rows(query, params, name="lot_trace_csv")
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(LOT_TRACE_COLUMNS)
+        for row in rows:
+            writer.writerow(value.isoformat() if isinstance(value, (date, datetime)) else value for value in row)
+            if buffer.tell() >= STREAM_CHUNK_BYTES:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    subject = f"project-{project_id}" if project_id is not None else "-".join(filter(None, ("lot", item_number, lot)))
+    filename = re.sub(r"[^\w.-]+", "_", f"trace-{subject}.csv")
+    return Response(
+        generate(),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
 
 @app.route("/register", methods=["GET", "POST"])
 def register():
@@ -0,0 +1,70 @@
+// Shared live feed: one EventSource per page, handlers keyed by event type.
+const liveFeed = (() => {
+    const handlers = {};
+    let source = null;
+
+    function connect() {
+        source = new EventSource("/events");
+        source.onmessage = (event) => {
+            const data = JSON.parse(event.data);
+            (handlers[data.type] || []).forEach(handler => handler(data));
+        };
+        source.addEventListener("resync", () => window.location.reload());
+    }
+
+    return {
+        on(type, handler) {
+            (handlers[type] = handlers[type] || []).push(handler);
+            if (!source) {
+                connect();
+            }
+        },
+    };
+})();
+
+function formatPst(value) {
+    if (!value) {
+        return "";
+    }
+    return new Date(value).toLocaleString("en-US", {
+        timeZone: "America/Los_Angeles",
+        year: "numeric",
+        month: "2-digit",
+        day: "2-digit",
+        hour: "2-digit",
+        minute: "2-digit",
+        timeZoneName: "short",
+    });
+}
+
+function flashRow(element) {
+    element.classList.remove("live-updated");
+    void element.offsetWidth;
+    element.classList.add("live-updated");
+}
+
+function showLiveNotice(message) {
+    let notice = document.getElementById("live_notice");
+    if (!notice) {
+        notice = document.createElement("div");
+        notice.id = "live_notice";
+        notice.className = "live-notice";
+        document.querySelector(".container").prepend(notice);
+    }
+    notice.innerHTML = "";
+    notice.append(message + " ");
+    const link = document.createElement("a");
+    link.href = window.location.href;
+    link.textContent = "Refresh";
+    notice.appendChild(link);
+}
+
+function buildRow(values) {
+    const row = document.createElement("tr");
+    values.forEach(value => {
+        const cell = document.createElement("td");
+        cell.textContent = value === null || value === undefined ? "" : value;
+        row.appendChild(cell);
+    });
+    return row;
+}
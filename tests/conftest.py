@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# app.py picks its repository backend and render cache path at import time.
+os.environ["REPOSITORY_BACKEND"] = "memory"
+os.environ.setdefault("RENDER_CACHE_PATH", os.path.join(tempfile.mkdtemp(), "render-cache.sqlite3"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
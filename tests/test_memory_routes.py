@@ -0,0 +1,250 @@
+import uuid
+from decimal import Decimal
+
+import psycopg2
+import pytest
+
+import app as inventory_app
+
+
+def login(client):
+    with client.session_transaction() as session:
+        session["user"] = "tester@example.com"
+    return client
+
+
+@pytest.fixture
+def repository(monkeypatch):
+    repository = inventory_app.MemoryRepository()
+    monkeypatch.setattr(inventory_app, "repository", repository)
+    return repository
+
+
+@pytest.fixture
+def client(repository):
+    return login(inventory_app.app.test_client())
+
+
+def add(client, item_number, lot, quantity, unit="kg", name="Pectin", exp=""):
+    return client.post(
+        "/add",
+        data={
+            "item_number": item_number, "name": name, "quantity": quantity, "unit": unit,
+            "lot": lot, "supplier": "Acme", "exp": exp,
+        },
+    )
+
+
+def test_add_creates_and_tops_up_lot(client, repository):
+    assert add(client, "P100", "L1", "500").status_code == 302
+    assert add(client, "P100", "L1", "5").status_code == 302
+
+    lot = repository.lots[("P100", "L1")]
+    assert lot["quantity"] == Decimal("505")
+    assert repository.items["P100"]["name"] == "Pectin"
+    assert [(entry["change"], entry["remaining"]) for entry in repository.history] == [
+        (Decimal("500"), Decimal("500")),
+        (Decimal("5"), Decimal("505")),
+    ]
+    assert b"P100" in client.get("/current").data
+
+
+def test_remove_takes_from_lot_and_logs(client, repository):
+    add(client, "P100", "L1", "500")
+
+    response = client.post("/remove", data={"item_number": "P100", "lot": "L1", "quantity": "30"})
+
+    assert response.status_code == 302
+    assert repository.lots[("P100", "L1")]["quantity"] == Decimal("470")
+    assert repository.history[-1]["action_type"] == "REMOVE"
+    assert repository.history[-1]["change"] == Decimal("-30")
+
+
+def test_over_remove_is_rejected_without_changes(client, repository):
+    add(client, "P100", "L1", "50")
+
+    response = client.post("/remove", data={"item_number": "P100", "lot": "L1", "quantity": "80"})
+
+    assert response.data == b"ERROR: Cannot remove 80.0 kg. Only 50.0 kg available!"
+    assert repository.lots[("P100", "L1")]["quantity"] == Decimal("50")
+    assert len(repository.history) == 1
+
+
+@pytest.mark.parametrize(
+    ("quantity", "message"),
+    [("abc", b"ERROR: Quantity must be a number."), ("0", b"ERROR: Quantity must be greater than 0.")],
+)
+def test_remove_validates_quantity(client, quantity, message):
+    response = client.post("/remove", data={"item_number": "P100", "lot": "L1", "quantity": quantity})
+    assert response.data == message
+
+
+def test_adjust_overwrites_quantity_and_logs_description(client, repository):
+    add(client, "S200", "A", "5000", unit="g")
+
+    response = client.post(
+        "/adjust",
+        data={"item_number": "S200", "lot": "A", "new_quantity": "10", "unit": "g", "description": "recount"},
+    )
+
+    assert response.status_code == 302
+    assert repository.lots[("S200", "A")]["quantity"] == Decimal("10")
+    assert repository.history[-1]["action_type"] == "ADJUST (recount)"
+    assert repository.history[-1]["change"] == Decimal("-4990")
+
+
+def test_adjust_rejects_negative_and_missing_lots(client):
+    negative = client.post("/adjust", data={"item_number": "S200", "lot": "A", "new_quantity": "-1", "unit": "g"})
+    missing = client.post("/adjust", data={"item_number": "S200", "lot": "A", "new_quantity": "1", "unit": "g"})
+
+    assert negative.data == b"ERROR: Quantity cannot be negative."
+    assert missing.data == b"ERROR: Item/Lot not found"
+
+
+def test_lookups_read_the_memory_store(client):
+    add(client, "P100", "L2", "7")
+    add(client, "P100", "L1", "2.5")
+
+    assert client.get("/lookup_item/P100").json["name"] == "Pectin"
+    assert client.get("/lookup_item/NOPE").json == {"found": False}
+    assert client.get("/get_lots/P100").json == {"lots": ["L1", "L2"]}
+    assert client.get("/lot_info/P100/L1").json == {"found": True, "quantity": "2.5", "unit": "kg"}
+
+    response = client.get("/lookup?item=P100,NOPE&lot=L2")
+
+    assert response.status_code == 200
+    assert response.json["missing"] == ["NOPE"]
+    assert response.json["items"]["P100"]["lots"] == {
+        "L2": {"quantity": 7.0, "unit": "kg", "exp": "", "allocated": 0.0, "available": 7.0},
+    }
+
+
+def test_dashboard_create_and_complete_project(client, repository):
+    response = client.post(
+        "/dashboard",
+        data={
+            "action": "create", "name": "Proj A", "customer_name": "Cust", "description": "d",
+            "due_date": "2030-01-01", "bags_bottles": "100", "gummies": "3000",
+        },
+    )
+    assert response.status_code == 302
+    (project_id, project), = repository.projects.items()
+    assert project["status"] == "Pending"
+    assert b"Proj A" in client.get("/dashboard").data
+
+    response = client.post(
+        "/dashboard",
+        data={
+            "action": "update_status", "project_id": str(project_id),
+            "status": "Completed", "completion_date": "2026-02-01",
+        },
+    )
+
+    assert response.status_code == 302
+    assert project["status"] == "Completed"
+    assert str(project["completed_on"]) == "2026-02-01"
+    assert [event[0] for event in repository.dashboard_history] == [
+        "Created project 'Proj A' targeting 100 Bags, due 2030-01-01",
+        "Marked project 'Proj A' as Completed",
+    ]
+    assert b"Proj A" in client.get("/projects/completed").data
+
+
+def test_project_ingredients_allocate_and_use_stock(client, repository):
+    add(client, "P100", "L1", "10")
+    with repository.transaction() as tx:
+        project_id = tx.create_project({"name": "Proj A"})
+    url = f"/projects/{project_id}/ingredients"
+    fields = {"action": "add", "item_number": "P100", "quantity": "0.5", "unit": "kg", "lot": "L1"}
+
+    assert client.post(url, data=dict(fields, stage="Used")).data == b"ERROR: Add the ingredient as Allocated, then use it."
+    assert client.post(url, data=dict(fields, lot="L9")).data == b"ERROR: Lot does not exist."
+    assert client.post(url, data=fields).status_code == 302
+    assert client.get("/lookup?item=P100").json["items"]["P100"]["lots"]["L1"]["available"] == 9.5
+    assert b"P100" in client.get(url).data
+
+    (ingredient_id, ingredient), = repository.ingredients.items()
+    response = client.post(url, data={"action": "use", "ingredient_id": str(ingredient_id)})
+
+    assert response.status_code == 302
+    assert ingredient["stage"] == "Used"
+    assert repository.lots[("P100", "L1")]["quantity"] == Decimal("9.5")
+    assert repository.dashboard_history[-1][0] == "Used 0.5 kg of P100 lot L1 for project 'Proj A'"
+
+
+def test_dashboard_rejects_bad_input(client, repository):
+    missing_name = client.post("/dashboard", data={"action": "create", "name": " "})
+    bad_id = client.post("/dashboard", data={"action": "update_status", "project_id": "x"})
+
+    assert missing_name.data == b"Project name is required."
+    assert bad_id.data == b"Invalid project id."
+    assert repository.projects == {}
+
+
+def test_failed_transaction_rolls_back(repository):
+    with pytest.raises(RuntimeError):
+        with repository.transaction() as tx:
+            tx.add_stock("X1", "X", 1.0, "kg", "L", "", "", "tester")
+            raise RuntimeError
+
+    assert "X1" not in repository.items
+    assert ("X1", "L") not in repository.lots
+    assert repository.history == []
+
+
+# Both backends must answer the same requests with the same messages and the
+# same NUMERIC rounding. The Postgres run is skipped without a database.
+@pytest.fixture(params=["memory", "postgres"])
+def backend(request, monkeypatch):
+    if request.param == "memory":
+        repository = inventory_app.MemoryRepository()
+    else:
+        try:
+            inventory_app.init_db()
+        except psycopg2.OperationalError as exc:
+            pytest.skip(f"Postgres unavailable: {exc}")
+        repository = inventory_app.PostgresRepository()
+    monkeypatch.setattr(inventory_app, "repository", repository)
+    item_number = f"PARITY-{uuid.uuid4().hex[:8]}"
+    yield repository, item_number
+    if request.param == "postgres":
+        conn = inventory_app._connect_primary()
+        c = conn.cursor()
+        for table in ("history", "inventory", "lot_trace", "items"):
+            c.execute(f"DELETE FROM {table} WHERE item_number = %s", (item_number,))
+        conn.commit()
+        conn.close()
+
+
+def test_backends_share_messages_and_rounding(backend):
+    repository, item_number = backend
+    client = login(inventory_app.app.test_client())
+
+    add(client, item_number, "L1", "0.1")
+    add(client, item_number, "L1", "0.2")
+    with repository.transaction(read_only=True) as tx:
+        assert tx.lot(item_number, "L1")[:2] == (Decimal("0.3"), "kg")
+
+    over = client.post("/remove", data={"item_number": item_number, "lot": "L1", "quantity": "1"})
+    assert over.data == b"ERROR: Cannot remove 1.0 kg. Only 0.3 kg available!"
+    missing = client.post("/remove", data={"item_number": item_number, "lot": "L2", "quantity": "1"})
+    assert missing.data == b"ERROR: Lot does not exist."
+
+    assert client.post("/remove", data={"item_number": item_number, "lot": "L1", "quantity": "0.3"}).status_code == 302
+    assert client.post(
+        "/adjust", data={"item_number": item_number, "lot": "L1", "new_quantity": "1.15", "unit": "kg"}
+    ).status_code == 302
+    missing_lot = client.post(
+        "/adjust", data={"item_number": item_number, "lot": "L2", "new_quantity": "1", "unit": "kg"}
+    )
+    assert missing_lot.data == b"ERROR: Item/Lot not found"
+
+    with repository.transaction(read_only=True) as tx:
+        assert tx.lot(item_number, "L1")[0] == Decimal("1.15")
+        movements = [(row[6], row[3], row[4]) for row in reversed(tx.item_history(item_number))]
+    assert movements == [
+        ("ADD", Decimal("0.1"), Decimal("0.1")),
+        ("ADD", Decimal("0.2"), Decimal("0.3")),
+        ("REMOVE", Decimal("-0.3"), Decimal("0")),
+        ("ADJUST", Decimal("1.15"), Decimal("1.15")),
+    ]
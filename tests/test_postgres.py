@@ -0,0 +1,142 @@
+"""Write paths that depend on Postgres triggers; skipped without a database."""
+import threading
+import uuid
+
+import psycopg2
+import pytest
+
+import app as inventory_app
+
+
+@pytest.fixture
+def item_number(monkeypatch):
+    try:
+        inventory_app.init_db()
+    except psycopg2.OperationalError as exc:
+        pytest.skip(f"Postgres unavailable: {exc}")
+    monkeypatch.setattr(inventory_app, "repository", inventory_app.PostgresRepository())
+    item_number = f"PGTEST-{uuid.uuid4().hex[:8]}"
+    yield item_number
+    conn = inventory_app._connect_primary()
+    c = conn.cursor()
+    for table in ("history", "inventory", "lot_trace", "items"):
+        c.execute(f"DELETE FROM {table} WHERE item_number = %s", (item_number,))
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def client():
+    client = inventory_app.app.test_client()
+    with client.session_transaction() as session:
+        session["user"] = "tester@example.com"
+    return client
+
+
+def test_long_adjust_description_still_commits(client, item_number):
+    client.post(
+        "/add",
+        data={"item_number": item_number, "name": "Pectin", "quantity": "5", "unit": "kg", "lot": "L1", "exp": ""},
+    )
+    description = "recount " * 2000
+
+    response = client.post(
+        "/adjust",
+        data={
+            "item_number": item_number, "lot": "L1", "new_quantity": "4", "unit": "kg",
+            "description": description,
+        },
+    )
+
+    assert response.status_code == 302
+    with inventory_app.repository.transaction(read_only=True) as tx:
+        latest = tx.item_history(item_number)[0]
+    assert latest[6] == f"ADJUST ({description.strip()})"
+
+
+def test_retried_import_applies_once(item_number, tmp_path):
+    upload = tmp_path / "stock.csv"
+    upload.write_text(f"item_number,name,quantity,unit,lot\n{item_number},Pectin,5,kg,L1\n")
+    conn = inventory_app._connect_primary()
+    job_id = inventory_app.enqueue_job(conn.cursor(), "import_stock", {"path": str(upload)}, "tester@example.com")
+    conn.commit()
+    worker = inventory_app.JobWorker("pytest", threading.Event())
+    context = inventory_app.JobContext(worker, job_id, "import_stock", {"path": str(upload)}, "tester@example.com")
+    try:
+        first = inventory_app.import_stock_job(context)
+        # A requeued attempt after the import committed, with its upload already gone.
+        upload.unlink()
+        second = inventory_app.import_stock_job(context)
+    finally:
+        worker.conn.close()
+        conn.cursor().execute("DELETE FROM jobs WHERE id = %s", (job_id,))
+        conn.commit()
+        conn.close()
+
+    assert first == "Imported 1 row(s)"
+    assert second == "Already imported by an earlier attempt"
+    with inventory_app.repository.transaction(read_only=True) as tx:
+        assert tx.lot(item_number, "L1")[0] == 5
+
+
+def test_ingredient_add_rejects_used_stage_and_unknown_lots(client, item_number):
+    client.post(
+        "/add",
+        data={"item_number": item_number, "name": "Pectin", "quantity": "5", "unit": "kg", "lot": "L1", "exp": ""},
+    )
+    with inventory_app.repository.transaction() as tx:
+        project_id = tx.create_project({"name": f"Project {item_number}"})
+    url = f"/projects/{project_id}/ingredients"
+    fields = {"action": "add", "item_number": item_number, "quantity": "1", "unit": "kg", "lot": "L1"}
+    try:
+        used = client.post(url, data=dict(fields, stage="Used"))
+        missing = client.post(url, data=dict(fields, lot="NOPE"))
+        wrong_unit = client.post(url, data=dict(fields, unit="L"))
+        allocated = client.post(url, data=fields)
+        with inventory_app.repository.transaction(read_only=True) as tx:
+            ingredients = [(row[5], row[6]) for row in tx.project_ingredients(project_id)]
+    finally:
+        with inventory_app.repository.transaction() as tx:
+            tx.delete_project(project_id)
+
+    assert used.data == b"ERROR: Add the ingredient as Allocated, then use it."
+    assert missing.data == b"ERROR: Lot does not exist."
+    assert wrong_unit.data == b"ERROR: Cannot allocate L from a lot counted in kg."
+    assert allocated.status_code == 302
+    assert ingredients == [("L1", "Allocated")]
+
+
+def test_reconcile_converts_or_skips_lots_whose_unit_changed(client, item_number):
+    for lot in ("L1", "L2"):
+        client.post(
+            "/add",
+            data={"item_number": item_number, "name": "Pectin", "quantity": "5", "unit": "kg", "lot": lot, "exp": ""},
+        )
+    stocktake_id = int(client.post("/stocktakes", data={"name": item_number}).location.rsplit("/", 1)[1])
+    conn = inventory_app._connect_primary()
+    c = conn.cursor()
+    try:
+        inventory_app.save_stocktake_counts(c, stocktake_id, {(item_number, "L1"): 4, (item_number, "L2"): 4})
+        conn.commit()
+        # After the snapshot L1 is re-entered as 6000 g (1 kg more) and L2 in an unrelated unit.
+        for lot, quantity, unit in (("L1", "6000", "g"), ("L2", "5", "L")):
+            client.post("/adjust", data={"item_number": item_number, "lot": lot, "new_quantity": quantity, "unit": unit})
+
+        touched, skipped = inventory_app.reconcile_stocktake(c, stocktake_id, "tester@example.com")
+        c.execute(
+            "SELECT lot, moved_since, final_quantity FROM stocktake_lines WHERE stocktake_id = %s AND item_number = %s ORDER BY lot",
+            (stocktake_id, item_number),
+        )
+        lines = c.fetchall()
+        conn.commit()
+    finally:
+        c.execute("DELETE FROM stocktakes WHERE id = %s", (stocktake_id,))
+        conn.commit()
+        conn.close()
+
+    assert touched == [item_number]
+    assert skipped == [f"{item_number} L2"]
+    assert lines == [("L1", 1, 5), ("L2", None, None)]
+    with inventory_app.repository.transaction(read_only=True) as tx:
+        assert tx.lot(item_number, "L1")[:2] == (5000, "g")
+        assert tx.lot(item_number, "L2")[:2] == (5, "L")